@@ -1,4 +1,5 @@
 from flask import Flask, render_template, Response
+from werkzeug.exceptions import default_exceptions
 from flask.logging import default_handler
 import logging
 import logging.handlers
@@ -12,6 +13,20 @@ from .mail import mail
 from .migrate import migrate
 from .login import login
 from .logger import Logger
+from .counter import views, scores
+from .ranking import ranking
+from .live import feed
+from .notify import digest
+from .moderate import runner
+from .audit import audit_log
+from .bus import bus, cache_cli
+from .template import template_cli, create_bytecode_cache, create_template_loader
+from .asset import asset_cli, load_manifest, asset_url, has_asset
+from .compress import CompressMiddleware
+from .admission import AdmissionMiddleware
+from .bench import bench_cli
+from .importer import import_cli
+from .snapshot import snapshot_cli
 
 from configure import conf
 
@@ -24,15 +39,27 @@ class HTalkFlask(Flask):
     def __init__(self, name):
         super(HTalkFlask, self).__init__(name)
         self.update_configure()
+        self.compress_setting()
         self.profile_setting()
         self.logging_setting()
+        self.template_setting()
         self.blueprint()
+        self.command()
 
         db.init_app(self)
         moment.init_app(self)
         mail.init_app(self)
         migrate.init_app(self, db)
         login.init_app(self)
+        views.init_app(self)
+        scores.init_app(self)
+        ranking.init_app(self)
+        feed.init_app(self)
+        digest.init_app(self)
+        runner.init_app(self)
+        audit_log.init_app(self)
+        bus.init_app(self)
+        load_manifest(self)
 
         @self.context_processor
         def inject_base():
@@ -40,9 +67,12 @@ class HTalkFlask(Flask):
             return {"conf": conf,
                     "Role": Role,
                     "User": User,
-                    "datetime": datetime}
+                    "datetime": datetime,
+                    "asset_url": asset_url,
+                    "has_asset": has_asset}
 
-        self.error_page([400, 401, 403, 404, 405, 408, 410, 413, 414, 423, 500, 501, 502])
+        self.error_page([400, 401, 403, 404, 405, 408, 410, 413, 414, 423, 429, 500, 501, 502, 503])
+        self.admission_setting()
 
     def blueprint(self):
         from .index import index
@@ -57,6 +87,53 @@ class HTalkFlask(Flask):
         from .archive import archive
         self.register_blueprint(archive, url_prefix="/ac")
 
+        from .api import api
+        self.register_blueprint(api, url_prefix="/api/v1")
+
+        from .live import live
+        self.register_blueprint(live, url_prefix="/live")
+
+        from .notify import notify
+        self.register_blueprint(notify, url_prefix="/notify")
+
+        from .spam import spam
+        self.register_blueprint(spam, url_prefix="/spam")
+
+        from .moderate import moderate
+        self.register_blueprint(moderate, url_prefix="/moderate")
+
+        from .audit import audit
+        self.register_blueprint(audit, url_prefix="/audit")
+
+        from .export import export
+        self.register_blueprint(export, url_prefix="/export")
+
+        from .asset import asset
+        self.register_blueprint(asset, url_prefix="/assets")
+
+        from .metrics import metric
+        self.register_blueprint(metric, url_prefix="/metrics")
+
+    def command(self):
+        self.cli.add_command(template_cli)
+        self.cli.add_command(asset_cli)
+        self.cli.add_command(bench_cli)
+        self.cli.add_command(import_cli)
+        self.cli.add_command(cache_cli)
+        self.cli.add_command(snapshot_cli)
+
+    def template_setting(self):
+        bytecode_cache = create_bytecode_cache()
+        if bytecode_cache is not None:
+            self.jinja_options = dict(self.jinja_options, bytecode_cache=bytecode_cache)
+
+    def create_global_jinja_loader(self):
+        return create_template_loader(self, super(HTalkFlask, self).create_global_jinja_loader())
+
+    def compress_setting(self):
+        if conf["COMPRESS"]:
+            self.wsgi_app = CompressMiddleware(self.wsgi_app)
+
     def profile_setting(self):
         if conf["DEBUG_PROFILE"]:
             self.wsgi_app = ProfilerMiddleware(self.wsgi_app, sort_by=("cumtime",))
@@ -82,13 +159,24 @@ class HTalkFlask(Flask):
         self.config.update(conf)
 
     def error_page(self, error_code):
+        """ 错误页面在启动时预先渲染, 处理错误时不访问数据库也不渲染模板 """
+        self.error_html = {}
+        with self.test_request_context("/"):
+            for i in error_code:
+                self.error_html[i] = render_template('error.html', error_code=i,
+                                                     error_info=default_exceptions[i]()).encode("utf-8")
+
         for i in error_code:
             def create_error_handle(status):  # 创建一个 status 变量给 error_handle
                 def error_handle(e):
                     Logger.print_load_page_log(status)
-                    data = render_template('error.html', error_code=status, error_info=e)
-                    return Response(response=data, status=status)
+                    headers = [h for h in e.get_headers() if h[0] != "Content-Type"]  # 保留 Allow 等响应头
+                    return Response(response=self.error_html[status], status=status, headers=headers)
                 return error_handle
 
             self.errorhandler(i)(create_error_handle(i))
 
+    def admission_setting(self):
+        if conf["ADMISSION"]:
+            self.wsgi_app = AdmissionMiddleware(self, self.wsgi_app)
+
@@ -0,0 +1,106 @@
+import threading
+from collections import deque
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_cookie
+from werkzeug.wsgi import ClosingIterator
+
+from .metrics import metrics
+
+from configure import conf
+
+
+HIGH, NORMAL, LOW = 0, 1, 2
+
+
+class Admission:
+    """
+    限制每个进程同时处理的请求数, 超出的请求按优先级排队
+    释放时把名额直接交给优先级最高的等待者, 队列已满或等待超时的请求立即返回 503
+    """
+
+    def __init__(self, limit: int, queue: list):
+        self.limit = limit
+        self.queue = queue
+        self.__lock = threading.Lock()
+        self.__active = 0
+        self.__waiting = [deque() for _ in queue]
+
+    def acquire(self, priority: int, timeout: float):
+        with self.__lock:
+            if self.__active < self.limit:
+                self.__active += 1
+                return True
+            if len(self.__waiting[priority]) >= self.queue[priority]:
+                return False
+            event = threading.Event()
+            self.__waiting[priority].append(event)
+
+        if event.wait(timeout):
+            return True
+        with self.__lock:
+            if event.is_set():  # 超时的同时被分配了名额
+                return True
+            self.__waiting[priority].remove(event)
+            return False
+
+    def release(self):
+        with self.__lock:
+            for waiting in self.__waiting:
+                if waiting:
+                    waiting.popleft().set()
+                    return
+            self.__active -= 1
+
+
+class AdmissionMiddleware:
+    """
+    按 endpoint 决定优先级: ADMISSION_PRIORITY 中配置的 endpoint 或蓝图优先,
+    写操作为 HIGH, 带有会话 cookie 的请求为 NORMAL, 匿名浏览为 LOW, 配置为 None 的不受限制
+    名额在响应发送完毕后才释放, 流式响应的整个过程都计入并发
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.admission = Admission(conf["ADMISSION_LIMIT"], conf["ADMISSION_QUEUE"])
+
+    def priority(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return LOW
+
+        rule = conf["ADMISSION_PRIORITY"]
+        if endpoint in rule:
+            return rule[endpoint]
+        blueprint = endpoint.rpartition(".")[0]
+        if blueprint in rule:
+            return rule[blueprint]
+
+        if environ["REQUEST_METHOD"] not in ("GET", "HEAD", "OPTIONS"):
+            return HIGH
+        cookie = parse_cookie(environ)
+        if self.app.config["SESSION_COOKIE_NAME"] in cookie or "remember_token" in cookie:
+            return NORMAL
+        return LOW
+
+    def __call__(self, environ, start_response):
+        priority = self.priority(environ)
+        if priority is None:
+            return self.wsgi_app(environ, start_response)
+
+        if not self.admission.acquire(priority, conf["ADMISSION_TIMEOUT"][priority]):
+            metrics.inc(f"admission_reject_total_{priority}")
+            body = self.app.error_html[503]
+            start_response("503 SERVICE UNAVAILABLE", [("Content-Type", "text/html; charset=utf-8"),
+                                                       ("Content-Length", str(len(body))),
+                                                       ("Retry-After", str(conf["ADMISSION_RETRY_AFTER"]))])
+            return [body]
+
+        metrics.inc(f"admission_admit_total_{priority}")
+        try:
+            return ClosingIterator(self.wsgi_app(environ, start_response), self.admission.release)
+        except BaseException:
+            self.admission.release()
+            raise
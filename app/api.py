@@ -0,0 +1,222 @@
+import base64
+import json
+from datetime import datetime
+from hashlib import sha1
+
+from flask import Blueprint, Response, request, abort
+from flask_login import current_user, login_required
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.exc import OperationalError
+
+from .db import db, Comment, Archive, ArchiveComment, User, Role, Follow
+from .login import role_required
+from .readmodel import son_count_column, search_user, is_query_timeout
+
+from configure import conf
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+api = Blueprint("api", __name__)
+
+MAX_LIMIT = 50
+MAX_BATCH = 100
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"),
+                      default=lambda o: o.isoformat()).encode("utf-8")
+
+
+def json_response(obj, status=200):
+    """ 生成 json 响应, 并根据内容设置 ETag 处理条件请求 """
+    response = Response(dumps(obj), status=status, mimetype="application/json")
+    if status == 200 and request.method == "GET":
+        response.set_etag(sha1(response.get_data()).hexdigest())
+        response.make_conditional(request)
+    return response
+
+
+def api_error(e: HTTPException):
+    return json_response({"code": e.code, "error": e.name}, e.code)
+
+
+for code in (400, 401, 403, 404, 405, 500):  # 需要按状态码注册才能覆盖 app 的 html 错误页面
+    api.register_error_handler(code, api_error)
+
+
+def get_limit():
+    return max(1, min(request.args.get("limit", 20, type=int), MAX_LIMIT))
+
+
+def encode_cursor(time: datetime, id_: int):
+    return base64.urlsafe_b64encode(f"{time.isoformat()}|{id_}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    try:
+        time, id_ = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|")
+        return datetime.fromisoformat(time), int(id_)
+    except (ValueError, UnicodeError):
+        return abort(400)
+
+
+def paginate_rows(stmt, time_column, id_column, limit: int):
+    """ 按 (时间, ID) 倒序的游标分页, 多取一行判断是否存在下一页 """
+    cursor = request.args.get("cursor", None)
+    if cursor:
+        time, id_ = decode_cursor(cursor)
+        stmt = stmt.where(db.or_(time_column < time, db.and_(time_column == time, id_column < id_)))
+    rows = db.session.execute(stmt.order_by(time_column.desc(), id_column.desc()).limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].create_time, rows[-1].id)
+    return rows, next_cursor
+
+
+def comment_select():
+    return (db.select(Comment.id, Comment.title, Comment.content, Comment.content_html,
+                      Comment.create_time, Comment.update_time,
+                      Comment.father_id, Comment.auth_id, User.email.label("auth_email"), son_count_column())
+            .join(User, User.id == Comment.auth_id))
+
+
+def comment_dict(row):
+    return {"id": row.id, "title": row.title, "content": row.content, "content_html": row.content_html,
+            "create_time": row.create_time, "update_time": row.update_time,
+            "father": row.father_id, "son_count": row.son_count,
+            "auth": {"id": row.auth_id, "email": row.auth_email}}
+
+
+@api.route("/comment/list")
+@role_required(Role.CHECK_COMMENT, "api list comment")
+def comment_list_page():
+    archive_id = request.args.get("archive", None, type=int)
+    user_id = request.args.get("user", None, type=int)
+
+    stmt = comment_select()
+    if user_id:
+        stmt = stmt.where(Comment.auth_id == user_id)
+    else:
+        stmt = stmt.where(Comment.title != None).where(Comment.father_id == None)
+        if archive_id:
+            stmt = stmt.join(ArchiveComment, ArchiveComment.c.comment_id == Comment.id).where(
+                ArchiveComment.c.archive_id == archive_id)
+
+    rows, cursor = paginate_rows(stmt, Comment.create_time, Comment.id, get_limit())
+    return json_response({"items": [comment_dict(i) for i in rows], "cursor": cursor})
+
+
+@api.route("/comment/<int:comment_id>")
+@role_required(Role.CHECK_COMMENT, "api check comment")
+def comment_page(comment_id):
+    row = db.session.execute(comment_select().where(Comment.id == comment_id)).first()
+    if not row:
+        return abort(404)
+    rows, cursor = paginate_rows(comment_select().where(Comment.father_id == comment_id),
+                                 Comment.create_time, Comment.id, get_limit())
+    return json_response({"comment": comment_dict(row), "son": [comment_dict(i) for i in rows], "cursor": cursor})
+
+
+@api.route("/comment/batch")
+@role_required(Role.CHECK_COMMENT, "api batch comment")
+def comment_batch_page():
+    try:
+        ids = [int(i) for i in request.args.get("ids", "").split(",") if i]
+    except ValueError:
+        return abort(400)
+    if len(ids) == 0 or len(ids) > MAX_BATCH:
+        return abort(400)
+
+    rows = {i.id: i for i in db.session.execute(comment_select().where(Comment.id.in_(ids)))}
+    return json_response({"items": [comment_dict(rows[i]) for i in ids if i in rows]})
+
+
+@api.route("/archive/list")
+@role_required(Role.CHECK_ARCHIVE, "api list archive")
+def archive_list_page():
+    comment_count = (db.select(db.func.count(Comment.id))
+                     .join(ArchiveComment, ArchiveComment.c.comment_id == Comment.id)
+                     .where(ArchiveComment.c.archive_id == Archive.id)
+                     .where(Comment.title != None).where(Comment.father_id == None)
+                     .correlate(Archive)
+                     .scalar_subquery())
+    rows = db.session.execute(db.select(Archive.id, Archive.name, Archive.describe,
+                                        comment_count.label("comment_count"))
+                              .order_by(Archive.name.asc()))
+    return json_response({"items": [{"id": i.id, "name": i.name, "describe": i.describe,
+                                     "comment_count": i.comment_count} for i in rows]})
+
+
+@api.route("/user/<int:user_id>")
+def user_page(user_id):
+    def count(stmt):
+        return stmt.correlate(User).scalar_subquery()
+
+    comment_count = count(db.select(db.func.count(Comment.id)).where(Comment.auth_id == User.id))
+    follower_count = count(db.select(db.func.count()).select_from(Follow).where(Follow.followed_id == User.id))
+    followed_count = count(db.select(db.func.count()).select_from(Follow).where(Follow.follower_id == User.id))
+    row = db.session.execute(db.select(User.id, User.email, Role.name.label("role"),
+                                       comment_count.label("comment_count"),
+                                       follower_count.label("follower_count"),
+                                       followed_count.label("followed_count"))
+                             .join(Role, Role.id == User.role_id)
+                             .where(User.id == user_id)).first()
+    if not row:
+        return abort(404)
+    return json_response(dict(row._mapping))
+
+
+@api.route("/user/search")
+@login_required
+@role_required(Role.BLOCK_USER, "api search user")
+def user_search_page():
+    """ 管理员表单的自动补全: q 为邮箱前缀, role 为角色名, 以返回的 cursor 作为 after 翻页 """
+    prefix = request.args.get("q", "").strip()
+    if not prefix:
+        return json_response({"items": [], "cursor": None})
+    role_id = None
+    if request.args.get("role"):
+        role_id = db.session.execute(db.select(Role.id).where(Role.name == request.args["role"])).scalar()
+        if role_id is None:
+            return abort(404)
+
+    limit = min(get_limit(), conf["USER_SEARCH_LIMIT"])
+    try:
+        rows = search_user(prefix, role_id, request.args.get("after"), limit)
+    except OperationalError as e:
+        if not is_query_timeout(e):
+            raise
+        db.session.rollback()
+        return json_response({"items": [], "cursor": None, "timeout": True})  # 自动补全提示输入更长的前缀
+    return json_response({"items": [dict(i._mapping) for i in rows],
+                          "cursor": rows[-1].email if len(rows) == limit else None})
+
+
+def follow_list(user_column, other_column):
+    stmt = (db.select(User.id, User.email, Follow.time.label("create_time"))
+            .join(Follow, other_column == User.id)
+            .where(user_column == current_user.id))
+    rows, cursor = paginate_rows(stmt, Follow.time, User.id, get_limit())
+    return json_response({"items": [{"id": i.id, "email": i.email, "time": i.create_time} for i in rows],
+                          "cursor": cursor})
+
+
+@api.route("/follower/list")
+@login_required
+@role_required(Role.CHECK_FOLLOW, "api check follower")
+def follower_list_page():
+    return follow_list(Follow.followed_id, Follow.follower_id)
+
+
+@api.route("/followed/list")
+@login_required
+@role_required(Role.CHECK_FOLLOW, "api check followed")
+def followed_list_page():
+    return follow_list(Follow.follower_id, Follow.followed_id)
@@ -7,6 +7,8 @@ from flask_login import login_required
 from .db import db, Archive, Role
 from .login import role_required
 from .logger import Logger
+from .audit import audit_log
+from .readmodel import archives
 
 
 archive = Blueprint("archive", __name__)
@@ -33,6 +35,7 @@ class CreateArchiveForm(FlaskForm):
 def list_all_page():
     page = request.args.get("page", 1, type=int)
     pagination = (Archive.query
+                  .options(*Archive.card_options())
                   .order_by(Archive.name.asc())
                   .paginate(page=page, per_page=8, error_out=False))
     Logger.print_load_page_log("list all archive")
@@ -52,6 +55,8 @@ def create_page():
         ac = Archive(name=form.name.data, describe=form.describe.data)
         db.session.add(ac)
         db.session.commit()
+        archives.invalidate()
+        audit_log.record("create_archive", "archive", ac.id, ac.name)
         Logger.print_user_opt_success_log(f"create new archive {ac.name}")
         return redirect(url_for("comment.list_all_page", archive=ac.id, page=1))
     Logger.print_load_page_log("create archive page")
@@ -0,0 +1,138 @@
+import gzip
+import json
+import mimetypes
+import os
+import re
+from hashlib import sha1
+from urllib.request import Request, urlopen
+from urllib.parse import urljoin
+
+import click
+from flask import Blueprint, current_app, request, send_file, abort, url_for
+from flask.cli import AppGroup
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+              "(KHTML, like Gecko) Chrome/120.0 Safari/537.36")  # Google Fonts 根据 UA 返回 woff2 字体
+
+# 逻辑名 -> 第三方地址, 未执行构建时模板直接使用第三方地址
+ASSETS = {
+    "bootstrap.min.css": "https://cdn.jsdelivr.net/npm/bootstrap@5.2.2/dist/css/bootstrap.min.css",
+    "bootstrap.bundle.min.js": "https://cdn.jsdelivr.net/npm/bootstrap@5.2.2/dist/js/bootstrap.bundle.min.js",
+    "moment-with-locales.min.js": "https://cdnjs.cloudflare.com/ajax/libs/moment.js/2.29.4/moment-with-locales.min.js",
+    "noto-sans-sc.css": "https://fonts.googleapis.com/css2?family=Noto+Sans+SC:wght@100;400&display=swap",
+}
+
+mimetypes.add_type("font/woff2", ".woff2")
+
+asset = Blueprint("asset", __name__)
+asset_cli = AppGroup("asset", help="静态资源构建")
+manifest = {}
+
+
+def asset_home(app=None):
+    return os.path.join((app or current_app).static_folder, "assets")
+
+
+def load_manifest(app):
+    """ 读取构建生成的 manifest, 不存在时使用第三方地址 """
+    manifest.clear()
+    try:
+        with open(os.path.join(asset_home(app), "manifest.json"), mode="r", encoding="utf-8") as f:
+            manifest.update(json.loads(f.read()))
+    except (OSError, ValueError):
+        pass
+
+
+def has_asset(name: str):
+    return name in manifest
+
+
+def asset_url(name: str):
+    """ 模板中引用静态资源的地址 """
+    if name in manifest:
+        return url_for("asset.asset_page", filename=manifest[name])
+    return ASSETS[name]
+
+
+@asset.route("/<path:filename>")
+def asset_page(filename):
+    path = safe_join(asset_home(), filename)
+    if path is None or filename.endswith((".gz", ".br")) or not os.path.isfile(path):
+        return abort(404)
+
+    encoding = None
+    for i, suffix in (("br", ".br"), ("gzip", ".gz")):  # 优先使用预压缩文件
+        if request.accept_encodings[i] and os.path.isfile(path + suffix):
+            encoding = i
+            path += suffix
+            break
+
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = send_file(path, mimetype=mimetype, max_age=ASSET_MAX_AGE, conditional=True)
+    response.cache_control.immutable = True
+    response.cache_control.public = True
+    response.vary.add("Accept-Encoding")
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
+
+def fetch(url: str):
+    with urlopen(Request(url, headers={"User-Agent": USER_AGENT}), timeout=60) as f:
+        return f.read()
+
+
+def write_asset(home: str, name: str, data: bytes):
+    """ 以内容哈希命名写入资源, 并生成 gzip/brotli 预压缩文件 """
+    stem, ext = os.path.splitext(name)
+    filename = f"{stem}.{sha1(data).hexdigest()[:12]}{ext}"
+    path = os.path.join(home, filename)
+    with open(path, mode="wb") as f:
+        f.write(data)
+
+    if ext in (".woff2", ".woff"):  # 字体已经压缩
+        return filename
+
+    with open(path + ".gz", mode="wb") as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + ".br", mode="wb") as f:
+            f.write(brotli.compress(data, quality=11))
+    return filename
+
+
+def build_font_css(home: str, url: str, css: bytes):
+    """ 下载字体样式引用的按 unicode-range 分片的字体子集, 并改写为本地地址 """
+    css = css.decode("utf-8")
+    font_files = {}
+    for font_url in set(re.findall(r"url\((https?://[^)]+)\)", css)):
+        font_files[font_url] = write_asset(home, "noto-sans-sc.woff2", fetch(urljoin(url, font_url)))
+    return re.sub(r"url\((https?://[^)]+)\)", lambda m: f"url({font_files[m.group(1)]})", css).encode("utf-8")
+
+
+@asset_cli.command("build")
+def build_asset():
+    """ 下载第三方静态资源到 static/assets, 生成指纹文件名、预压缩文件和 manifest """
+    home = asset_home()
+    os.makedirs(home, exist_ok=True)
+
+    new_manifest = {}
+    for name, url in ASSETS.items():
+        data = fetch(url)
+        if name == "noto-sans-sc.css":
+            data = build_font_css(home, url, data)
+        new_manifest[name] = write_asset(home, name, data)
+        click.echo(f"{url} -> {new_manifest[name]}")
+
+    with open(os.path.join(home, "manifest.json"), mode="w", encoding="utf-8") as f:
+        f.write(json.dumps(new_manifest, indent=2))
+    if brotli is None:
+        click.echo("brotli is not installed, skip brotli compression")
@@ -0,0 +1,244 @@
+import atexit
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import Blueprint, render_template, request, has_request_context
+from flask_login import current_user, login_required
+from sqlalchemy.exc import SQLAlchemyError
+
+from .db import db, AuditLog, User, Role
+from .login import role_required
+from .logger import Logger
+
+from configure import conf
+
+
+audit = Blueprint("audit", __name__)
+
+
+def spool_path():
+    return conf["AUDIT_SPOOL_FILE"] or os.path.join(conf["LOG_HOME"] or tempfile.gettempdir(), "htalk-audit.ndjson")
+
+
+def append(path: str, data: str):
+    with open(path, "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def parse_entry(line: str):
+    entry = json.loads(line)
+    entry["time"] = datetime.fromisoformat(entry["time"])
+    return entry
+
+
+class AuditBuffer:
+    """
+    审计日志先缓存在进程内, 由后台线程每 AUDIT_FLUSH_INTERVAL 秒批量插入, 请求中只追加到列表
+    写入失败的记录保留在内存中重试, 超过 AUDIT_MAX_PENDING 条或进程退出时仍未写入的记录追加到本地文件,
+    下次刷新时补写进数据库
+    """
+
+    def __init__(self):
+        self.app = None
+        self.__lock = threading.Lock()
+        self.__pending = []
+        self.__pid = None
+
+    def init_app(self, app):
+        self.app = app
+        atexit.register(self.close)
+
+    def __start(self):
+        """ 在 worker 进程内第一次记录时启动刷新线程 (gunicorn 会在 fork 后调用) """
+        if self.__pid == os.getpid():
+            return
+        self.__pid = os.getpid()
+        self.__pending = []  # 不写入 fork 前父进程的记录
+        threading.Thread(target=self.__run, name="audit-log", daemon=True).start()
+
+    def __run(self):
+        while True:
+            time.sleep(conf["AUDIT_FLUSH_INTERVAL"])
+            try:
+                self.flush()
+            except Exception:  # 刷新线程不能退出, 记录已放回内存, 下次重试
+                self.app.logger.exception("Flush audit log fail")
+
+    def record(self, action: str, target_type=None, target_id=None, detail=None):
+        """ 在请求中调用时记录当前用户和 ip """
+        entry = {"time": datetime.utcnow(), "action": action, "target_type": target_type, "target_id": target_id,
+                 "detail": detail[:256] if detail else detail, "actor_id": None, "ip": None}
+        if has_request_context():
+            entry["ip"] = request.remote_addr
+            if current_user.is_authenticated:
+                entry["actor_id"] = current_user.id
+
+        with self.__lock:
+            self.__start()
+            self.__pending.append(entry)
+            if len(self.__pending) <= conf["AUDIT_MAX_PENDING"]:
+                return
+            pending, self.__pending = self.__pending, []
+        self.spool(pending)  # 数据库长时间不可用, 避免内存无限增长
+
+    def flush(self):
+        with self.__lock:
+            pending, self.__pending = self.__pending, []
+        if self.app is None:
+            return
+
+        with self.app.app_context():
+            try:
+                self.replay()
+                if pending:
+                    db.session.execute(AuditLog.__table__.insert(), pending)
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                with self.__lock:
+                    self.__pending[:0] = pending
+                if not isinstance(e, SQLAlchemyError):
+                    raise
+                self.app.logger.exception("Flush audit log fail")
+            finally:
+                db.session.remove()
+
+    def close(self):
+        """ 进程退出时最后写入一次, 失败则追加到本地文件 """
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception("Flush audit log fail")
+        with self.__lock:
+            pending, self.__pending = self.__pending, []
+        if pending:
+            self.spool(pending)
+
+    @staticmethod
+    def spool(entries: list):
+        append(spool_path(), "".join(json.dumps(i, ensure_ascii=False, default=lambda o: o.isoformat()) + "\n"
+                                     for i in entries))
+
+    @staticmethod
+    def replay():
+        """
+        补写本地文件中的记录, 改名后读取, 多个进程同时补写时只有一个能改名成功
+        无法解析的行 (例如写入时进程被杀死留下的半行) 移到 <spool>.bad, 不影响其他记录
+        """
+        path = spool_path()
+        if not os.path.exists(path):
+            return 0
+        replaying = f"{path}.{os.getpid()}"
+        try:
+            os.rename(path, replaying)
+        except FileNotFoundError:
+            return 0
+
+        with open(replaying, "r", encoding="utf-8", errors="replace") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # 等待改名前已打开文件的进程写完
+            lines = [line for line in f if line.strip()]
+        entries, bad = [], []
+        for line in lines:
+            try:
+                entries.append(parse_entry(line))
+            except (ValueError, KeyError, TypeError):
+                bad.append(line if line.endswith("\n") else line + "\n")
+        if bad:
+            append(f"{path}.bad", "".join(bad))
+        try:
+            if entries:
+                db.session.execute(AuditLog.__table__.insert(), entries)
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            AuditBuffer.spool(entries)
+            raise
+        finally:
+            os.remove(replaying)
+        return len(entries)
+
+
+audit_log = AuditBuffer()
+
+
+@audit.route("/")
+@login_required
+@role_required(Role.SYSTEM, "audit log")
+def list_page():
+    """ 按操作者、对象和时间范围筛选, 以上一页最后一条的 id 作为 before 翻页 """
+    actor = request.args.get("actor", "").strip()
+    target_type = request.args.get("target_type", "").strip()
+    target_id = request.args.get("target_id", None, type=int)
+    action = request.args.get("action", "").strip()
+    start = request.args.get("start", "").strip()
+    end = request.args.get("end", "").strip()
+    before = request.args.get("before", None, type=int)
+
+    stmt = db.select(AuditLog).order_by(AuditLog.id.desc()).limit(conf["AUDIT_PAGE_SIZE"])
+    if actor:
+        actor_id = int(actor) if actor.isdigit() else db.session.execute(
+            db.select(User.id).where(User.email == actor)).scalar()
+        stmt = stmt.where(AuditLog.actor_id == actor_id)
+    if target_type:
+        stmt = stmt.where(AuditLog.target_type == target_type)
+        if target_id is not None:
+            stmt = stmt.where(AuditLog.target_id == target_id)
+    if action:
+        stmt = stmt.where(AuditLog.action == action)
+    try:
+        if start:
+            stmt = stmt.where(AuditLog.time >= datetime.fromisoformat(start))
+        if end:
+            stmt = stmt.where(AuditLog.time < datetime.fromisoformat(end))
+    except ValueError:
+        start = end = ""
+    if before:
+        stmt = stmt.where(AuditLog.id < before)
+
+    items = db.session.execute(stmt).scalars().all()
+    emails = dict(db.session.execute(db.select(User.id, User.email)
+                                     .where(User.id.in_({i.actor_id for i in items if i.actor_id}))).all())
+    cursor = items[-1].id if len(items) == conf["AUDIT_PAGE_SIZE"] else None
+    Logger.print_load_page_log("audit log")
+    return render_template("audit/list.html", items=items, emails=emails, cursor=cursor,
+                           args={"actor": actor, "target_type": target_type, "target_id": target_id,
+                                 "action": action, "start": start, "end": end})
+
+
+@audit.cli.command("prune")
+@click.option("--days", default=None, type=int, help="保留的天数, 默认为 AUDIT_RETENTION_DAYS")
+@click.option("--chunk", default=10000, help="每个事务删除的 id 范围")
+def prune_command(days, chunk):
+    """ 按 id 范围分批删除过期的审计日志, id 与时间基本同序, 每批只扫描主键的一段 """
+    cutoff = datetime.utcnow() - timedelta(days=days if days is not None else conf["AUDIT_RETENTION_DAYS"])
+    last = db.session.execute(db.select(db.func.max(AuditLog.id)).where(AuditLog.time < cutoff)).scalar()
+    first = db.session.execute(db.select(db.func.min(AuditLog.id))).scalar()
+    if last is None:
+        click.echo("Nothing to prune")
+        return
+
+    table = AuditLog.__table__
+    count = 0
+    for start in range(first, last + 1, chunk):
+        result = db.session.execute(table.delete()
+                                    .where(table.c.id >= start)
+                                    .where(table.c.id < min(start + chunk, last + 1))
+                                    .where(table.c.time < cutoff))  # 从本地文件补写的记录 id 较大但时间较早
+        db.session.commit()
+        count += result.rowcount
+    click.echo(f"Prune {count} audit log before {cutoff.isoformat()}")
+
+
+@audit.cli.command("replay")
+def replay_command():
+    """ 立即补写本地文件中未写入数据库的审计日志 """
+    click.echo(f"Replay {AuditBuffer.replay()} audit log")
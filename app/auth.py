@@ -5,17 +5,24 @@ from wtforms import (EmailField,
                      BooleanField,
                      SubmitField,
                      ValidationError,
-                     StringField)
+                     StringField,
+                     HiddenField)
 from wtforms.validators import DataRequired, Length, Regexp, EqualTo
 from flask_login import current_user, login_user, logout_user, login_required
 from urllib.parse import urljoin
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 
 from .db import db, User, Role, Follow
 from .logger import Logger
 from .mail import send_msg
+from .notify import notify_follow
+from .ratelimit import rate_limit
 from .login import role_required
+from .audit import audit_log
+from .readmodel import search_user, is_query_timeout
+
+from configure import conf
 
 
 auth = Blueprint("auth", __name__)
@@ -88,17 +95,25 @@ class ChangePasswdForm(AuthField):
 
 
 class ChangeRoleForm(AuthField):
+    user = HiddenField()  # 通过搜索选中的用户 id, 存在时不再按邮箱查询
     email = AuthField.email_field("邮箱", "用户邮箱")
     role = StringField("角色", description="用户角色", validators=[DataRequired(message="必须指定用户角色")])
     submit = SubmitField("修改")
 
     def validate_role(self, field):
-        if not Role.query.filter_by(name=field.data).first():
+        self.role_obj = Role.query.filter_by(name=field.data).first()
+        if not self.role_obj:
             raise ValidationError("角色不存在")
 
-
     def validate_email(self, field):
-        if not User.query.filter_by(email=field.data).first():
+        """ 通过搜索选中用户时按 id 查询, 邮箱被修改过时拒绝, 避免修改的不是页面上显示的用户 """
+        if self.user.data and self.user.data.isdigit():
+            self.user_obj = db.session.get(User, int(self.user.data))
+            if self.user_obj and self.user_obj.email != field.data:
+                raise ValidationError("邮箱与选中的用户不一致, 请重新选择")
+        else:
+            self.user_obj = User.query.filter_by(email=field.data).first()
+        if not self.user_obj:
             raise ValidationError("用户不存在")
 
 
@@ -129,6 +144,7 @@ def auth_page():
 
 
 @auth.route('/login/passwd', methods=["GET", "POST"])
+@rate_limit("passwd_login")
 def passwd_login_page():
     if current_user.is_authenticated:  # 用户已经成功登陆
         Logger.print_user_not_allow_opt_log("passwd-login")
@@ -138,6 +154,7 @@ def passwd_login_page():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         if user and user.check_passwd(form.passwd.data) and user.role.has_permission(Role.USABLE):
+            db.session.commit()  # 保存重新计算的哈希
             login_user(user, form.remember.data)
             next_page = request.args.get("next")
             if next_page is None or not next_page.startswith('/'):
@@ -152,6 +169,7 @@ def passwd_login_page():
 
 
 @auth.route('/login/email', methods=["GET", "POST"])
+@rate_limit("email_login")
 def email_login_page():
     if current_user.is_authenticated:  # 用户已经成功登陆
         Logger.print_user_not_allow_opt_log("email-login")
@@ -170,10 +188,11 @@ def email_login_page():
         flash("账号不存在")
         Logger.print_user_opt_fail_log(f"email login {form.email.data}")
         return redirect(url_for("auth.passwd_login_page"))
-    return __load_login_page(passwd_login_form=form, on_passwd_login=True)
+    return __load_login_page(email_login_form=form, on_passwd_login=False, on_email_login=True)
 
 
 @auth.route('/register', methods=["GET", "POST"])
+@rate_limit("register")
 def register_page():
     if current_user.is_authenticated:
         Logger.print_user_not_allow_opt_log("register")
@@ -181,7 +200,7 @@ def register_page():
 
     form = RegisterForm()
     if form.validate_on_submit():
-        token = User.register_creat_token(form.email.data, form.passwd.data)
+        token = User.register_creat_token(form.email.data, User.get_passwd_hash(form.passwd.data))
         register_url = urljoin(request.host_url, url_for("auth.register_confirm_page", token=token))
         send_msg("注册确认", form.email.data, "register", register_url=register_url)
         flash("注册提交成功, 请进入邮箱点击确认注册链接")
@@ -206,16 +225,21 @@ def register_confirm_page():
         Logger.print_user_opt_fail_log(f"register confirm (bad token)")
         return abort(404)
 
+    passwd_hash = token[1]
+    if not token[2]:  # 升级前签发的链接中是明文密码
+        passwd_hash = User.get_passwd_hash(passwd_hash)
+
     if User.query.limit(1).first():  # 不是第一个用户
-        new_user = User(email=token[0], passwd_hash=User.get_passwd_hash(token[1]))
+        new_user = User(email=token[0], passwd_hash=passwd_hash)
     else:
         admin = Role.query.filter_by(name="admin").first()
         if admin is None:
             Logger.print_sys_opt_fail_log(f"get admin(role)")
             return abort(500)
-        new_user = User(email=token[0], passwd_hash=User.get_passwd_hash(token[1]), role=admin)
+        new_user = User(email=token[0], passwd_hash=passwd_hash, role=admin)
     db.session.add(new_user)
     db.session.commit()
+    audit_log.record("register", "user", new_user.id, new_user.email)
 
     Logger.print_user_opt_success_log(f"register confirm {token[0]}")
     flash(f"用户{token[0]}认证完成")
@@ -297,7 +321,8 @@ def follower_page():
         return render_template("auth/no_follow.html", title="粉丝", msg="你暂时一个粉丝都没有哦。")
 
     page = request.args.get("page", 1, type=int)
-    pagination = current_user.follower.paginate(page=page, per_page=8, error_out=False)
+    pagination = (current_user.follower.options(db.joinedload(Follow.follower))
+                  .paginate(page=page, per_page=8, error_out=False))
     Logger.print_load_page_log(f"user {current_user.email} follower")
     return render_template("auth/follow.html",
                            items=[i.follower for i in pagination.items],
@@ -313,7 +338,8 @@ def followed_page():
         return render_template("auth/no_follow.html", title="关注", msg="你暂时未关注任何人。")
 
     page = request.args.get("page", 1, type=int)
-    pagination = current_user.followed.paginate(page=page, per_page=8, error_out=False)
+    pagination = (current_user.followed.options(db.joinedload(Follow.followed))
+                  .paginate(page=page, per_page=8, error_out=False))
     Logger.print_load_page_log(f"user {current_user.email} followed")
     return render_template("auth/follow.html",
                            items=[i.followed for i in pagination.items],
@@ -335,6 +361,7 @@ def set_follow_page():
 
     try:
         db.session.add(Follow(follower=current_user, followed=user))
+        notify_follow(current_user, user)
         db.session.commit()
     except IntegrityError:
         flash("不能重复关注用户")
@@ -379,8 +406,10 @@ def set_block_page():
         Logger.print_sys_opt_fail_log("get block(role)")
         return abort(500)
 
+    old_role = user.role.name
     user.role = block
     db.session.commit()
+    audit_log.record("change_role", "user", user_id, f"{old_role} -> block")
 
     return redirect(url_for("auth.user_page", user=user_id))
 
@@ -391,20 +420,43 @@ def set_block_page():
 def change_role_page():
     form = ChangeRoleForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data).first()
-        if not user:
-            flash("用户不存在")
-            return redirect(url_for("auth.change_role_page"))
-
-        role = Role.query.filter_by(name=form.role.data).first()
-        if not role:
-            flash("角色不存在")
-            return redirect(url_for("auth.change_role_page"))
-
+        user, role = form.user_obj, form.role_obj
+        old_role = user.role.name
         user.role = role
         db.session.commit()
+        audit_log.record("change_role", "user", user.id, f"{old_role} -> {role.name}")
         flash("用户分组修改成功")
         Logger.print_sys_opt_success_log(f"move {user.email} to {role.name}")
         return redirect(url_for("auth.change_role_page"))
+
+    user = db.session.get(User, request.args.get("user", 0, type=int))
+    if user and not form.is_submitted():
+        form.user.data = str(user.id)
+        form.email.data = user.email
+        form.role.data = user.role.name
     Logger.print_load_page_log("change user role")
-    return render_template("auth/change_role.html", form=form)
+    return render_template("auth/change_role.html", form=form, roles=Role.query.order_by(Role.name).all())
+
+
+@auth.route("/search")
+@login_required
+@role_required(Role.BLOCK_USER, "search user")
+def search_page():
+    prefix = request.args.get("q", "").strip()
+    role = request.args.get("role", "")
+    after = request.args.get("after", None)
+    roles = Role.query.order_by(Role.name).all()
+    role_id = next((i.id for i in roles if i.name == role), None)
+
+    items = []
+    if prefix:
+        try:
+            items = search_user(prefix, role_id, after, conf["USER_SEARCH_LIMIT"])
+        except OperationalError as e:
+            if not is_query_timeout(e):
+                raise
+            db.session.rollback()
+            flash("匹配的用户过多, 请输入更长的邮箱前缀")
+    cursor = items[-1].email if len(items) == conf["USER_SEARCH_LIMIT"] else None
+    Logger.print_load_page_log("search user")
+    return render_template("auth/search.html", items=items, roles=roles, prefix=prefix, role=role, cursor=cursor)
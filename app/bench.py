@@ -0,0 +1,119 @@
+import time
+import tracemalloc
+
+import click
+from flask.cli import AppGroup
+
+from .db import db, Comment
+
+
+bench_cli = AppGroup("bench", help="性能测试")
+
+
+def measure(func, times: int):
+    """ 返回平均 CPU 时间(ms)和峰值内存(KiB) """
+    tracemalloc.start()
+    start = time.process_time()
+    for _ in range(times):
+        func()
+        db.session.remove()  # 每次模拟一个新请求
+    cpu = (time.process_time() - start) * 1000 / times
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak / 1024
+
+
+@bench_cli.command("readmodel")
+@click.option("--times", default=50, help="每种方式执行的次数")
+@click.option("--per-page", default=8, help="每页讨论个数")
+def bench_readmodel(times, per_page):
+    """ 对比主页讨论列表使用 ORM 和只读模型的开销 """
+    from .readmodel import list_comment_card
+
+    def orm_page():
+        pagination = (Comment.query
+                      .options(*Comment.card_options(), db.undefer(Comment.content))
+                      .filter(Comment.title != None).filter(Comment.father_id == None)
+                      .order_by(Comment.create_time.desc(), Comment.title.desc())
+                      .paginate(page=1, per_page=per_page, error_out=False))
+        return [(i.title, i.content, i.auth.email, i.son_count, i.create_time) for i in pagination.items]
+
+    def readmodel_page():
+        pagination = list_comment_card(1, per_page)
+        return [(i.title, i.excerpt, i.auth.email, i.son_count, i.create_time) for i in pagination.items]
+
+    for name, func in (("orm", orm_page), ("readmodel", readmodel_page)):
+        func()  # 预热
+        cpu, peak = measure(func, times)
+        click.echo(f"{name:10} cpu {cpu:.3f} ms/page  peak memory {peak:.1f} KiB")
+
+
+@bench_cli.command("bus")
+@click.option("--transport", default="socket", type=click.Choice(["socket", "database"]), help="失效总线的传输方式")
+@click.option("--workers", default=4, help="接收消息的进程个数")
+@click.option("--times", default=20, help="发布的次数")
+def bench_bus(transport, workers, times):
+    """ fork 多个进程模拟 worker, 测量失效消息从发布到所有进程收到的延迟 """
+    import multiprocessing
+    from flask import current_app
+    from .bus import InvalidationBus, TRANSPORT
+
+    app = current_app._get_current_object()
+    queue = multiprocessing.get_context("fork").Queue()
+    ready = multiprocessing.get_context("fork").Barrier(workers + 1)
+
+    def worker():
+        db.engine.dispose()  # 不使用父进程的连接
+        receiver = InvalidationBus()
+        receiver.app = app
+        receiver.transport = TRANSPORT[transport]()
+        receiver.subscribe("bench", lambda key: queue.put((key, time.time())))
+        receiver.transport.start(receiver)
+        ready.wait()
+        time.sleep(3600)
+
+    processes = [multiprocessing.get_context("fork").Process(target=worker, daemon=True) for _ in range(workers)]
+    for i in processes:
+        i.start()
+    ready.wait()
+    time.sleep(1)  # database 传输的第一次轮询只记录起点
+
+    sender = InvalidationBus()
+    sender.app = app
+    sender.transport = TRANSPORT[transport]()
+    delay = []
+    for n in range(times):
+        start = time.time()
+        sender.publish("bench", n)
+        received = [queue.get(timeout=10) for _ in range(workers)]
+        delay.append(max(t for _, t in received) - start)
+    for i in processes:
+        i.terminate()
+
+    delay.sort()
+    click.echo(f"{transport:10} workers {workers}  median {delay[len(delay) // 2] * 1000:.2f} ms  "
+               f"max {delay[-1] * 1000:.2f} ms")
+
+
+@bench_cli.command("passwd")
+@click.option("--times", default=100, help="验证密码的次数")
+@click.option("--concurrency", default=8, help="同时验证的线程数")
+def bench_passwd(times, concurrency):
+    """ 模拟登录高峰, 测量每秒可以验证的密码个数和请求线程占用的 CPU 时间 """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from configure import conf
+    from .passwd import hasher
+
+    passwd_hash = hasher.hash("passwd")
+    hasher.check(passwd_hash, "passwd")  # 预热, 启动进程池
+    cores = min(conf["PASSWD_WORKERS"] or 1, os.cpu_count())
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        assert all(executor.map(lambda _: hasher.check(passwd_hash, "passwd"), range(times)))
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    click.echo(f"{conf['PASSWD_METHOD']}  workers {conf['PASSWD_WORKERS']}  "
+               f"{times / wall:.1f} login/s  {times / wall / cores:.1f} login/s/core  "
+               f"request process cpu {cpu * 1000 / times:.2f} ms/login")
@@ -0,0 +1,262 @@
+import glob
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+
+from .db import db, CacheVersion
+from .metrics import metrics
+
+from configure import conf
+
+
+OVERLAP = timedelta(seconds=5)  # 轮询时多读一段时间, 覆盖提交延迟, 重复的消息按版本号忽略
+
+
+class LocalTransport:
+    """ 只在本进程内生效, 用于开发和单进程部署 """
+
+    def start(self, bus):
+        pass
+
+    def send(self, namespace: str, key: str):
+        return time.time_ns()
+
+
+class SocketTransport:
+    """
+    同一台机器上的每个进程在 BUS_SOCKET_DIR 下绑定一个 UNIX 数据报 socket, 发布时逐个发送
+    接收方缓冲区已满时丢弃消息, 由缓存的 ttl 兜底; 已退出进程的 socket 文件在发送失败时删除
+    """
+
+    def __init__(self):
+        self.__path = None
+        self.__sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__sender.setblocking(False)
+
+    @staticmethod
+    def directory():
+        path = conf["BUS_SOCKET_DIR"] or os.path.join(tempfile.gettempdir(), "htalk-bus")
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        return path
+
+    def start(self, bus):
+        self.__path = os.path.join(self.directory(), f"{os.getpid()}.sock")
+        if os.path.exists(self.__path):
+            os.unlink(self.__path)
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self.__path)
+        threading.Thread(target=self.__run, args=(bus, receiver), name="bus-socket", daemon=True).start()
+
+    @staticmethod
+    def __run(bus, receiver):
+        while True:
+            data = receiver.recv(4096)
+            try:
+                namespace, key, version = json.loads(data)
+                bus.receive(namespace, key, version)
+            except Exception:  # 接收线程不能退出, 格式错误的消息丢弃, 由缓存的 ttl 兜底
+                bus.app.logger.exception(f"Receive invalidation fail: {data[:256]!r}")
+
+    def send(self, namespace: str, key: str):
+        version = time.time_ns()
+        data = json.dumps([namespace, key, version]).encode("utf-8")
+        for path in glob.glob(os.path.join(self.directory(), "*.sock")):
+            if path == self.__path:
+                continue
+            try:
+                self.__sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:
+                metrics.inc("bus_drop_total")
+        return version
+
+
+class DatabaseTransport:
+    """
+    每个键在 cache_version 表中有一行, 发布时版本号加一, 每个进程一个线程每 BUS_POLL_INTERVAL 秒轮询
+    时间取数据库的时钟, 不受各节点时钟误差影响, 可以跨机器使用
+    """
+
+    def __init__(self):
+        self.__last = None
+
+    def start(self, bus):
+        threading.Thread(target=self.__run, args=(bus,), name="bus-database", daemon=True).start()
+
+    def __run(self, bus):
+        while True:
+            time.sleep(conf["BUS_POLL_INTERVAL"])
+            with bus.app.app_context():
+                try:
+                    self.poll(bus)
+                except Exception:  # 轮询线程不能退出, 下次轮询时重试
+                    db.session.rollback()
+                    bus.app.logger.exception("Poll cache version fail")
+                finally:
+                    db.session.remove()
+
+    def poll(self, bus):
+        """ 每次轮询一条按 update_time 索引的范围查询 """
+        if self.__last is None:  # 启动前的失效与本进程无关, 从当前位置开始
+            self.__last = db.session.execute(db.select(db.func.max(CacheVersion.update_time))).scalar()
+            if self.__last is None:
+                self.__last = db.session.execute(db.select(db.func.now())).scalar()
+            return
+
+        rows = db.session.execute(db.select(CacheVersion.namespace, CacheVersion.key,
+                                            CacheVersion.version, CacheVersion.update_time)
+                                  .where(CacheVersion.update_time >= self.__last - OVERLAP)).all()
+        for row in rows:
+            try:
+                bus.receive(row.namespace, row.key, row.version)
+            except Exception:  # 一条消息的回调出错不影响其他消息, 也不重复处理
+                bus.app.logger.exception(f"Receive invalidation {row.namespace}:{row.key} fail")
+            self.__last = max(self.__last, row.update_time)
+
+    @staticmethod
+    def send(namespace: str, key: str):
+        table = CacheVersion.__table__
+        where = (table.c.namespace == namespace) & (table.c.key == key)
+        update = table.update().where(where).values(version=table.c.version + 1, update_time=db.func.now())
+        if db.session.execute(update).rowcount == 0:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(table.insert().values(namespace=namespace, key=key, version=1,
+                                                             update_time=db.func.now()))
+            except IntegrityError:  # 其他进程同时插入
+                db.session.execute(update)
+        version = db.session.execute(db.select(table.c.version).where(where)).scalar()
+        db.session.commit()
+        return version
+
+
+TRANSPORT = {"local": LocalTransport, "socket": SocketTransport, "database": DatabaseTransport}
+
+
+class InvalidationBus:
+    """
+    缓存失效总线: 写操作提交后调用 publish, 所有进程中该 namespace 的缓存删除对应的键, key 为空时清空整个 namespace
+    本进程立即生效, 其他进程的延迟: socket 为毫秒级, database 不超过 BUS_POLL_INTERVAL 秒
+    每个键在本进程内有一个代数, 收到失效消息时加一, 缓存只保存加载前后代数不变的值
+    """
+
+    def __init__(self):
+        self.app = None
+        self.transport = None
+        self.__lock = threading.Lock()
+        self.__pid = None
+        self.__subscribers = {}  # namespace -> 回调列表
+        self.__generation = {}  # (namespace, key) -> 本进程收到的失效次数
+        self.__seen = {}  # (namespace, key) -> 最近一条消息的版本号, 用于忽略重复的消息
+
+    def init_app(self, app):
+        self.app = app
+        self.transport = TRANSPORT[conf["BUS_TRANSPORT"]]()
+        app.before_request(self.__start)
+
+    def __start(self):
+        """ 在 worker 进程处理第一个请求时开始接收其他进程的消息 """
+        if self.__pid == os.getpid():
+            return
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            self.transport.start(self)
+
+    def subscribe(self, namespace: str, callback):
+        """ callback(key) 在失效时调用, key 为空表示整个 namespace """
+        self.__subscribers.setdefault(namespace, []).append(callback)
+
+    def generation(self, namespace: str, key: str):
+        return self.__generation.get((namespace, key), 0) + self.__generation.get((namespace, ""), 0)
+
+    def publish(self, namespace: str, key=""):
+        """ 在写操作提交之后调用, 否则其他进程可能重新加载到旧数据 """
+        key = str(key)
+        version = self.transport.send(namespace, key)
+        metrics.inc("bus_publish_total")
+        self.receive(namespace, key, version)
+
+    def receive(self, namespace: str, key: str, version: int):
+        with self.__lock:
+            if self.__seen.get((namespace, key)) == version:
+                return
+            self.__seen[(namespace, key)] = version
+            self.__generation[(namespace, key)] = self.__generation.get((namespace, key), 0) + 1
+        metrics.inc("bus_receive_total")
+        for callback in self.__subscribers.get(namespace, []):
+            callback(key or None)
+
+
+bus = InvalidationBus()
+
+
+class VersionedCache:
+    """
+    进程内的 LRU 缓存, 通过 bus 在所有进程中失效, CACHE_TTL 是消息丢失时数据过期的上限
+    加载期间收到失效消息时, 加载到的值只返回给本次调用, 不写入缓存
+    """
+
+    def __init__(self, namespace: str, size=1024):
+        self.namespace = namespace
+        self.size = size
+        self.__lock = threading.Lock()
+        self.__data = OrderedDict()  # key -> (代数, 过期时间, 值)
+        bus.subscribe(namespace, self.discard)
+
+    def get(self, key, loader):
+        key = str(key)
+        generation = bus.generation(self.namespace, key)
+        now = time.monotonic()
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is not None and item[0] == generation and item[1] > now:
+                self.__data.move_to_end(key)
+                metrics.inc(f"cache_hit_total_{self.namespace}")
+                return item[2]
+
+        metrics.inc(f"cache_miss_total_{self.namespace}")
+        value = loader()
+        with self.__lock:
+            if bus.generation(self.namespace, key) == generation:
+                self.__data[key] = (generation, now + conf["CACHE_TTL"], value)
+                self.__data.move_to_end(key)
+                while len(self.__data) > self.size:
+                    self.__data.popitem(last=False)
+        return value
+
+    def invalidate(self, key=""):
+        bus.publish(self.namespace, key)
+
+    def discard(self, key):
+        with self.__lock:
+            if key is None:
+                self.__data.clear()
+            else:
+                self.__data.pop(key, None)
+
+
+cache_cli = AppGroup("cache", help="进程内缓存")
+
+
+@cache_cli.command("clear")
+@click.argument("namespace")
+@click.argument("key", default="")
+def clear_command(namespace, key):
+    """ 在所有进程中删除 NAMESPACE 的缓存, 指定 KEY 时只删除该键 """
+    bus.publish(namespace, key)
+    click.echo(f"Publish invalidation {namespace}:{key or '*'} via {conf['BUS_TRANSPORT']}")
@@ -1,13 +1,27 @@
 from flask import Blueprint, render_template, request, abort, flash, redirect, url_for
+import click
 from flask_wtf import FlaskForm
 from wtforms import TextAreaField, StringField, SelectMultipleField, SubmitField, ValidationError
 from wtforms.validators import DataRequired, Length
 from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime
 
 
-from .db import db, Comment, Archive, User, Role
+from .db import db, Comment, CommentVote, CommentHold, Archive, User, Role
 from .login import role_required
 from .logger import Logger
+from .render import render_page
+from .readmodel import list_comment_card, user_comment_card, archive_choices
+from .markup import render_markdown, RENDER_VERSION
+from .counter import views, scores
+from .ranking import ranking
+from .live import feed
+from .notify import notify_reply
+from .spam import check_comment, index_comment
+from .snapshot import snapshots, thread_version, archive_version, BUILDING
+
+from configure import conf
 
 
 comment = Blueprint("comment", __name__)
@@ -21,12 +35,8 @@ class WriteCommentForm(FlaskForm):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        archive = Archive.query.all()
-        self.archive_res = []
-        self.archive_choices = []
-        for i in archive:
-            self.archive_res.append(i.id)
-            self.archive_choices.append((i.id, f"{i.name} ({i.comment_count})"))
+        self.archive_choices = archive_choices()
+        self.archive_res = {i for i, _ in self.archive_choices}
         self.archive.choices = self.archive_choices
 
     def validate_archive(self, field):
@@ -42,12 +52,28 @@ def comment_page():
     if not comment_id:
         return abort(404)
 
-    cm: Comment = Comment.query.filter_by(id=comment_id).first()
+    snapshot = snapshots.serve("comment", str(comment_id), lambda: thread_version(comment_id))
+    if snapshot is not None:
+        Logger.print_load_page_log(f"comment {comment_id} snapshot")
+        views.view(comment_id, f"ip-{request.remote_addr}")
+        return snapshot
+
+    cm: Comment = (Comment.query
+                   .options(db.undefer_group("body"), db.joinedload(Comment.view))
+                   .filter_by(id=comment_id).first())
     if cm:
         Logger.print_load_page_log(f"comment {comment_id} page")
-        return render_template("comment/comment.html",
-                               comment=cm,
-                               comment_son=cm.son)
+        if not request.environ.get(BUILDING):
+            views.view(cm.id, f"user-{current_user.id}" if current_user.is_authenticated else f"ip-{request.remote_addr}")
+        comment_son = (cm.son
+                       .options(*Comment.card_options(), db.undefer_group("body"))
+                       .yield_per(conf["STREAM_YIELD_PER"]))
+        voted = (current_user.is_authenticated and
+                 CommentVote.query.filter_by(comment_id=cm.id, user_id=current_user.id).first() is not None)
+        return render_page("comment/comment.html",
+                           comment=cm,
+                           comment_son=comment_son,
+                           voted=voted)
     return abort(404)
 
 
@@ -56,38 +82,42 @@ def comment_page():
 def list_all_page():
     page = request.args.get("page", 1, type=int)
     archive_id = request.args.get("archive", None, type=int)
+    sort = request.args.get("sort", "new")
+    if sort not in ("new", "score", "hot"):
+        return abort(404)
 
     if not archive_id:
-        pagination = (Comment.query
-                      .filter(Comment.title != None).filter(Comment.father_id == None)
-                      .order_by(Comment.create_time.desc(), Comment.title.desc())
-                      .paginate(page=page, per_page=8, error_out=False))
+        pagination = list_comment_card(page, 8, sort=sort)
         Logger.print_load_page_log("list all comment")
-        return render_template("comment/list.html",
-                               page=page,
-                               archive=archive_id,
-                               items=pagination.items,
-                               pagination=pagination,
-                               archive_name="全部讨论",
-                               archive_describe="罗列了本站所有的讨论",
-                               title="主页")
+        return render_page("comment/list.html",
+                           page=page,
+                           sort=sort,
+                           archive=archive_id,
+                           items=pagination.items,
+                           pagination=pagination,
+                           archive_name="全部讨论",
+                           archive_describe="罗列了本站所有的讨论",
+                           title="主页")
     else:
+        if sort == "new":
+            snapshot = snapshots.serve("archive", f"{archive_id}-{page}", lambda: archive_version(archive_id, page))
+            if snapshot is not None:
+                Logger.print_load_page_log(f"list comment of archive {archive_id} snapshot")
+                return snapshot
         archive = Archive.query.filter_by(id=archive_id).first()
         if not archive:
             return abort(404)
-        pagination = (archive.comment
-                      .filter(Comment.title != None).filter(Comment.father_id == None)
-                      .order_by(Comment.create_time.desc(), Comment.title.asc())
-                      .paginate(page=page, per_page=8, error_out=False))
+        pagination = list_comment_card(page, 8, archive_id=archive.id, sort=sort)
         Logger.print_load_page_log(f"list comment of archive {archive_id}")
-        return render_template("comment/list.html",
-                               page=page,
-                               archive=archive_id,
-                               items=pagination.items,
-                               pagination=pagination,
-                               archive_name=archive.name,
-                               archive_describe=archive.describe,
-                               title=archive.name)
+        return render_page("comment/list.html",
+                           page=page,
+                           sort=sort,
+                           archive=archive_id,
+                           items=pagination.items,
+                           pagination=pagination,
+                           archive_name=archive.name,
+                           archive_describe=archive.describe,
+                           title=archive.name)
 
 
 @comment.route("/user")
@@ -102,16 +132,14 @@ def user_page():
     if not user:
         return abort(404)
 
-    pagination = (user.comment
-                  .order_by(Comment.create_time.desc(), Comment.title.asc())
-                  .paginate(page=page, per_page=8, error_out=False))
+    pagination = user_comment_card(user.id, page, 8)
     Logger.print_load_page_log(f"list comment of user {user_id}")
-    return render_template("comment/user.html",
-                           page=page,
-                           user=user,
-                           items=pagination.items,
-                           pagination=pagination,
-                           title=user.email)
+    return render_page("comment/user.html",
+                       page=page,
+                       user=user,
+                       items=pagination.items,
+                       pagination=pagination,
+                       title=user.email)
 
 
 @comment.route("/create", methods=["GET", "POST"])
@@ -136,11 +164,133 @@ def create_page():
             if not archive:
                 return abort(404)
             archive_list.append(archive)
+
+        signature, action, match_id, similarity = check_comment(form.content.data, current_user.id)
+        if action == "reject":
+            flash("讨论与已有讨论过于相似")
+            Logger.print_user_not_allow_opt_log(f"create comment (similar to {match_id})")
+            return render_template("comment/create.html", form=form, father=father)
+        if action == "hold":
+            db.session.add(CommentHold(title=title, content=form.content.data, father_id=father_id,
+                                       archive=",".join(str(i.id) for i in archive_list), auth=current_user,
+                                       match_id=match_id, similarity=similarity))
+            db.session.commit()
+            flash("讨论与已有讨论高度相似, 需要管理员审核后发布")
+            Logger.print_user_opt_success_log(f"hold comment (similar to {match_id})")
+            if father:
+                return redirect(url_for("comment.comment_page", comment=father.id))
+            return redirect(url_for("comment.list_all_page"))
+
         cm = Comment(title=title, content=form.content.data, father=father, archive=archive_list, auth=current_user)
         db.session.add(cm)
+        ranking.add(cm)
+        notify_reply(cm, father)
+        if signature is not None:
+            db.session.flush()
+            index_comment(cm.id, current_user.id, signature)
         db.session.commit()
+        feed.publish(cm)
         flash("讨论发表成功")
         Logger.print_user_opt_success_log(f"create comment {cm.id}")
         return redirect(url_for("comment.comment_page", comment=cm.id))
     Logger.print_load_page_log("create comment page")
     return render_template("comment/create.html", form=form, father=father)
+
+
+@comment.route("/vote")
+@login_required
+@role_required(Role.CREATE_COMMENT, "vote comment")
+def vote_page():
+    comment_id = request.args.get("comment", None, type=int)
+    if not comment_id or not Comment.query.filter_by(id=comment_id).first():
+        return abort(404)
+
+    try:
+        db.session.add(CommentVote(comment_id=comment_id, user_id=current_user.id))
+        Comment.query.filter_by(id=comment_id).update({"vote_time": datetime.utcnow()})
+        db.session.commit()
+    except IntegrityError:  # 已经点赞过, 重复请求不改变评分
+        db.session.rollback()
+    else:
+        scores.add(comment_id, 1)
+        Logger.print_user_opt_success_log(f"vote comment {comment_id}")
+    flash("点赞成功")
+    return redirect(url_for("comment.comment_page", comment=comment_id))
+
+
+@comment.route("/unvote")
+@login_required
+@role_required(Role.CREATE_COMMENT, "unvote comment")
+def unvote_page():
+    comment_id = request.args.get("comment", None, type=int)
+    if not comment_id:
+        return abort(404)
+
+    count = CommentVote.query.filter_by(comment_id=comment_id, user_id=current_user.id).delete()
+    if count > 0:  # 取消点赞不留下点赞记录, 通过 vote_time 让重新计算评分时跳过
+        Comment.query.filter_by(id=comment_id).update({"vote_time": datetime.utcnow()})
+    db.session.commit()
+    if count > 0:
+        scores.add(comment_id, -1)
+        Logger.print_user_opt_success_log(f"unvote comment {comment_id}")
+    flash("取消点赞成功")
+    return redirect(url_for("comment.comment_page", comment=comment_id))
+
+
+def update_in_chunks(where, names, values, chunk: int):
+    """ 按 ID 顺序分批读取 content, 使用 values(content) 计算 names 列的新值并更新, 每批一个事务 """
+    table = Comment.__table__
+    update = (table.update()
+              .where(table.c.id == db.bindparam("_id"))
+              .values({i: db.bindparam(f"_{i}") for i in names}))
+
+    last_id = 0
+    count = 0
+    while True:
+        rows = db.session.execute(db.select(table.c.id, table.c.content)
+                                  .where(where).where(table.c.id > last_id)
+                                  .order_by(table.c.id).limit(chunk)).all()
+        if not rows:
+            break
+        db.session.execute(update, [{"_id": i.id, **{f"_{k}": v for k, v in values(i.content).items()}}
+                                    for i in rows])
+        db.session.commit()
+        last_id = rows[-1].id
+        count += len(rows)
+        click.echo(f"Update {count} comments (id <= {last_id})")
+
+
+@comment.cli.command("backfill-excerpt")
+@click.option("--chunk", default=1000, help="每批处理的讨论个数")
+def backfill_excerpt(chunk):
+    """ 为旧讨论分批生成摘要 """
+    update_in_chunks(Comment.__table__.c.excerpt == None, ["excerpt", "content_length"],
+                     lambda content: {"excerpt": Comment.make_excerpt(content), "content_length": len(content)},
+                     chunk)
+
+
+@comment.cli.command("rerender")
+@click.option("--chunk", default=500, help="每批处理的讨论个数")
+def rerender(chunk):
+    """ 使用当前版本的渲染器重新渲染旧讨论的 html """
+    version = Comment.__table__.c.render_version
+    update_in_chunks(db.or_(version == None, version < RENDER_VERSION), ["content_html", "render_version"],
+                     lambda content: {"content_html": render_markdown(content), "render_version": RENDER_VERSION},
+                     chunk)
+
+
+@comment.cli.command("refresh-hot")
+@click.option("--full", is_flag=True, help="重新计算所有主题讨论")
+@click.option("--chunk", default=500, help="每批处理的讨论个数")
+def refresh_hot(full, chunk):
+    """ 刷新热度排行, 可以在关闭后台刷新时由定时任务调用 """
+    count = ranking.refresh(full=full, chunk=chunk)
+    click.echo(f"Refresh {count} comments")
+
+
+@comment.cli.command("reconcile-score")
+@click.option("--chunk", default=1000, help="每批处理的讨论个数")
+def reconcile_score(chunk):
+    """ 按点赞记录重新计算讨论评分, 可以由定时任务调用 """
+    checked, fixed = scores.reconcile(chunk)
+    click.echo(f"Check {checked} comments, fix {fixed} scores")
@@ -0,0 +1,153 @@
+import time
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+from configure import conf
+from .metrics import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# 各算法允许的最高压缩等级, 超过后吞吐量下降明显而压缩率提升有限
+MAX_LEVEL = {"gzip": 6, "br": 5, "zstd": 9}
+
+
+class GzipCompressor:
+    def __init__(self, level: int):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level: int):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level: int):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes):
+        return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+COMPRESSOR = {"gzip": GzipCompressor}
+if brotli is not None:
+    COMPRESSOR["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSOR["zstd"] = ZstdCompressor
+
+
+class CompressResponse:
+    """ 逐块压缩响应体, 每块都会 flush 以保证流式响应能及时发送 """
+
+    def __init__(self, app_iter, encoding: str, compressor):
+        self.app_iter = app_iter
+        self.encoding = encoding
+        self.compressor = compressor
+        self.cpu_time = 0
+        self.size_in = 0
+        self.size_out = 0
+
+    def compress(self, data: bytes, finish=False):
+        start = time.thread_time()
+        res = self.compressor.compress(data) if data else b""
+        if finish:
+            res += self.compressor.finish()
+        self.cpu_time += time.thread_time() - start
+        self.size_in += len(data)
+        self.size_out += len(res)
+        return res
+
+    def __iter__(self):
+        for data in self.app_iter:
+            res = self.compress(data)
+            if res:
+                yield res
+        yield self.compress(b"", finish=True)
+
+    def close(self):
+        if hasattr(self.app_iter, "close"):
+            self.app_iter.close()
+        metrics.inc(f"compress_response_total_{self.encoding}")
+        metrics.inc(f"compress_cpu_seconds_{self.encoding}", self.cpu_time)
+        metrics.inc(f"compress_bytes_in_{self.encoding}", self.size_in)
+        metrics.inc(f"compress_bytes_out_{self.encoding}", self.size_out)
+
+
+class CompressMiddleware:
+    """ 响应压缩中间件, 根据 Accept-Encoding 选择 br/zstd/gzip """
+
+    def __init__(self, app):
+        self.app = app
+        self.min_size = conf["COMPRESS_MIN_SIZE"]
+        self.mimetype = set(conf["COMPRESS_MIMETYPE"])
+        self.encoding = [i for i in conf["COMPRESS_ENCODING"] if i in COMPRESSOR]
+        self.level = {i: max(1, min(conf["COMPRESS_LEVEL"].get(i, MAX_LEVEL[i]), MAX_LEVEL[i]))
+                      for i in self.encoding}
+
+    def select_encoding(self, environ):
+        accept = parse_accept_header(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        for i in self.encoding:  # 按配置的优先顺序选择
+            if accept[i]:
+                return i
+        return None
+
+    def should_compress(self, environ, status: str, headers: Headers):
+        if environ["REQUEST_METHOD"] == "HEAD" or status[:3] in ("204", "206", "304") or status.startswith("1"):
+            return False
+        if "Content-Encoding" in headers or "no-transform" in headers.get("Cache-Control", ""):
+            return False
+        if headers.get("Content-Type", "").split(";")[0].strip() not in self.mimetype:
+            return False
+        length = headers.get("Content-Length", None, type=int)
+        return length is None or length >= self.min_size  # 没有长度的流式响应总是压缩
+
+    def __call__(self, environ, start_response):
+        encoding = self.select_encoding(environ)
+        compress = []
+
+        def new_start_response(status, response_headers, exc_info=None):
+            headers = Headers(response_headers)
+            if headers.get("Content-Type", "").split(";")[0].strip() in self.mimetype:
+                vary = [i.strip() for i in headers.get("Vary", "").split(",") if i.strip()]
+                if "accept-encoding" not in [i.lower() for i in vary]:
+                    headers["Vary"] = ", ".join(vary + ["Accept-Encoding"])
+
+            if encoding and self.should_compress(environ, status, headers):
+                headers.remove("Content-Length")
+                headers["Content-Encoding"] = encoding
+                etag = headers.get("ETag", None)
+                if etag and not etag.startswith("W/"):  # 压缩后的内容不再逐字节相同
+                    headers["ETag"] = "W/" + etag
+                compress.append(encoding)
+            return start_response(status, headers.to_wsgi_list(), exc_info)
+
+        app_iter = self.app(environ, new_start_response)
+        if not compress:
+            return app_iter
+        return CompressResponse(app_iter, encoding, COMPRESSOR[encoding](self.level[encoding]))
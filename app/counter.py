@@ -0,0 +1,179 @@
+import atexit
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .db import db, Comment, CommentVote, CommentView
+from .sketch import HyperLogLog
+
+from configure import conf
+
+
+class WriteBehind(ABC):
+    """
+    在 worker 内存中合并写操作, 由后台线程定期批量写入数据库
+    进程退出时会再写入一次, 写入失败的数据会合并回内存等待下次写入
+    子类需要实现 merge 和 write
+    """
+    name = "write-behind"
+
+    def __init__(self):
+        self.app = None
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__pid = None
+
+    def init_app(self, app):
+        self.app = app
+        atexit.register(self.flush)
+
+    def __start(self):
+        """ 在 worker 进程内第一次写入时启动刷新线程 (gunicorn 会在 fork 后调用) """
+        if self.__pid == os.getpid():
+            return
+        self.__pid = os.getpid()
+        threading.Thread(target=self.__run, name=self.name, daemon=True).start()
+
+    def __run(self):
+        while True:
+            time.sleep(conf["WRITE_BEHIND_INTERVAL"])
+            self.flush()
+
+    def add(self, key, value):
+        with self.__lock:
+            self.__start()
+            self.__pending[key] = self.merge(self.__pending.get(key), value)
+
+    def flush(self):
+        if self.app is None:  # init_app 之前记录的数据保留在内存中
+            return
+        with self.__lock:
+            pending, self.__pending = self.__pending, {}
+        if not pending:
+            return
+
+        with self.app.app_context():
+            try:
+                self.write(dict(pending))
+                db.session.commit()
+            except SQLAlchemyError:
+                db.session.rollback()
+                with self.__lock:
+                    for key, value in pending.items():
+                        self.__pending[key] = self.merge(self.__pending.get(key), value)
+                self.app.logger.exception(f"Flush {self.name} fail")
+            finally:
+                db.session.remove()
+
+    @abstractmethod
+    def merge(self, old, new):
+        """ 合并同一个 key 的两次写入, old 可能为 None """
+
+    @abstractmethod
+    def write(self, pending: dict):
+        """ 在 flush 的事务中写入合并后的数据, 由 flush 提交 """
+
+
+class ViewCounter(WriteBehind):
+    """ 讨论浏览计数: comment_id -> (浏览次数, 访客 HyperLogLog) """
+    name = "view-counter"
+
+    def view(self, comment_id: int, viewer: str):
+        if conf["VIEW_COUNTER"]:
+            self.add(comment_id, (1, viewer))
+
+    def merge(self, old, new):
+        """ new 的访客可以是单个访客或 HyperLogLog """
+        count, hll = old if old is not None else (0, HyperLogLog())
+        if isinstance(new[1], str):
+            hll.add(new[1])
+        else:
+            hll.merge(new[1])
+        return count + new[0], hll
+
+    def write(self, pending: dict):
+        table = CommentView.__table__
+        rows = db.session.execute(db.select(table)
+                                  .where(table.c.comment_id.in_(list(pending)))
+                                  .with_for_update()).all()  # 锁定行, 避免多个 worker 同时合并 sketch
+
+        now = datetime.utcnow()
+        update = []
+        for row in rows:
+            count, hll = pending.pop(row.comment_id)
+            hll.merge(HyperLogLog(row.sketch))
+            update.append({"_id": row.comment_id, "_views": count, "_visitors": hll.count(), "_sketch": hll.to_bytes()})
+
+        if update:
+            db.session.execute(table.update()
+                               .where(table.c.comment_id == db.bindparam("_id"))
+                               .values(views=table.c.views + db.bindparam("_views"),
+                                       visitors=db.bindparam("_visitors"),
+                                       sketch=db.bindparam("_sketch"),
+                                       update_time=now),
+                               update)
+        if pending:  # 新出现的讨论, 跳过已被删除的讨论, 与其他 worker 冲突时整体回滚后重试
+            exist = set(db.session.execute(db.select(Comment.id).where(Comment.id.in_(list(pending)))).scalars())
+            pending = {i: v for i, v in pending.items() if i in exist}
+        if pending:
+            db.session.execute(table.insert(),
+                               [{"comment_id": i, "views": count, "visitors": hll.count(), "sketch": hll.to_bytes(),
+                                 "update_time": now}
+                                for i, (count, hll) in pending.items()])
+
+
+class ScoreCounter(WriteBehind):
+    """ 讨论评分增量: comment_id -> delta, 合并后批量更新, 避免热门讨论的行锁竞争 """
+    name = "score-counter"
+
+    def merge(self, old, new):
+        return (old or 0) + new
+
+    def write(self, pending: dict):
+        table = Comment.__table__
+        update = [{"_id": i, "_delta": delta} for i, delta in pending.items() if delta != 0]
+        if update:
+            db.session.execute(table.update()
+                               .where(table.c.id == db.bindparam("_id"))
+                               .values(score=table.c.score + db.bindparam("_delta")),
+                               update)
+
+    @staticmethod
+    def reconcile(chunk: int):
+        """
+        按 comment_vote 分批重新计算评分 (导入的 score_base 加点赞个数), 修正 worker 异常退出时丢失的增量
+        最近两个写入间隔内点赞或取消点赞过的讨论跳过, 其增量可能仍在 worker 内存中, 返回 (检查个数, 修正个数)
+        """
+        table = Comment.__table__
+        recent = datetime.utcnow() - timedelta(seconds=2 * conf["WRITE_BEHIND_INTERVAL"])
+        last_id = 0
+        checked = fixed = 0
+        while True:
+            rows = db.session.execute(db.select(table.c.id, table.c.score, table.c.score_base, table.c.vote_time,
+                                                db.func.count(CommentVote.user_id).label("votes"))
+                                      .outerjoin(CommentVote, CommentVote.comment_id == table.c.id)
+                                      .where(table.c.id > last_id)
+                                      .group_by(table.c.id)
+                                      .order_by(table.c.id).limit(chunk)).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            checked += len(rows)
+            update = [{"_id": i.id, "_score": i.score_base + i.votes} for i in rows
+                      if i.score != i.score_base + i.votes and (i.vote_time is None or i.vote_time < recent)]
+            if update:
+                db.session.execute(table.update()
+                                   .where(table.c.id == db.bindparam("_id"))
+                                   .values(score=db.bindparam("_score")),
+                                   update)
+            db.session.commit()
+            fixed += len(update)
+        return checked, fixed
+
+
+views = ViewCounter()
+scores = ScoreCounter()
@@ -4,9 +4,10 @@ from flask_login import UserMixin, AnonymousUserMixin
 from datetime import datetime
 from itsdangerous import URLSafeTimedSerializer as Serializer
 from itsdangerous.exc import BadData
-from werkzeug.security import generate_password_hash, check_password_hash
 
 from configure import conf
+from .markup import render_markdown, RENDER_VERSION
+from .passwd import hasher
 
 db = SQLAlchemy()
 
@@ -25,9 +26,13 @@ class AnonymousUser(AnonymousUserMixin):
     def email(self):
         return None
 
+    def in_followed(self, user):
+        return False
+
     @property
     def role(self):
-        anonymous = Role.query.filter_by(name="anonymous").first()
+        from .readmodel import cached_role
+        anonymous = cached_role(name="anonymous")
         if not anonymous:
             return abort(500)
         return anonymous
@@ -35,6 +40,7 @@ class AnonymousUser(AnonymousUserMixin):
 
 class User(db.Model, UserMixin):
     __tablename__ = "user"
+    __table_args__ = (db.Index("ix_user_role_id_email", "role_id", "email"),)  # 按角色筛选后按邮箱前缀搜索
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
     email = db.Column(db.String(32), nullable=False, unique=True)
@@ -60,6 +66,10 @@ class User(db.Model, UserMixin):
     def followed_count(self):
         return self.followed.count()
 
+    @property
+    def unread_notification_count(self):
+        return Notification.query.filter_by(user_id=self.id, read=False).count()
+
     def in_followed(self, user):
         user_id = user.id
         if Follow.query.filter_by(followed_id=user_id, follower_id=self.id).first():
@@ -70,14 +80,15 @@ class User(db.Model, UserMixin):
     @staticmethod
     def register_creat_token(email: str, passwd_hash: str):
         s = Serializer(conf["SECRET_KEY"])
-        return s.dumps({"email": email, "passwd_hash": passwd_hash})
+        return s.dumps({"email": email, "passwd_hash": passwd_hash, "hashed": True})
 
     @staticmethod
     def register_load_token(token: str):
+        """ 返回 (邮箱, 密码哈希, 是否已哈希), 没有 hashed 字段的旧链接中是明文密码 """
         s = Serializer(conf["SECRET_KEY"])
         try:
             token = s.loads(token, max_age=3600)
-            return token['email'], token['passwd_hash']
+            return token['email'], token['passwd_hash'], token.get('hashed', False)
         except (BadData, KeyError):
             return None
 
@@ -96,10 +107,15 @@ class User(db.Model, UserMixin):
 
     @staticmethod
     def get_passwd_hash(passwd: str):
-        return generate_password_hash(passwd)
+        return hasher.hash(passwd)
 
     def check_passwd(self, passwd: str):
-        return check_password_hash(self.passwd_hash, passwd)
+        """ 验证成功且哈希参数已过时时重新计算哈希, 由调用者提交 """
+        if not hasher.check(self.passwd_hash, passwd):
+            return False
+        if hasher.needs_rehash(self.passwd_hash):
+            self.passwd_hash = hasher.hash(passwd)
+        return True
 
     @property
     def passwd(self):
@@ -150,11 +166,20 @@ ArchiveComment = db.Table("archive_comment",
 
 class Comment(db.Model):
     __tablename__ = "comment"
+    __table_args__ = (db.Index("ix_comment_father_id_score", "father_id", "score"),)  # 按评分排序讨论
+    EXCERPT_LENGTH = 100
 
     id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
     title = db.Column(db.String(32), nullable=True)  # 允许为空
-    content = db.Column(db.Text, nullable=False)
-    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    content = db.deferred(db.Column(db.Text, nullable=False), group="body")  # markdown 源码, 只在讨论页加载
+    content_html = db.deferred(db.Column(db.Text, nullable=True), group="body")  # 写入时渲染并过滤的 html
+    render_version = db.Column(db.Integer, nullable=True)
+    excerpt = db.Column(db.String(128), nullable=True)  # 列表页使用的摘要
+    content_length = db.Column(db.Integer, nullable=True)
+    score = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # 点赞数, 由 ScoreCounter 批量更新
+    score_base = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # 导入的评分, 没有对应的点赞记录
+    vote_time = db.Column(db.DateTime, nullable=True)  # 最近一次点赞或取消点赞的时间
+    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
     update_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     auth_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     father_id = db.Column(db.Integer, db.ForeignKey("comment.id"))
@@ -164,12 +189,133 @@ class Comment(db.Model):
     son = db.relationship("Comment", foreign_keys="[Comment.father_id]", remote_side="[Comment.father_id]",
                           back_populates="father", lazy="dynamic")
     archive = db.relationship("Archive", back_populates="comment", secondary="archive_comment")
+    view = db.relationship("CommentView", uselist=False)
+    son_count_cache = db.query_expression()  # 通过 card_options 随查询一同加载的子讨论个数
 
+    @staticmethod
+    def make_excerpt(content: str):
+        if len(content) > Comment.EXCERPT_LENGTH:
+            return content[:Comment.EXCERPT_LENGTH] + "……"
+        return content
+
+    @db.validates("content")
+    def validate_content(self, _, content):
+        """ 写入内容时同时生成摘要和 html """
+        self.excerpt = self.make_excerpt(content)
+        self.content_length = len(content)
+        self.content_html = render_markdown(content)
+        self.render_version = RENDER_VERSION
+        return content
 
     @property
     def son_count(self):
+        if self.son_count_cache is not None:
+            return self.son_count_cache
         return self.son.count()
 
+    @property
+    def view_count(self):
+        return self.view.views if self.view else 0
+
+    @staticmethod
+    def card_options():
+        """ 查询选项: 一次性加载子讨论个数、作者和浏览数, 避免模板中逐行查询 """
+        son = db.aliased(Comment)
+        count = (db.select(db.func.count(son.id))
+                 .where(son.father_id == Comment.id)
+                 .correlate_except(son)
+                 .scalar_subquery())
+        return (db.with_expression(Comment.son_count_cache, count),
+                db.joinedload(Comment.auth),
+                db.joinedload(Comment.view))
+
+
+class CommentVote(db.Model):
+    """ 每个用户对每个讨论只能点赞一次 """
+    __tablename__ = "comment_vote"
+
+    comment_id = db.Column(db.Integer, db.ForeignKey("comment.id"), primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True, nullable=False)
+    time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class CommentView(db.Model):
+    """ 浏览计数, 由 ViewCounter 批量写入 """
+    __tablename__ = "comment_view"
+
+    comment_id = db.Column(db.Integer, db.ForeignKey("comment.id"), primary_key=True, nullable=False)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    visitors = db.Column(db.Integer, nullable=False, default=0)  # 由 sketch 估计的访客数
+    sketch = db.Column(db.LargeBinary(1024), nullable=True)  # HyperLogLog 寄存器
+    update_time = db.Column(db.DateTime, nullable=True, index=True)  # 最近一次写入, 用于增量刷新热度
+
+
+class CommentRank(db.Model):
+    """ 主题讨论的热度排行, 由 HotRanking 在后台增量刷新 """
+    __tablename__ = "comment_rank"
+
+    comment_id = db.Column(db.Integer, db.ForeignKey("comment.id"), primary_key=True, nullable=False)
+    hot = db.Column(db.Float, nullable=False, index=True)
+    replies = db.Column(db.Integer, nullable=False, default=0)
+    score = db.Column(db.Integer, nullable=False, default=0)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    active_time = db.Column(db.DateTime, nullable=False)  # 最近一次回复的时间, 没有回复时为创建时间
+    refresh_time = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class CommentMinHash(db.Model):
+    """ 讨论内容的 MinHash 签名, 用于检测近似重复的讨论 """
+    __tablename__ = "comment_minhash"
+
+    comment_id = db.Column(db.Integer, db.ForeignKey("comment.id"), primary_key=True, nullable=False)
+    signature = db.Column(db.LargeBinary(512), nullable=False)
+
+
+class CommentBand(db.Model):
+    """ MinHash 签名的 LSH 索引, 每个讨论每个带一行 """
+    __tablename__ = "comment_band"
+
+    band = db.Column(db.SmallInteger, primary_key=True, nullable=False, autoincrement=False)
+    bucket = db.Column(db.BigInteger, primary_key=True, nullable=False, autoincrement=False)
+    comment_id = db.Column(db.Integer, db.ForeignKey("comment.id"), primary_key=True, nullable=False, index=True)
+
+
+class CommentHold(db.Model):
+    """ 与已有讨论高度相似而被暂扣的讨论, 由管理员通过后才会发布 """
+    __tablename__ = "comment_hold"
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    title = db.Column(db.String(32), nullable=True)
+    content = db.Column(db.Text, nullable=False)
+    father_id = db.Column(db.Integer, db.ForeignKey("comment.id"), nullable=True)
+    archive = db.Column(db.String(256), nullable=False, default="")  # 逗号分隔的归档 id
+    auth_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    match_id = db.Column(db.Integer, db.ForeignKey("comment.id"), nullable=False)  # 最相似的已有讨论
+    similarity = db.Column(db.Float, nullable=False)
+    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    auth = db.relationship("User")
+    match = db.relationship("Comment", foreign_keys="[CommentHold.match_id]")
+
+
+class Notification(db.Model):
+    """ 站内通知, 每个事件一条, 邮件由 DigestMailer 按接收者合并发送 """
+    __tablename__ = "notification"
+    __table_args__ = (db.Index("ix_notification_user_id_read", "user_id", "read"),)
+    REPLY = "reply"
+    FOLLOW = "follow"
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)  # 接收者
+    kind = db.Column(db.String(16), nullable=False)
+    actor_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)  # 回复或关注的用户
+    comment_id = db.Column(db.Integer, db.ForeignKey("comment.id"), nullable=True)  # 被回复的讨论
+    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    read = db.Column(db.Boolean, nullable=False, default=False, server_default="0")
+    digest = db.Column(db.String(32), nullable=True, index=True)  # 领取该通知发送邮件的批次
+    claim_time = db.Column(db.DateTime, nullable=True, index=True)  # 领取时间, 发送成功后清空
+    actor = db.relationship("User", foreign_keys="[Notification.actor_id]")
+    comment = db.relationship("Comment")
+
 
 class Archive(db.Model):
     __tablename__ = "archive"
@@ -178,11 +324,96 @@ class Archive(db.Model):
     name = db.Column(db.String(32), nullable=False, unique=True)
     describe = db.Column(db.String(100), nullable=False)
     comment = db.relationship("Comment", back_populates="archive", secondary="archive_comment", lazy="dynamic")
+    comment_count_cache = db.query_expression()  # 通过 card_options 随查询一同加载的主题个数
 
     @property
     def comment_count(self):
+        if self.comment_count_cache is not None:
+            return self.comment_count_cache
         return self.comment.filter(Comment.title != None).filter(Comment.father_id == None).count()
 
+    @staticmethod
+    def card_options():
+        """ 查询选项: 一次性加载每个归档的主题个数 """
+        count = (db.select(db.func.count(Comment.id))
+                 .join(ArchiveComment, ArchiveComment.c.comment_id == Comment.id)
+                 .where(ArchiveComment.c.archive_id == Archive.id)
+                 .where(Comment.title != None).where(Comment.father_id == None)
+                 .correlate(Archive)
+                 .scalar_subquery())
+        return (db.with_expression(Archive.comment_count_cache, count),)
+
+
+class ImportMap(db.Model):
+    """ 批量导入时旧 id 到新 id 的映射, 同时用于跳过重复导入的行 """
+    __tablename__ = "import_map"
+
+    kind = db.Column(db.String(16), primary_key=True, nullable=False)
+    old_id = db.Column(db.BigInteger, primary_key=True, nullable=False, autoincrement=False)
+    new_id = db.Column(db.Integer, nullable=False)
+
+
+class ModerationJob(db.Model):
+    """ 批量管理任务, 每批处理后在同一事务中更新 cursor, 中断后从 cursor 继续 """
+    __tablename__ = "moderation_job"
+    BLOCK = "block"
+    ROLE = "role"
+    PURGE = "purge"
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    kind = db.Column(db.String(16), nullable=False)
+    params = db.Column(db.Text, nullable=False)  # json: user_ids, emails, role_filter, prefix, role
+    state = db.Column(db.String(16), nullable=False, default=PENDING, index=True)
+    cursor = db.Column(db.Integer, nullable=False, default=0)  # 已处理的最大用户或讨论 id
+    total = db.Column(db.Integer, nullable=True)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    message = db.Column(db.String(256), nullable=True)
+    lease_time = db.Column(db.DateTime, nullable=True)  # 处理该任务的 worker 的租约到期时间
+    auth_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)  # 通过命令行创建时为空
+    create_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    update_time = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    auth = db.relationship("User")
+
+
+class AuditLog(db.Model):
+    """ 系统操作的审计日志, 只追加, 由 AuditBuffer 批量写入 """
+    __tablename__ = "audit_log"
+    __table_args__ = (db.Index("ix_audit_log_actor_id_time", "actor_id", "time"),
+                      db.Index("ix_audit_log_target_time", "target_type", "target_id", "time"))
+
+    id = db.Column(db.Integer, autoincrement=True, primary_key=True, nullable=False)
+    time = db.Column(db.DateTime, nullable=False, index=True)
+    actor_id = db.Column(db.Integer, nullable=True)  # 不设外键, 用户删除后仍保留记录, 命令行操作为空
+    action = db.Column(db.String(32), nullable=False)
+    target_type = db.Column(db.String(16), nullable=True)
+    target_id = db.Column(db.Integer, nullable=True)
+    ip = db.Column(db.String(64), nullable=True)
+    detail = db.Column(db.String(256), nullable=True)
+
+
+class CacheVersion(db.Model):
+    """ 缓存失效总线的 database 传输, 每个键一行, 各进程轮询 update_time 得到其他进程发布的失效 """
+    __tablename__ = "cache_version"
+
+    namespace = db.Column(db.String(32), primary_key=True, nullable=False)
+    key = db.Column(db.String(64), primary_key=True, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    update_time = db.Column(db.DateTime, nullable=False, index=True)  # 数据库时钟
+
+
+class TaskLease(db.Model):
+    """ 周期性后台任务的租约, 所有节点的 worker 中只有持有租约的一个执行 """
+    __tablename__ = "task_lease"
+
+    name = db.Column(db.String(32), primary_key=True, nullable=False)
+    owner = db.Column(db.String(64), nullable=True)  # 主机名:进程号
+    lease_time = db.Column(db.DateTime, nullable=True)  # 租约到期时间
+
 
 def create_all():
     try:
@@ -205,9 +436,10 @@ def create_faker_user():
     from sqlalchemy.exc import IntegrityError
     fake = Faker("zh_CN")
 
+    passwd_hash = User.get_passwd_hash("passwd")
     count_user = 0
     while count_user < 100:
-        user = User(email=fake.email(), passwd_hash=User.get_passwd_hash("passwd"), role_id=3)
+        user = User(email=fake.email(), passwd_hash=passwd_hash, role_id=3)
         db.session.add(user)
 
         try:
@@ -0,0 +1,109 @@
+import csv
+import io
+import zlib
+from datetime import datetime
+
+import click
+from flask import Blueprint, Response, request, abort, stream_with_context
+from flask_login import login_required
+
+from .db import db, Comment, User, Role, ArchiveComment
+from .login import role_required
+from .logger import Logger
+from .api import dumps
+from .audit import audit_log
+
+from configure import conf
+
+
+export = Blueprint("export", __name__)
+
+FIELDS = ("id", "title", "content", "create_time", "update_time", "father_id", "auth_id", "auth_email", "score")
+FORMAT = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+def export_select(archive_id=None, user_id=None, after=None):
+    """ 按 id 升序导出, 中断后以最后一条的 id 作为 after 继续 """
+    stmt = (db.select(Comment.id, Comment.title, Comment.content, Comment.create_time, Comment.update_time,
+                      Comment.father_id, Comment.auth_id, User.email.label("auth_email"), Comment.score)
+            .join(User, User.id == Comment.auth_id)
+            .order_by(Comment.id.asc()))
+    if archive_id:
+        stmt = (stmt.join(ArchiveComment, ArchiveComment.c.comment_id == Comment.id)
+                .where(ArchiveComment.c.archive_id == archive_id))
+    if user_id:
+        stmt = stmt.where(Comment.auth_id == user_id)
+    if after:
+        stmt = stmt.where(Comment.id > after)
+    return stmt
+
+
+def iter_ndjson(partitions):
+    for rows in partitions:
+        yield b"".join(dumps(dict(zip(FIELDS, row))) + b"\n" for row in rows)
+
+
+def iter_csv(partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for rows in partitions:
+        writer.writerows((i.isoformat() if isinstance(i, datetime) else i for i in row) for row in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():  # 没有任何数据时只输出表头
+        yield buffer.getvalue().encode("utf-8")
+
+
+def iter_gzip(chunks):
+    compressor = zlib.compressobj(conf["COMPRESS_LEVEL"]["gzip"], zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_comment(stmt, fmt: str, gzip: bool):
+    """ 使用服务端游标每次读取 EXPORT_YIELD_PER 行, 内存占用与导出的行数无关 """
+    result = db.session.execute(stmt.execution_options(stream_results=True, yield_per=conf["EXPORT_YIELD_PER"]))
+    chunks = (iter_ndjson if fmt == "ndjson" else iter_csv)(result.partitions())
+    return iter_gzip(chunks) if gzip else chunks
+
+
+@export.route("/comment")
+@login_required
+@role_required(Role.SYSTEM, "export comment")
+def comment_page():
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in FORMAT:
+        return abort(400)
+    archive_id = request.args.get("archive", None, type=int)
+    user_id = request.args.get("user", None, type=int)
+    after = request.args.get("after", None, type=int)
+    gzip = request.args.get("gzip", 0, type=int) == 1
+
+    name = "comment" + (f"-archive{archive_id}" if archive_id else "") + (f"-user{user_id}" if user_id else "")
+    name += f"-after{after}" if after else ""
+    name += f".{fmt}" + (".gz" if gzip else "")
+    audit_log.record("export", detail=name)
+    Logger.print_user_opt_success_log(f"export {name}")
+    chunks = export_comment(export_select(archive_id, user_id, after), fmt, gzip)
+    return Response(stream_with_context(chunks),  # 流式输出时保持请求上下文, 数据库会话在导出结束后才关闭
+                    mimetype="application/gzip" if gzip else FORMAT[fmt],
+                    headers={"Content-Disposition": f"attachment; filename={name}"})
+
+
+@export.cli.command("comment")
+@click.option("--archive", "archive_id", default=None, type=int, help="只导出该归档的讨论")
+@click.option("--user", "user_id", default=None, type=int, help="只导出该用户的讨论")
+@click.option("--after", default=None, type=int, help="从该 id 之后继续导出")
+@click.option("--format", "fmt", default="ndjson", type=click.Choice(list(FORMAT)), help="导出格式")
+@click.option("--gzip", is_flag=True, help="使用 gzip 压缩")
+@click.option("--output", default="-", type=click.File("wb"), help="输出文件, 默认为标准输出")
+def export_comment_command(archive_id, user_id, after, fmt, gzip, output):
+    """ 导出讨论, 不指定归档和用户时导出全站讨论 """
+    for chunk in export_comment(export_select(archive_id, user_id, after), fmt, gzip):
+        output.write(chunk)
+    output.flush()
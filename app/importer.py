@@ -0,0 +1,308 @@
+import itertools
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+
+from .db import db, User, Role, Archive, Comment, ArchiveComment, ImportMap
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+import_cli = AppGroup("import", help="批量导入")
+
+UNUSABLE_PASSWD = "!"  # 不是合法的密码哈希, 导入的用户需要通过邮件登录后重设密码
+
+
+def loads(line: bytes):
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def parse_time(value):
+    if value is None:
+        return datetime.utcnow()
+    return datetime.fromisoformat(value)
+
+
+def check_str(record: dict, name: str, max_length: int, nullable=False):
+    value = record.get(name)
+    if value is None and nullable:
+        return None
+    if not isinstance(value, str) or not 0 < len(value) <= max_length:
+        raise ValueError(f"{name} 必须是长度为1-{max_length}的字符串")
+    return value
+
+
+def lookup(kind: str, ids):
+    """ 查询已导入的旧 id 对应的新 id """
+    ids = list({i for i in ids if i is not None})
+    if not ids:
+        return {}
+    return dict(db.session.execute(db.select(ImportMap.old_id, ImportMap.new_id)
+                                   .where(ImportMap.kind == kind)
+                                   .where(ImportMap.old_id.in_(ids))).all())
+
+
+class Importer(ABC):
+    """
+    流式读取 NDJSON, 每 batch 行校验后批量插入, 每批一个事务
+    提交后在输入文件旁写入断点, 重新执行时从断点继续, 已导入的行通过 import_map 跳过
+    主键在导入开始时从当前最大 id 之后预先分配, 导入期间不应有其他写入
+    子类需要实现 load 和 convert
+    """
+    kind = None
+    model = None
+
+    def __init__(self, path: str, batch: int):
+        self.path = path
+        self.batch = batch
+        self.checkpoint = path + ".checkpoint"
+        self.next_id = None
+        self.new_map = {}  # 当前批次分配的 旧 id -> 新 id
+
+    def load_checkpoint(self):
+        if not os.path.exists(self.checkpoint):
+            return 0, 0
+        with open(self.checkpoint, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data["offset"], data["line"]
+
+    def save_checkpoint(self, offset: int, line: int):
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"offset": offset, "line": line}, f)
+        os.replace(tmp, self.checkpoint)
+
+    def allocate(self, old_id: int):
+        new_id = self.next_id
+        self.next_id += 1
+        self.new_map[old_id] = new_id
+        return new_id
+
+    def reject(self, line: int, reason):
+        click.echo(f"{self.path}:{line}: {reason}", err=True)
+
+    def run(self, restart=False):
+        offset, line = (0, 0) if restart else self.load_checkpoint()
+        self.next_id = (db.session.execute(db.select(db.func.max(self.model.id))).scalar() or 0) + 1
+        imported = rejected = 0
+        start = time.perf_counter()
+
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while True:
+                lines = list(itertools.islice(f, self.batch))
+                if not lines:
+                    break
+
+                records = []
+                for raw in lines:
+                    line += 1
+                    offset += len(raw)
+                    if not raw.strip():
+                        continue
+                    try:
+                        record = loads(raw)
+                        if not isinstance(record, dict) or not isinstance(record.get("id"), int):
+                            raise ValueError("缺少整数 id")
+                        records.append((line, record))
+                    except ValueError as e:
+                        rejected += 1
+                        self.reject(line, e)
+
+                done = lookup(self.kind, [r["id"] for _, r in records])
+                records = [(n, r) for n, r in records if r["id"] not in done]
+                self.new_map = {}
+                self.load([r for _, r in records])
+                rows = []
+                for n, record in records:
+                    try:
+                        if record["id"] in self.new_map:
+                            raise ValueError("id 重复")
+                        row = self.convert(record)
+                    except (ValueError, TypeError) as e:
+                        rejected += 1
+                        self.reject(n, e)
+                        continue
+                    if row is not None:
+                        rows.append(row)
+
+                self.insert(rows)
+                if self.new_map:
+                    db.session.execute(ImportMap.__table__.insert(),
+                                       [{"kind": self.kind, "old_id": k, "new_id": v} for k, v in self.new_map.items()])
+                db.session.commit()
+                self.save_checkpoint(offset, line)
+
+                imported += len(rows)
+                rate = imported / max(time.perf_counter() - start, 1e-6)
+                click.echo(f"{self.kind}: line {line}, imported {imported}, rejected {rejected}, {rate:.0f} rows/s")
+        return imported, rejected
+
+    def insert(self, rows: list):
+        if rows:
+            db.session.execute(self.model.__table__.insert(), rows)
+
+    @abstractmethod
+    def load(self, records: list):
+        """ 为一批记录预先查询 convert 需要的数据 """
+
+    @abstractmethod
+    def convert(self, record: dict):
+        """ 校验并转换为插入的行, 映射到已有数据时返回 None """
+
+
+class UserImporter(Importer):
+    """ 导入用户: {"id", "email", "passwd_hash"?, "role"?}, 邮箱已存在时映射到已有用户 """
+    kind = "user"
+    model = User
+
+    def __init__(self, path: str, batch: int):
+        super().__init__(path, batch)
+        self.roles = dict(db.session.execute(db.select(Role.name, Role.id)).all())
+        self.exist = {}
+
+    def load(self, records: list):
+        emails = [r.get("email") for r in records if isinstance(r.get("email"), str)]
+        self.exist = dict(db.session.execute(db.select(User.email, User.id).where(User.email.in_(emails))).all())
+
+    def convert(self, record: dict):
+        email = check_str(record, "email", 32)
+        if email in self.exist:
+            self.new_map[record["id"]] = self.exist[email]
+            return None
+
+        role = record.get("role", "default")
+        if role not in self.roles:
+            raise ValueError(f"角色 {role} 不存在")
+        passwd_hash = check_str(record, "passwd_hash", 128, nullable=True) or UNUSABLE_PASSWD
+        new_id = self.allocate(record["id"])
+        self.exist[email] = new_id
+        return {"id": new_id, "email": email, "passwd_hash": passwd_hash, "role_id": self.roles[role]}
+
+
+class ArchiveImporter(Importer):
+    """ 导入归档: {"id", "name", "describe"?}, 名字已存在时映射到已有归档 """
+    kind = "archive"
+    model = Archive
+
+    def __init__(self, path: str, batch: int):
+        super().__init__(path, batch)
+        self.exist = {}
+
+    def load(self, records: list):
+        names = [r.get("name") for r in records if isinstance(r.get("name"), str)]
+        self.exist = dict(db.session.execute(db.select(Archive.name, Archive.id).where(Archive.name.in_(names))).all())
+
+    def convert(self, record: dict):
+        name = check_str(record, "name", 32)
+        if name in self.exist:
+            self.new_map[record["id"]] = self.exist[name]
+            return None
+
+        describe = record.get("describe") or ""
+        if not isinstance(describe, str) or len(describe) > 100:
+            raise ValueError("describe 必须是长度为0-100的字符串")
+        new_id = self.allocate(record["id"])
+        self.exist[name] = new_id
+        return {"id": new_id, "name": name, "describe": describe}
+
+
+class CommentImporter(Importer):
+    """
+    导入讨论: {"id", "title"?, "content", "auth_id", "father_id"?, "archive"?, "score"?, "create_time"?, "update_time"?}
+    父讨论需要先于子讨论出现, html 在导入后由 flask import rebuild 统一生成
+    """
+    kind = "comment"
+    model = Comment
+
+    def __init__(self, path: str, batch: int):
+        super().__init__(path, batch)
+        self.users = self.fathers = self.archives = {}
+        self.links = []
+
+    def load(self, records: list):
+        self.users = lookup("user", [r.get("auth_id") for r in records])
+        self.fathers = lookup("comment", [r.get("father_id") for r in records])
+        self.archives = lookup("archive", [i for r in records if isinstance(r.get("archive"), list)
+                                           for i in r["archive"]])
+        self.links = []
+
+    def convert(self, record: dict):
+        title = check_str(record, "title", 32, nullable=True)
+        content = record.get("content")
+        if not isinstance(content, str) or len(content) == 0:
+            raise ValueError("content 不能为空")
+
+        auth_id = self.users.get(record.get("auth_id"))
+        if auth_id is None:
+            raise ValueError(f"用户 {record.get('auth_id')} 未导入")
+
+        father_id = record.get("father_id")
+        if father_id is not None:
+            father_id = self.new_map.get(father_id) or self.fathers.get(father_id)
+            if father_id is None:
+                raise ValueError(f"父讨论 {record.get('father_id')} 未导入")
+
+        archive = []
+        for i in record.get("archive") or []:
+            if i not in self.archives:
+                raise ValueError(f"归档 {i} 未导入")
+            archive.append(self.archives[i])
+
+        score = int(record.get("score", 0))
+        row = {"title": title, "content": content,
+               "excerpt": Comment.make_excerpt(content), "content_length": len(content),
+               "score": score, "score_base": score,  # 导入的评分没有点赞记录, 重新计算评分时保留
+               "create_time": parse_time(record.get("create_time")),
+               "update_time": parse_time(record.get("update_time") or record.get("create_time")),
+               "auth_id": auth_id, "father_id": father_id}
+        row["id"] = self.allocate(record["id"])
+        self.links.extend({"archive_id": i, "comment_id": row["id"]} for i in set(archive))
+        return row
+
+    def insert(self, rows: list):
+        super().insert(rows)
+        if self.links:
+            db.session.execute(ArchiveComment.insert(), self.links)
+
+
+def import_command(importer):
+    @import_cli.command(importer.kind, help=importer.__doc__)
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--batch", default=1000, help="每批处理的行数")
+    @click.option("--restart", is_flag=True, help="忽略断点从头读取")
+    def command(path, batch, restart):
+        imported, rejected = importer(path, batch).run(restart)
+        click.echo(f"Import {imported} {importer.kind}, reject {rejected}")
+    return command
+
+
+for i in (UserImporter, ArchiveImporter, CommentImporter):
+    import_command(i)
+
+
+@import_cli.command("rebuild")
+@click.option("--chunk", default=500, help="每批处理的讨论个数")
+def rebuild(chunk):
+    """ 导入完成后统一生成派生数据: 讨论 html、热度排行和近似重复检测的签名 """
+    from .comment import update_in_chunks
+    from .markup import render_markdown, RENDER_VERSION
+    from .ranking import ranking
+    from .spam import index_missing
+
+    update_in_chunks(Comment.__table__.c.render_version == None, ["content_html", "render_version"],
+                     lambda content: {"content_html": render_markdown(content), "render_version": RENDER_VERSION},
+                     chunk)
+    count = ranking.refresh(full=True, chunk=chunk)
+    click.echo(f"Refresh {count} comments")
+    index_missing(chunk)
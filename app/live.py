@@ -0,0 +1,277 @@
+import glob
+import os
+import queue
+import socket
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+from flask import Blueprint, Response, request, abort
+
+from .db import db, Comment, Role
+from .login import role_required
+from .logger import Logger
+from .api import comment_select, comment_dict, dumps
+
+from configure import conf
+
+
+live = Blueprint("live", __name__)
+
+RETRY = 3000  # 浏览器断线后重连的间隔(毫秒)
+
+
+def format_event(row):
+    return row.id, f"id: {row.id}\nevent: comment\ndata: {dumps(comment_dict(row)).decode('utf-8')}\n\n"
+
+
+class Subscriber:
+    """ 一个 SSE 连接, 队列满时说明客户端过慢, 关闭连接让其通过 Last-Event-ID 重连补发 """
+    __slots__ = ("thread_id", "queue", "closed")
+
+    def __init__(self, thread_id: int):
+        self.thread_id = thread_id
+        self.queue = queue.Queue(maxsize=conf["LIVE_QUEUE_SIZE"])
+        self.closed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.closed = True
+
+
+class SocketBroker:
+    """
+    同一台机器上各进程之间的替身 broker, 用于开发和测试跨进程分发, 不能跨机器
+    有订阅者的进程在 LIVE_SOCKET_DIR 下绑定一个 UNIX 数据报 socket, 发布时把讨论 id 发送给其他进程
+    已退出进程的 socket 文件在发送失败时删除
+    """
+
+    def __init__(self):
+        self.__path = None
+        self.__sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.__sender.setblocking(False)
+
+    @staticmethod
+    def directory():
+        path = conf["LIVE_SOCKET_DIR"] or os.path.join(tempfile.gettempdir(), "htalk-live")
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        return path
+
+    def start(self, feed):
+        self.__path = os.path.join(self.directory(), f"{os.getpid()}.sock")
+        if os.path.exists(self.__path):
+            os.unlink(self.__path)
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self.__path)
+        threading.Thread(target=self.__run, args=(feed, receiver), name="live-socket", daemon=True).start()
+
+    @staticmethod
+    def __run(feed, receiver):
+        while True:
+            data = receiver.recv(64)
+            with feed.app.app_context():
+                try:
+                    feed.dispatch_ids([int(data)])
+                except Exception:  # 接收线程不能退出, 格式错误的数据报丢弃
+                    db.session.rollback()
+                    feed.app.logger.exception(f"Receive live feed fail: {data[:64]!r}")
+                finally:
+                    db.session.remove()
+
+    def send(self, comment_id: int):
+        data = str(comment_id).encode("utf-8")
+        for path in glob.glob(os.path.join(self.directory(), "*.sock")):
+            if path == self.__path:
+                continue
+            try:
+                self.__sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except BlockingIOError:  # 接收方过慢, 丢弃
+                pass
+
+
+class LiveFeed:
+    """
+    每个进程一个变更流, 新的子讨论按父讨论分发给该讨论的所有订阅者, 每个事件只序列化一次
+    LIVE_BROKER 为 database 时由一个线程轮询 comment 表, 可以收到其他机器上的进程创建的讨论
+    LIVE_BROKER 为 socket 时通过 SocketBroker 通知同一台机器上的其他进程
+    LIVE_BROKER 为 local 时只分发本进程创建的讨论, 用于开发和测试
+    """
+
+    def __init__(self):
+        self.app = None
+        self.broker = SocketBroker()
+        self.__lock = threading.Lock()
+        self.__subscribers = {}  # 父讨论 id -> 订阅者集合
+        self.__count = 0
+        self.__pid = None
+        self.__wake = threading.Event()
+        self.__since = None  # 上一次轮询的时间
+        self.__sent = {}  # 轮询窗口内已分发的讨论 id -> 创建时间
+
+    def init_app(self, app):
+        self.app = app
+
+    @property
+    def count(self):
+        return self.__count
+
+    def subscribe(self, thread_id: int):
+        """ 连接数达到上限时返回 None """
+        with self.__lock:
+            if self.__count >= conf["LIVE_MAX_CONNECTION"]:
+                return None
+            self.__start()
+            sub = Subscriber(thread_id)
+            self.__subscribers.setdefault(thread_id, set()).add(sub)
+            self.__count += 1
+            return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        with self.__lock:
+            subs = self.__subscribers.get(sub.thread_id)
+            if subs is None or sub not in subs:
+                return
+            subs.remove(sub)
+            self.__count -= 1
+            if not subs:
+                del self.__subscribers[sub.thread_id]
+
+    def publish(self, cm: Comment):
+        """ 新讨论提交后调用 """
+        if cm.father_id is None:
+            return
+        if conf["LIVE_BROKER"] == "socket":
+            self.broker.send(cm.id)
+        if cm.father_id not in self.__subscribers:
+            return
+        if conf["LIVE_BROKER"] == "database":
+            self.__wake.set()  # 立即轮询, 其他进程在下一次轮询时收到
+        else:
+            self.dispatch_ids([cm.id])
+
+    def dispatch_ids(self, ids: list):
+        with self.__lock:
+            threads = list(self.__subscribers)
+        if threads:
+            self.dispatch(db.session.execute(comment_select()
+                                             .where(Comment.id.in_(ids))
+                                             .where(Comment.father_id.in_(threads))).all())
+
+    def dispatch(self, rows):
+        with self.__lock:
+            for row in rows:
+                subs = self.__subscribers.get(row.father_id)
+                if subs:
+                    event = format_event(row)
+                    for sub in subs:
+                        sub.put(event)
+
+    def __start(self):
+        """ 在 worker 进程内第一次订阅时启动轮询线程或开始接收其他进程的通知 """
+        if conf["LIVE_BROKER"] == "local" or self.__pid == os.getpid():
+            return
+        self.__pid = os.getpid()
+        if conf["LIVE_BROKER"] == "socket":
+            self.broker.start(self)
+        else:
+            threading.Thread(target=self.__run, name="live-feed", daemon=True).start()
+
+    def __run(self):
+        while True:
+            self.__wake.wait(conf["LIVE_POLL_INTERVAL"])
+            self.__wake.clear()
+            if not self.__subscribers:
+                self.__since = None  # 没有订阅者时不查询, 有新订阅者后从当前时间开始
+                self.__sent.clear()
+                continue
+
+            with self.app.app_context():
+                try:
+                    self.poll()
+                except Exception:  # 轮询线程不能退出, 下次轮询时重试
+                    db.session.rollback()
+                    self.app.logger.exception("Poll live feed fail")
+                finally:
+                    db.session.remove()
+
+    def poll(self):
+        """
+        每次轮询一条查询, 与订阅者个数无关
+        自增 id 的分配顺序与提交顺序不同, 较小的 id 可能在较大的 id 之后才可见, 因此不以 id 为游标,
+        而是读取上次轮询前 LIVE_POLL_OVERLAP 秒以来创建的讨论, 已分发的按 id 跳过
+        """
+        now = datetime.utcnow()
+        since, self.__since = self.__since, now
+        if since is None:
+            return
+        overlap = timedelta(seconds=conf["LIVE_POLL_OVERLAP"])
+
+        with self.__lock:
+            threads = list(self.__subscribers)
+        rows = db.session.execute(comment_select()
+                                  .where(Comment.create_time >= since - overlap)
+                                  .where(Comment.father_id.in_(threads))
+                                  .order_by(Comment.id)).all()
+        rows = [i for i in rows if i.id not in self.__sent]
+        for row in rows:
+            self.__sent[row.id] = row.create_time
+        self.__sent = {k: v for k, v in self.__sent.items() if v >= now - 2 * overlap}
+        self.dispatch(rows)
+
+
+feed = LiveFeed()
+
+
+def stream(sub: Subscriber, replay: list):
+    """ 先补发断线期间的讨论, 再发送订阅到的讨论, 空闲时发送心跳以便尽快发现断开的连接 """
+    try:
+        yield f"retry: {RETRY}\n\n"
+        sent = set()
+        for row_id, event in replay:
+            yield event
+            sent.add(row_id)
+        while not sub.closed:
+            try:
+                row_id, event = sub.queue.get(timeout=conf["LIVE_HEARTBEAT"])
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            if row_id not in sent:  # 订阅后、补发前创建的讨论可能同时出现在两处
+                yield event
+    finally:
+        feed.unsubscribe(sub)
+
+
+@live.route("/comment")
+@role_required(Role.CHECK_COMMENT, "live comment")
+def comment_page():
+    comment_id = request.args.get("comment", None, type=int)
+    if not comment_id or not db.session.execute(db.select(Comment.id).where(Comment.id == comment_id)).first():
+        return abort(404)
+
+    sub = feed.subscribe(comment_id)
+    if sub is None:
+        Logger.print_load_page_log(f"live comment {comment_id} rejected")
+        return Response(status=503, headers={"Retry-After": str(RETRY // 1000)})
+
+    # 浏览器自动重连时使用 Last-Event-ID 请求头, 页面脚本手动重连时使用 last 参数
+    last_id = request.headers.get("Last-Event-ID", None, type=int) or request.args.get("last", None, type=int)
+    replay = []
+    if last_id:
+        replay = [format_event(row) for row in
+                  db.session.execute(comment_select()
+                                     .where(Comment.father_id == comment_id)
+                                     .where(Comment.id > last_id)
+                                     .order_by(Comment.id)
+                                     .limit(conf["LIVE_REPLAY_LIMIT"])).all()]
+
+    Logger.print_load_page_log(f"live comment {comment_id}")
+    return Response(stream(sub, replay), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,8 +1,16 @@
+import logging
+
 from flask import request, current_app
 from flask_login import current_user
 
 
 class Logger:
+    @staticmethod
+    def __log(level: int, msg: str):
+        """ 只在日志级别启用时才拼接请求信息 """
+        if current_app.logger.isEnabledFor(level):
+            current_app.logger.log(level, msg + Logger.__get_log_request_info())
+
     @staticmethod
     def __get_log_request_info():
         return (f"user: '{current_user.email}' "
@@ -15,45 +23,36 @@ class Logger:
 
     @staticmethod
     def print_load_page_log(page: str):
-        current_app.logger.debug(
-            f"[{request.method}] Load - '{page}' " + Logger.__get_log_request_info())
+        Logger.__log(logging.DEBUG, f"[{request.method}] Load - '{page}' ")
 
     @staticmethod
     def print_form_error_log(opt: str):
-        current_app.logger.warning(
-            f"[{request.method}] '{opt}' - Bad form " + Logger.__get_log_request_info())
+        Logger.__log(logging.WARNING, f"[{request.method}] '{opt}' - Bad form ")
 
     @staticmethod
     def print_sys_opt_fail_log(opt: str):
-        current_app.logger.error(
-            f"[{request.method}] System {opt} - fail " + Logger.__get_log_request_info())
+        Logger.__log(logging.ERROR, f"[{request.method}] System {opt} - fail ")
 
     @staticmethod
     def print_sys_opt_success_log(opt: str):
-        current_app.logger.warning(
-            f"[{request.method}] System {opt} - success " + Logger.__get_log_request_info())
+        Logger.__log(logging.WARNING, f"[{request.method}] System {opt} - success ")
 
     @staticmethod
     def print_user_opt_fail_log(opt: str):
-        current_app.logger.debug(
-            f"[{request.method}] User {opt} - fail " + Logger.__get_log_request_info())
+        Logger.__log(logging.DEBUG, f"[{request.method}] User {opt} - fail ")
 
     @staticmethod
     def print_user_opt_success_log(opt: str):
-        current_app.logger.debug(
-            f"[{request.method}] User {opt} - success " + Logger.__get_log_request_info())
+        Logger.__log(logging.DEBUG, f"[{request.method}] User {opt} - success ")
 
     @staticmethod
     def print_user_opt_error_log(opt: str):
-        current_app.logger.warning(
-            f"[{request.method}] User {opt} - system fail " + Logger.__get_log_request_info())
+        Logger.__log(logging.WARNING, f"[{request.method}] User {opt} - system fail ")
 
     @staticmethod
     def print_import_user_opt_success_log(opt: str):
-        current_app.logger.info(
-            f"[{request.method}] User {opt} - success " + Logger.__get_log_request_info())
+        Logger.__log(logging.INFO, f"[{request.method}] User {opt} - success ")
 
     @staticmethod
     def print_user_not_allow_opt_log(opt: str):
-        current_app.logger.info(
-            f"[{request.method}] User '{opt}' - reject " + Logger.__get_log_request_info())
\ No newline at end of file
+        Logger.__log(logging.INFO, f"[{request.method}] User '{opt}' - reject ")
\ No newline at end of file
@@ -1,14 +1,16 @@
 from functools import wraps
 from flask import abort
 from flask_login import LoginManager, current_user
+from sqlalchemy.orm.attributes import set_committed_value
 
-from .db import AnonymousUser, User, Role
+from .db import db, AnonymousUser, User, Role
 from .logger import  Logger
 
 
 login = LoginManager()
 login.anonymous_user = AnonymousUser  # 设置未登录的匿名对象
 login.login_view = "auth.passwd_login_page"
+login.blueprint_login_views = {"api": None}  # api 未登录时直接返回 401
 
 
 @login.user_loader
@@ -16,6 +18,10 @@ def user_loader(user_id: int):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return None
+    from .readmodel import cached_role  # readmodel 经过 bus 和 metrics 依赖本模块
+    role = cached_role(user.role_id)
+    if role is not None:  # 复制到当前 session, 省去每个请求加载角色的查询
+        set_committed_value(user, "role", db.session.merge(role, load=False))
     if user.role.has_permission(Role.USABLE):
         return user
     return None
@@ -12,4 +12,4 @@ def send_msg(title: str, to, template, **kwargs):
     message.body = render_template("email-msg/" + template + ".txt", **kwargs)
     message.html = render_template("email-msg/" + template + ".html", **kwargs)
     mail.send(message)
-    current_app.logger.info(f"Send email to {to} sender: {sender} msg: {template} kwargs: {kwargs}")
+    current_app.logger.info(f"Send email msg: {template}")  # 不记录收件人和内容 (包含登录链接等)
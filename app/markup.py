@@ -0,0 +1,41 @@
+import threading
+from functools import partial
+
+import bleach
+from bleach.linkifier import LinkifyFilter
+import markdown
+
+
+RENDER_VERSION = 1  # 修改渲染或过滤规则后需要加一, 并执行 flask comment rerender
+
+ALLOWED_TAGS = ["a", "p", "br", "hr", "strong", "em", "del", "code", "pre", "blockquote",
+                "ul", "ol", "li", "h1", "h2", "h3", "h4", "h5", "h6",
+                "table", "thead", "tbody", "tr", "th", "td"]
+ALLOWED_ATTRIBUTES = {"a": ["href", "title"], "code": ["class"], "th": ["align"], "td": ["align"]}
+ALLOWED_PROTOCOLS = ["http", "https", "mailto"]
+MARKDOWN_EXTENSIONS = ["fenced_code", "tables", "nl2br", "sane_lists"]
+
+
+def set_nofollow(attrs, new=False):
+    attrs[(None, "rel")] = "nofollow noopener"
+    return attrs
+
+
+local = threading.local()  # bleach.Cleaner 不是线程安全的, 每个线程各自创建
+
+
+def get_cleaner():
+    if not hasattr(local, "cleaner"):
+        local.cleaner = bleach.Cleaner(tags=ALLOWED_TAGS,
+                                       attributes=ALLOWED_ATTRIBUTES,
+                                       protocols=ALLOWED_PROTOCOLS,
+                                       strip=True,
+                                       filters=[partial(LinkifyFilter, callbacks=[set_nofollow],
+                                                        skip_tags=["pre", "code"])])
+    return local.cleaner
+
+
+def render_markdown(content: str):
+    """ 将 markdown 渲染为经过过滤的 html, 只在写入时调用 """
+    html = markdown.markdown(content, extensions=MARKDOWN_EXTENSIONS, output_format="html")
+    return get_cleaner().clean(html)
@@ -0,0 +1,37 @@
+import os
+import threading
+
+from flask import Blueprint, Response
+from flask_login import login_required
+
+from .db import Role
+from .login import role_required
+
+
+class Metrics:
+    """ 进程内计数器, 每个 worker 独立统计 """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counter = {}
+
+    def inc(self, name: str, value=1):
+        with self.__lock:
+            self.__counter[name] = self.__counter.get(name, 0) + value
+
+    def items(self):
+        with self.__lock:
+            return sorted(self.__counter.items())
+
+
+metrics = Metrics()
+metric = Blueprint("metric", __name__)
+
+
+@metric.route("/")
+@login_required
+@role_required(Role.SYSTEM, "check metrics")
+def metric_page():
+    pid = os.getpid()
+    data = "".join(f"{name}{{pid=\"{pid}\"}} {value}\n" for name, value in metrics.items())
+    return Response(data, mimetype="text/plain")
@@ -0,0 +1,355 @@
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort
+from flask_login import current_user, login_required
+from flask_wtf import FlaskForm
+from wtforms import SelectField, TextAreaField, StringField, SubmitField, ValidationError
+
+from .db import (db, User, Role, Comment, ArchiveComment, CommentView, CommentVote, CommentRank,
+                 CommentMinHash, CommentBand, CommentHold, Notification, ModerationJob)
+from .login import role_required
+from .logger import Logger
+from .ranking import ranking
+from .audit import audit_log
+from .bus import bus
+
+from configure import conf
+
+
+moderate = Blueprint("moderate", __name__)
+
+LEASE = timedelta(minutes=5)  # 单批处理时间远小于租约, 持有租约的 worker 退出后由其他 worker 继续
+KIND = {ModerationJob.BLOCK: "封禁用户", ModerationJob.ROLE: "修改分组", ModerationJob.PURGE: "删除讨论"}
+
+
+def parse_users(text: str):
+    """ 按空白或逗号分隔, 数字为用户 id, 其余为邮箱 """
+    user_ids, emails = [], []
+    for i in re.split(r"[\s,]+", text or ""):
+        if i.isdigit():
+            user_ids.append(int(i))
+        elif i:
+            emails.append(i)
+    return user_ids, emails
+
+
+def create_job(kind: str, auth_id, users="", role_filter="", prefix="", role=""):
+    user_ids, emails = parse_users(users)
+    if not (user_ids or emails or role_filter or prefix):
+        raise ValueError("必须指定用户或筛选条件")
+    if kind == ModerationJob.ROLE and not Role.query.filter_by(name=role).first():
+        raise ValueError("角色不存在")
+    params = {"user_ids": user_ids, "emails": emails, "role_filter": role_filter, "prefix": prefix, "role": role}
+    job = ModerationJob(kind=kind, params=json.dumps(params, ensure_ascii=False), auth_id=auth_id)
+    db.session.add(job)
+    db.session.commit()
+    audit_log.record(f"moderation_{kind}", "job", job.id, job.params)
+    return job
+
+
+def target_users(job: ModerationJob, params: dict):
+    """ 用户列表与筛选条件同时给出时取交集, 不包括创建任务的管理员 """
+    stmt = db.select(User.id)
+    if job.auth_id is not None:
+        stmt = stmt.where(User.id != job.auth_id)
+    if params["user_ids"] or params["emails"]:
+        stmt = stmt.where(db.or_(User.id.in_(params["user_ids"]), User.email.in_(params["emails"])))
+    if params["role_filter"]:
+        stmt = stmt.where(User.role_id == db.select(Role.id).where(Role.name == params["role_filter"]).scalar_subquery())
+    if params["prefix"]:
+        stmt = stmt.where(User.email.startswith(params["prefix"], autoescape=True))
+    return stmt
+
+
+def delete_comments(ids: list):
+    """ 删除讨论及其派生数据, ids 中的讨论不能还有未删除的回复 """
+    db.session.execute(ArchiveComment.delete().where(ArchiveComment.c.comment_id.in_(ids)))
+    for model in (CommentView, CommentVote, CommentRank, CommentMinHash, CommentBand, Notification):
+        table = model.__table__
+        db.session.execute(table.delete().where(table.c.comment_id.in_(ids)))
+    table = CommentHold.__table__
+    db.session.execute(table.delete().where(db.or_(table.c.father_id.in_(ids), table.c.match_id.in_(ids))))
+    db.session.execute(Comment.__table__.delete().where(Comment.__table__.c.id.in_(ids)))
+
+
+class ModerationRunner:
+    """
+    后台线程定期领取未完成的任务, 每批在一个短事务中处理 MODERATION_CHUNK 个用户或讨论
+    多个 worker 通过租约保证同一任务只由一个 worker 处理, 派生数据在任务最后统一修正
+    """
+
+    def __init__(self):
+        self.app = None
+        self.__lock = threading.Lock()
+        self.__pid = None
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.__start)
+
+    def __start(self):
+        """ 在 worker 进程处理第一个请求时启动任务线程 """
+        if self.__pid == os.getpid() or conf["MODERATION_POLL_INTERVAL"] <= 0:
+            return
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            threading.Thread(target=self.__run, name="moderation", daemon=True).start()
+
+    def __run(self):
+        while True:
+            time.sleep(conf["MODERATION_POLL_INTERVAL"])
+            with self.app.app_context():
+                try:
+                    for i in db.session.execute(db.select(ModerationJob.id)
+                                                .where(ModerationJob.state.in_((ModerationJob.PENDING,
+                                                                                ModerationJob.RUNNING)))
+                                                .order_by(ModerationJob.id)).scalars().all():
+                        if self.claim(i):
+                            self.run(i)
+                except Exception:  # 任务线程不能退出, 下次轮询时重试
+                    db.session.rollback()
+                    self.app.logger.exception("Run moderation job fail")
+                finally:
+                    db.session.remove()
+
+    @staticmethod
+    def claim(job_id: int):
+        """ 领取没有租约或租约已过期的任务 """
+        now = datetime.utcnow()
+        table = ModerationJob.__table__
+        result = db.session.execute(table.update()
+                                    .where(table.c.id == job_id)
+                                    .where(table.c.state.in_((ModerationJob.PENDING, ModerationJob.RUNNING)))
+                                    .where(db.or_(table.c.lease_time == None, table.c.lease_time < now))
+                                    .values(state=ModerationJob.RUNNING, lease_time=now + LEASE, update_time=now))
+        db.session.commit()
+        return result.rowcount == 1
+
+    def run(self, job_id: int, echo=None):
+        """ 处理已领取的任务直到完成, 出错时释放租约, 之后由任意 worker 从 cursor 继续 """
+        job = db.session.get(ModerationJob, job_id)
+        step = self.purge if job.kind == ModerationJob.PURGE else self.change_role
+        chunk = conf["MODERATION_CHUNK"]
+
+        try:
+            params = json.loads(job.params)
+            users = target_users(job, params)
+            if job.total is None:
+                job.total = db.session.execute(db.select(db.func.count())
+                                               .select_from(self.target(job, users).subquery())).scalar()
+                db.session.commit()
+
+            while True:
+                last = step(job, params, users, chunk)
+                if last is None:
+                    break
+                job.cursor, count = last
+                job.processed += count
+                job.update_time = datetime.utcnow()
+                job.lease_time = job.update_time + LEASE
+                db.session.commit()  # 进度与本批修改在同一事务中提交
+                if echo:
+                    echo(f"Job {job.id}: {job.processed}/{job.total}")
+                time.sleep(conf["MODERATION_CHUNK_PAUSE"])  # 让出行锁和连接, 避免影响在线请求
+
+            if job.kind == ModerationJob.PURGE:
+                self.fix_derived(users, chunk)
+            job.state = ModerationJob.DONE
+            job.message = None
+        except ValueError as e:
+            db.session.rollback()
+            job.state = ModerationJob.FAILED
+            job.message = str(e)
+        except Exception as e:  # 其他错误保留任务状态, 释放租约后重试
+            db.session.rollback()
+            job.message = str(e)[:256] or type(e).__name__
+            self.app.logger.exception(f"Moderation job {job.id} fail")
+        job.lease_time = None
+        job.update_time = datetime.utcnow()
+        db.session.commit()
+        if echo:
+            echo(f"Job {job.id}: {job.state} {job.message or ''}")
+
+    @staticmethod
+    def target(job: ModerationJob, users):
+        """ 修改分组按用户计数, 删除讨论按目标用户的讨论计数 """
+        if job.kind == ModerationJob.PURGE:
+            return db.select(Comment.id).where(Comment.auth_id.in_(users))
+        return users
+
+    @staticmethod
+    def change_role(job: ModerationJob, params: dict, users, chunk: int):
+        role = "block" if job.kind == ModerationJob.BLOCK else params["role"]
+        role_id = db.session.execute(db.select(Role.id).where(Role.name == role)).scalar()
+        if role_id is None:
+            raise ValueError(f"角色 {role} 不存在")
+
+        ids = db.session.execute(users.where(User.id > job.cursor).order_by(User.id).limit(chunk)).scalars().all()
+        if not ids:
+            return None
+        table = User.__table__
+        db.session.execute(table.update().where(table.c.id.in_(ids)).values(role_id=role_id))
+        return ids[-1], len(ids)
+
+    @staticmethod
+    def purge(job: ModerationJob, params: dict, users, chunk: int):
+        """
+        删除一批目标用户的讨论及其全部回复, 回复从最深的一层开始分批删除并各自提交
+        中断后重新查询剩余的回复, 已删除的讨论不会再出现
+        """
+        roots = db.session.execute(db.select(Comment.id)
+                                   .where(Comment.auth_id.in_(users))
+                                   .where(Comment.id > job.cursor)
+                                   .order_by(Comment.id).limit(chunk)).scalars().all()
+        if not roots:
+            return None
+
+        depth = {i: 0 for i in roots}  # 讨论 -> 所在层数, 目标用户回复自己时记为更深的一层
+        target = set(roots)  # 本批删除的目标用户的讨论, 用于统计进度
+        level, d = roots, 0
+        while level:
+            d += 1
+            children = []
+            for i in range(0, len(level), chunk):
+                rows = db.session.execute(db.select(Comment.id, Comment.auth_id.in_(users).label("target"))
+                                          .where(Comment.father_id.in_(level[i:i + chunk]))).all()
+                children.extend(row.id for row in rows)
+                target.update(row.id for row in rows if row.target)
+            depth.update((i, d) for i in children)
+            level = children
+
+        levels = {}
+        for i, d in depth.items():
+            levels.setdefault(d, []).append(i)
+        for d in sorted(levels, reverse=True):
+            for i in range(0, len(levels[d]), chunk):
+                delete_comments(levels[d][i:i + chunk])
+                db.session.commit()
+        return roots[-1], len(target)
+
+    @staticmethod
+    def fix_derived(users, chunk: int):
+        """ 删除目标用户发出的通知, 重新计算回复数已改变的讨论的热度 """
+        table = Notification.__table__
+        while True:
+            ids = db.session.execute(db.select(table.c.id).where(table.c.actor_id.in_(users))
+                                     .limit(chunk)).scalars().all()
+            if not ids:
+                break
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            db.session.commit()
+
+        replies = (db.select(db.func.count(Comment.id))
+                   .where(Comment.father_id == CommentRank.comment_id)
+                   .correlate(CommentRank)
+                   .scalar_subquery())
+        stale = db.session.execute(db.select(CommentRank.comment_id)
+                                   .where(CommentRank.replies != replies)).scalars().all()
+        now = datetime.utcnow()
+        for i in range(0, len(stale), chunk):
+            ranking.write(stale[i:i + chunk], now)
+            db.session.commit()
+        bus.publish("comment")  # 所有进程中与讨论有关的缓存
+
+
+runner = ModerationRunner()
+
+
+class ModerationForm(FlaskForm):
+    kind = SelectField("操作", choices=list(KIND.items()))
+    users = TextAreaField("用户", description="用户 id 或邮箱, 以空白或逗号分隔")
+    role_filter = StringField("角色筛选", description="只处理该分组的用户")
+    prefix = StringField("邮箱前缀", description="只处理邮箱以此开头的用户")
+    role = StringField("新分组", description="修改分组时的目标分组")
+    submit = SubmitField("提交")
+
+    def validate_users(self, field):
+        if not (field.data.strip() or self.role_filter.data or self.prefix.data):
+            raise ValidationError("必须指定用户或筛选条件")
+
+    def validate_role(self, field):
+        if self.kind.data == ModerationJob.ROLE and not Role.query.filter_by(name=field.data).first():
+            raise ValidationError("角色不存在")
+
+
+@moderate.route("/", methods=["GET", "POST"])
+@login_required
+@role_required(Role.BLOCK_USER, "moderation job")
+def job_page():
+    form = ModerationForm()
+    if form.validate_on_submit():
+        if form.kind.data == ModerationJob.ROLE and not current_user.role.has_permission(Role.SYSTEM):
+            return abort(403)
+        job = create_job(form.kind.data, current_user.id, form.users.data, form.role_filter.data,
+                         form.prefix.data, form.role.data)
+        flash("任务已提交, 将在后台分批执行")
+        Logger.print_user_opt_success_log(f"create moderation job {job.id}")
+        return redirect(url_for("moderate.job_page"))
+
+    page = request.args.get("page", 1, type=int)
+    pagination = (ModerationJob.query.options(db.joinedload(ModerationJob.auth))
+                  .order_by(ModerationJob.id.desc())
+                  .paginate(page=page, per_page=8, error_out=False))
+    Logger.print_load_page_log("moderation job")
+    return render_template("moderate/job.html", form=form, items=pagination.items, pagination=pagination, kind=KIND)
+
+
+@moderate.route("/retry")
+@login_required
+@role_required(Role.BLOCK_USER, "retry moderation job")
+def retry_page():
+    job = ModerationJob.query.filter_by(id=request.args.get("job", None, type=int)).first()
+    if not job:
+        return abort(404)
+    if job.state == ModerationJob.FAILED:
+        job.state = ModerationJob.PENDING
+        job.message = None
+        db.session.commit()
+        flash("任务将从中断处继续")
+    return redirect(url_for("moderate.job_page"))
+
+
+def job_command(kind: str):
+    @moderate.cli.command(kind, help=f"{KIND[kind]}, 在当前进程中执行")
+    @click.option("--users", default="", help="用户 id 或邮箱, 以逗号分隔")
+    @click.option("--role-filter", default="", help="只处理该分组的用户")
+    @click.option("--prefix", default="", help="只处理邮箱以此开头的用户")
+    @click.option("--role", default="", help="修改分组时的目标分组")
+    def command(users, role_filter, prefix, role):
+        try:
+            job = create_job(kind, None, users, role_filter, prefix, role)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        runner.claim(job.id)
+        runner.run(job.id, echo=click.echo)
+    return command
+
+
+for i in KIND:
+    job_command(i)
+
+
+@moderate.cli.command("resume")
+@click.argument("job_id", type=int)
+def resume_command(job_id):
+    """ 在当前进程中继续执行未完成的任务 """
+    ModerationJob.query.filter_by(id=job_id, state=ModerationJob.FAILED).update({"state": ModerationJob.PENDING})
+    db.session.commit()
+    if not runner.claim(job_id):
+        raise click.UsageError("任务不存在、已完成或正在由其他进程执行")
+    runner.run(job_id, echo=click.echo)
+
+
+@moderate.cli.command("list")
+def list_command():
+    """ 列出最近的任务 """
+    for job in ModerationJob.query.order_by(ModerationJob.id.desc()).limit(20):
+        click.echo(f"{job.id}\t{job.kind}\t{job.state}\t{job.processed}/{job.total}\t{job.message or ''}")
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import click
+from flask import Blueprint, render_template, request, url_for
+from flask_login import current_user, login_required
+
+from .db import db, Notification, Comment, User
+from .logger import Logger
+from .mail import send_msg
+
+from configure import conf
+
+
+notify = Blueprint("notify", __name__)
+
+LEASE = timedelta(minutes=30)  # 领取后超过租约仍未发送 (worker 中途退出) 的通知重新领取
+
+
+def notify_reply(cm: Comment, father: Comment):
+    """ 与新讨论在同一个事务中提交 """
+    if father is not None and father.auth_id != cm.auth.id:
+        db.session.add(Notification(user_id=father.auth_id, kind=Notification.REPLY,
+                                    actor_id=cm.auth.id, comment_id=father.id))
+
+
+def notify_follow(follower: User, followed: User):
+    db.session.add(Notification(user_id=followed.id, kind=Notification.FOLLOW, actor_id=follower.id))
+
+
+class DigestMailer:
+    """
+    定期将未读通知按接收者合并为一封邮件, 同一讨论的多条回复合并为一行
+    多个 worker 同时运行时通过写入 digest 批次号和领取时间领取通知, 发送成功后清空领取时间,
+    领取时间超过 LEASE 的通知视为未领取, worker 在领取和发送之间退出时由下一批重新发送
+    """
+
+    def __init__(self):
+        self.app = None
+        self.__lock = threading.Lock()
+        self.__pid = None
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.__start)
+
+    def __start(self):
+        """ 在 worker 进程处理第一个请求时启动发送线程 """
+        if self.__pid == os.getpid() or not conf["NOTIFY_EMAIL"]:
+            return
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            threading.Thread(target=self.__run, name="digest-mailer", daemon=True).start()
+
+    def __run(self):
+        while True:
+            time.sleep(conf["NOTIFY_DIGEST_INTERVAL"])
+            with self.app.app_context():
+                try:
+                    self.send()
+                except Exception:  # 发送线程不能退出, 未发送的通知在租约过期后重新领取
+                    db.session.rollback()
+                    self.app.logger.exception("Send notification digest fail")
+                finally:
+                    db.session.remove()
+
+    @staticmethod
+    def claim():
+        """ 领取所有未读且未发送的通知 (包括租约已过期的), 返回批次号 """
+        token = uuid4().hex
+        now = datetime.utcnow()
+        table = Notification.__table__
+        db.session.execute(table.update()
+                           .where(db.or_(table.c.digest == None, table.c.claim_time < now - LEASE))
+                           .where(table.c.read == False)
+                           .where(table.c.create_time <= now)
+                           .values(digest=token, claim_time=now))
+        db.session.commit()
+        return token
+
+    @staticmethod
+    def release(token: str, sent: bool, user_id=None):
+        """
+        发送成功时清空领取时间, 不再重新领取; 失败时清空批次号, 由下一批重新领取
+        user_id 为空时释放该批次剩余的全部通知
+        """
+        table = Notification.__table__
+        stmt = table.update().where(table.c.digest == token)
+        if user_id is not None:
+            stmt = stmt.where(table.c.user_id == user_id)
+        values = {"claim_time": None} if sent else {"claim_time": None, "digest": None}
+        db.session.execute(stmt.values(values))
+        db.session.commit()
+
+    @staticmethod
+    def collect(token: str):
+        """ 按接收者汇总, 回复按讨论聚合, 查询次数与通知条数无关 """
+        digest = defaultdict(lambda: {"reply": [], "follow": []})
+        replies = db.session.execute(db.select(Notification.user_id, Notification.comment_id,
+                                               db.func.count(Notification.id).label("count"),
+                                               Comment.title, Comment.excerpt)
+                                     .join(Comment, Comment.id == Notification.comment_id)
+                                     .where(Notification.digest == token)
+                                     .where(Notification.kind == Notification.REPLY)
+                                     .group_by(Notification.user_id, Notification.comment_id,
+                                               Comment.title, Comment.excerpt))
+        for row in replies:
+            digest[row.user_id]["reply"].append(row)
+
+        follows = db.session.execute(db.select(Notification.user_id, User.id, User.email)
+                                     .join(User, User.id == Notification.actor_id)
+                                     .where(Notification.digest == token)
+                                     .where(Notification.kind == Notification.FOLLOW))
+        for row in follows:
+            digest[row.user_id]["follow"].append(row)
+
+        recipients = db.session.execute(db.select(User.id, User.email)
+                                        .where(User.id.in_(list(digest)))).all()
+        return [(row.id, row.email, digest[row.id]) for row in recipients]
+
+    def send(self):
+        """ 发送一批摘要邮件, 返回邮件个数 """
+        token = self.claim()
+        limit = conf["NOTIFY_DIGEST_LIMIT"]
+        count = 0
+        with self.app.test_request_context(base_url=conf["WEBSITE_URL"]):  # 邮件中的链接需要完整的 url
+            for user_id, email, item in self.collect(token):
+                try:
+                    send_msg("新通知", email, "digest",
+                             reply=item["reply"][:limit],
+                             reply_more=max(len(item["reply"]) - limit, 0),
+                             follow=item["follow"][:limit],
+                             follow_more=max(len(item["follow"]) - limit, 0),
+                             notification_url=url_for("notify.list_page", _external=True))
+                except Exception:  # 发送失败的通知会在下一批重新领取
+                    self.app.logger.exception(f"Send notification digest to user {user_id} fail")
+                    self.release(token, sent=False, user_id=user_id)
+                else:
+                    self.release(token, sent=True, user_id=user_id)
+                    count += 1
+        self.release(token, sent=True)  # 接收者或被回复的讨论已删除的通知不再发送
+        return count
+
+
+digest = DigestMailer()
+
+
+@notify.route("/")
+@login_required
+def list_page():
+    page = request.args.get("page", 1, type=int)
+    pagination = (Notification.query
+                  .options(db.joinedload(Notification.actor), db.joinedload(Notification.comment))
+                  .filter_by(user_id=current_user.id)
+                  .order_by(Notification.id.desc())
+                  .paginate(page=page, per_page=20, error_out=False))
+    unread = [i.id for i in pagination.items if not i.read]
+    html = render_template("notify/list.html",
+                           items=pagination.items,
+                           unread=set(unread),
+                           pagination=pagination)
+    if unread:  # 渲染后再提交, 避免提交使已加载的通知过期而逐条重新查询
+        Notification.query.filter(Notification.id.in_(unread)).update({"read": True}, synchronize_session=False)
+        db.session.commit()
+    Logger.print_load_page_log("notification list")
+    return html
+
+
+@notify.cli.command("digest")
+def send_digest():
+    """ 立即发送通知摘要邮件, 可以在关闭后台发送时由定时任务调用 """
+    count = digest.send()
+    click.echo(f"Send {count} digest emails")
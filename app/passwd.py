@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import abort
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+
+from configure import conf
+
+
+def normalize_method(method: str):
+    """ 与哈希中记录的方法一致, pbkdf2 未指定迭代次数时补上 werkzeug 的默认值 """
+    if method.startswith("pbkdf2:") and method.count(":") == 1:
+        return f"{method}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+
+class PasswdHasher:
+    """
+    密码哈希在进程池中计算, 不占用请求线程的 CPU, 每个 worker 进程有独立的进程池
+    同时提交的任务最多 PASSWD_WORKERS + PASSWD_QUEUE 个, 等待超过 PASSWD_TIMEOUT 秒时返回 503
+    PASSWD_WORKERS 为 0 时在当前线程中计算
+    子进程按 multiprocessing 的规则导入 __main__, 直接运行的脚本需要放在 if __name__ == "__main__" 下
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__pid = None
+        self.__executor = None
+        self.__slots = None
+
+    def __start(self):
+        """ gunicorn fork 后在 worker 进程中重新创建进程池; forkserver 不复制请求线程持有的锁 """
+        if self.__pid == os.getpid():
+            return
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.__slots = threading.BoundedSemaphore(conf["PASSWD_WORKERS"] + conf["PASSWD_QUEUE"])
+            self.__executor = ProcessPoolExecutor(max_workers=conf["PASSWD_WORKERS"],
+                                                  mp_context=multiprocessing.get_context("forkserver"))
+            self.__pid = os.getpid()
+
+    def __call(self, func, *args):
+        if conf["PASSWD_WORKERS"] == 0:
+            return func(*args)
+        self.__start()
+        if not self.__slots.acquire(timeout=conf["PASSWD_TIMEOUT"]):
+            return abort(503)
+        try:
+            return self.__executor.submit(func, *args).result()
+        finally:
+            self.__slots.release()
+
+    def hash(self, passwd: str):
+        return self.__call(generate_password_hash, passwd, conf["PASSWD_METHOD"], conf["PASSWD_SALT_LENGTH"])
+
+    def check(self, passwd_hash: str, passwd: str):
+        return self.__call(check_password_hash, passwd_hash, passwd)
+
+    @staticmethod
+    def needs_rehash(passwd_hash: str):
+        """ 哈希方法或盐长度与当前配置不同 """
+        if passwd_hash.count("$") < 2:
+            return True
+        method, salt, _ = passwd_hash.split("$", 2)
+        return method != normalize_method(conf["PASSWD_METHOD"]) or len(salt) != conf["PASSWD_SALT_LENGTH"]
+
+
+hasher = PasswdHasher()
@@ -0,0 +1,171 @@
+import math
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+
+from .db import db, Comment, CommentView, CommentVote, CommentRank, TaskLease
+
+from configure import conf
+
+
+EPOCH = datetime(2022, 1, 1)
+OVERLAP = timedelta(minutes=1)  # 刷新开始后才提交的修改可能早于上次刷新时间, 多检查一段时间
+LEASE_NAME = "hot-ranking"
+
+
+def hot_score(replies: int, score: int, views: int, active_time: datetime):
+    """
+    活跃度取对数后加上时间项, 结果与当前时间无关
+    因此没有新活动的讨论不需要重新计算, 排行可以增量刷新
+    """
+    weight = conf["HOT_WEIGHT"]
+    activity = replies * weight["reply"] + max(score, 0) * weight["score"] + views * weight["view"]
+    return math.log10(max(activity, 1)) + (active_time - EPOCH).total_seconds() / conf["HOT_DECAY"]
+
+
+def is_topic():
+    return (Comment.title != None) & (Comment.father_id == None)
+
+
+class HotRanking:
+    """
+    维护 comment_rank 表, 每个主题讨论在创建时写入一行, 只重新计算上次刷新后有新回复、浏览或点赞的主题讨论
+    取消点赞不会触发刷新, 会在下次有其他活动或全量刷新时更新
+    每个 worker 都有刷新线程, 但只有持有 task_lease 租约的一个执行刷新
+    """
+
+    def __init__(self):
+        self.app = None
+        self.__lock = threading.Lock()
+        self.__pid = None
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.__start)
+
+    def __start(self):
+        """ 在 worker 进程处理第一个请求时启动刷新线程 """
+        if self.__pid == os.getpid() or conf["HOT_REFRESH_INTERVAL"] <= 0:
+            return
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+            self.__pid = os.getpid()
+            threading.Thread(target=self.__run, name="hot-ranking", daemon=True).start()
+
+    def __run(self):
+        while True:
+            time.sleep(conf["HOT_REFRESH_INTERVAL"])
+            with self.app.app_context():
+                try:
+                    if self.claim():
+                        self.refresh()
+                except SQLAlchemyError:  # 与 flask comment refresh-hot 同时插入新讨论时会冲突, 下次刷新时重试
+                    db.session.rollback()
+                    self.app.logger.exception("Refresh hot ranking fail")
+                finally:
+                    db.session.remove()
+
+    @staticmethod
+    def claim():
+        """
+        领取或续约刷新任务, 租约为两个刷新间隔, 持有者每次刷新前续约
+        持有者退出后, 其他 worker 在租约到期后接替
+        """
+        now = datetime.utcnow()
+        owner = f"{socket.gethostname()}:{os.getpid()}"
+        values = {"owner": owner, "lease_time": now + timedelta(seconds=2 * conf["HOT_REFRESH_INTERVAL"])}
+        table = TaskLease.__table__
+        result = db.session.execute(table.update()
+                                    .where(table.c.name == LEASE_NAME)
+                                    .where(db.or_(table.c.owner == owner, table.c.lease_time == None,
+                                                  table.c.lease_time < now))
+                                    .values(values))
+        if result.rowcount == 0:  # 租约由其他 worker 持有, 或者还没有租约
+            try:
+                db.session.execute(table.insert().values(name=LEASE_NAME, **values))
+            except IntegrityError:
+                db.session.rollback()
+                return False
+        db.session.commit()
+        return True
+
+    @staticmethod
+    def add(comment: Comment):
+        """
+        在创建主题讨论的事务中写入初始热度, 按热度排序时不需要等待下次刷新
+        refresh_time 为 EPOCH, 不影响增量刷新的起点, 下次刷新时按实际活动重新计算
+        """
+        if comment.title is None or comment.father is not None:
+            return
+        db.session.flush()
+        db.session.add(CommentRank(comment_id=comment.id, hot=hot_score(0, 0, 0, comment.create_time),
+                                   active_time=comment.create_time, refresh_time=EPOCH))
+
+    @staticmethod
+    def changed(since: datetime):
+        """ since 之后有活动的主题讨论 """
+        ids = db.union(db.select(Comment.id).where(Comment.create_time >= since),
+                       db.select(Comment.father_id).where(Comment.create_time >= since),
+                       db.select(CommentView.comment_id).where(CommentView.update_time >= since),
+                       db.select(CommentVote.comment_id).where(CommentVote.time >= since)).subquery()
+        return db.session.execute(db.select(Comment.id)
+                                  .where(Comment.id.in_(db.select(ids.c[0])))
+                                  .where(is_topic())).scalars().all()
+
+    @staticmethod
+    def write(ids: list, now: datetime):
+        son = db.aliased(Comment)
+        rows = db.session.execute(db.select(Comment.id, Comment.create_time, Comment.score,
+                                            db.func.count(son.id).label("replies"),
+                                            db.func.max(son.create_time).label("last_reply"),
+                                            db.func.coalesce(CommentView.views, 0).label("views"))
+                                  .outerjoin(son, son.father_id == Comment.id)
+                                  .outerjoin(CommentView, CommentView.comment_id == Comment.id)
+                                  .where(Comment.id.in_(ids))
+                                  .group_by(Comment.id, Comment.create_time, Comment.score, CommentView.views)).all()
+
+        table = CommentRank.__table__
+        exist = set(db.session.execute(db.select(table.c.comment_id)
+                                       .where(table.c.comment_id.in_(ids))).scalars())
+        update, insert = [], []
+        for row in rows:
+            active_time = max(row.create_time, row.last_reply or row.create_time)
+            rank = {"hot": hot_score(row.replies, row.score, row.views, active_time),
+                    "replies": row.replies, "score": row.score, "views": row.views,
+                    "active_time": active_time, "refresh_time": now}
+            if row.id in exist:
+                update.append({"_id": row.id, **{f"_{k}": v for k, v in rank.items()}})
+            else:
+                insert.append({"comment_id": row.id, **rank})
+
+        if update:
+            db.session.execute(table.update()
+                               .where(table.c.comment_id == db.bindparam("_id"))
+                               .values({k: db.bindparam(f"_{k}") for k in
+                                        ("hot", "replies", "score", "views", "active_time", "refresh_time")}),
+                               update)
+        if insert:
+            db.session.execute(table.insert(), insert)
+
+    def refresh(self, full=False, chunk=500):
+        """ 刷新排行, 返回重新计算的讨论个数 """
+        now = datetime.utcnow()
+        since = None if full else db.session.execute(db.select(db.func.max(CommentRank.refresh_time))
+                                                     .where(CommentRank.refresh_time > EPOCH)).scalar()
+        if since is None:
+            ids = db.session.execute(db.select(Comment.id).where(is_topic())).scalars().all()
+        else:
+            ids = self.changed(since - OVERLAP)
+
+        for i in range(0, len(ids), chunk):
+            self.write(ids[i:i + chunk], now)
+            db.session.commit()
+        return len(ids)
+
+
+ranking = HotRanking()
@@ -0,0 +1,121 @@
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from functools import wraps
+from hashlib import blake2b
+
+from flask import request, abort
+
+from .logger import Logger
+from .metrics import metrics
+
+from configure import conf
+
+
+SLOT = struct.Struct("<Qddd")  # 键的哈希, 剩余令牌, 上次更新时间, 令牌补满的时间
+PROBE = 4  # 每个键最多检查的相邻槽位个数
+
+
+class SharedBuckets:
+    """
+    令牌桶保存在 mmap 文件中的定长哈希表里, 同一台机器上的所有 worker 共享
+    每次检查最多读写 PROBE 个槽位, 令牌已补满的桶等同于不存在, 可以直接被其他键覆盖
+    槽位都被占用时覆盖最早补满的桶, 因此内存占用固定为 RATE_LIMIT_SLOTS * 32 字节
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()  # flock 不能互斥同一进程内的线程
+        self.__pid = None
+        self.__fd = None
+        self.__map = None
+        self.__slots = 0
+
+    def __open(self):
+        """
+        每个进程单独打开文件, fork 前打开的文件描述符共享 flock, 无法互斥
+        文件名包含槽位个数, 修改槽位个数后使用新文件; 已被其他进程映射的文件不能缩小, 否则它们访问时触发 SIGBUS
+        """
+        if self.__pid == os.getpid():
+            return
+        self.__slots = conf["RATE_LIMIT_SLOTS"]
+        prefix = conf["RATE_LIMIT_FILE"] or os.path.join(tempfile.gettempdir(), "htalk-ratelimit")
+        path = f"{prefix}.{self.__slots}"
+        size = self.__slots * SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            current = os.fstat(fd).st_size
+            if current == 0:
+                os.ftruncate(fd, size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        if current not in (0, size):
+            os.close(fd)
+            raise RuntimeError(f"Rate limit file {path} has size {current}, expect {size}")
+        self.__fd = fd
+        self.__map = mmap.mmap(self.__fd, size)
+        self.__pid = os.getpid()
+
+    def take(self, key: str, count: int, period: float):
+        """ 从 key 的桶中取一个令牌, 桶容量为 count, 每 period 秒补满 """
+        rate = count / period
+        h = int.from_bytes(blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+        now = time.time()
+
+        with self.__lock:
+            self.__open()
+            fcntl.flock(self.__fd, fcntl.LOCK_EX)
+            try:
+                index, tokens = None, float(count)
+                victim, victim_full = None, None
+                for i in range(PROBE):
+                    j = (h + i) % self.__slots
+                    slot_h, slot_tokens, slot_time, slot_full = SLOT.unpack_from(self.__map, j * SLOT.size)
+                    if slot_h == h:
+                        index, tokens = j, min(float(count), slot_tokens + (now - slot_time) * rate)
+                        break
+                    if victim is None or slot_full < victim_full:
+                        victim, victim_full = j, slot_full
+                if index is None:
+                    index = victim
+
+                allow = tokens >= 1
+                if allow:
+                    tokens -= 1
+                SLOT.pack_into(self.__map, index * SLOT.size, h, tokens, now, now + (count - tokens) / rate)
+                return allow
+            finally:
+                fcntl.flock(self.__fd, fcntl.LOCK_UN)
+
+
+buckets = SharedBuckets()
+
+
+def check(rule: str, kind: str, value: str):
+    limit = conf["RATE_LIMIT_RULE"].get(rule, {}).get(kind)
+    if limit is None or not value:
+        return True
+    allow = buckets.take(f"{rule}:{kind}:{value}", *limit)
+    metrics.inc(f"ratelimit_{'allow' if allow else 'deny'}_total_{rule}_{kind}")
+    return allow
+
+
+def rate_limit(rule: str):
+    """ 对 POST 请求按 ip 和表单中的 email 限流, 超过限制时返回 429 """
+    def limit(func):
+        @wraps(func)
+        def new_func(*args, **kwargs):
+            if conf["RATE_LIMIT"] and request.method == "POST":
+                email = request.form.get("email", "").strip().lower()
+                allow_ip = check(rule, "ip", request.remote_addr)
+                allow_email = check(rule, "email", email)
+                if not (allow_ip and allow_email):
+                    Logger.print_user_not_allow_opt_log(f"{rule} (rate limit)")
+                    return abort(429)
+            return func(*args, **kwargs)
+        return new_func
+    return limit
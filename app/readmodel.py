@@ -0,0 +1,168 @@
+from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import make_transient_to_detached
+
+from .db import db, Comment, CommentView, CommentRank, User, Role, Archive, ArchiveComment
+from .bus import VersionedCache
+
+from configure import conf
+
+
+class AuthView:
+    __slots__ = ("id", "email")
+
+    def __init__(self, id_: int, email: str):
+        self.id = id_
+        self.email = email
+
+
+class CommentCard:
+    """ 讨论列表中一张卡片所需的字段, 不经过 ORM 对象构造和 session 的 identity map """
+    __slots__ = ("id", "title", "excerpt", "create_time", "update_time", "son_count", "view_count", "score", "auth")
+
+    def __init__(self, row):
+        self.id = row.id
+        self.title = row.title
+        self.excerpt = row.excerpt
+        self.create_time = row.create_time
+        self.update_time = row.update_time
+        self.son_count = row.son_count
+        self.view_count = row.view_count
+        self.score = row.score
+        self.auth = AuthView(row.auth_id, row.auth_email) if "auth_email" in row._fields else None
+
+
+class RowPagination(Pagination):
+    """ 对 Core select 分页, 每一行通过 view 转换为只读对象 """
+
+    def _query_items(self):
+        select = self._query_args["select"]
+        view = self._query_args["view"]
+        select = select.limit(self.per_page).offset(self._query_offset)
+        return [view(i) for i in db.session.execute(select)]
+
+    def _query_count(self):
+        select = self._query_args["select"].order_by(None).subquery()
+        return db.session.execute(db.select(db.func.count()).select_from(select)).scalar()
+
+
+def son_count_column():
+    son = db.aliased(Comment)
+    return (db.select(db.func.count(son.id))
+            .where(son.father_id == Comment.id)
+            .correlate_except(son)
+            .scalar_subquery()
+            .label("son_count"))
+
+
+def excerpt_column():
+    """ 未回填摘要的旧数据只截取内容开头, 不读取完整内容 """
+    head = db.func.substr(Comment.content, 1, Comment.EXCERPT_LENGTH)
+    return db.func.coalesce(Comment.excerpt, head).label("excerpt")
+
+
+def comment_card_select(with_auth=True):
+    columns = [Comment.id, Comment.title, excerpt_column(), Comment.create_time, Comment.update_time, Comment.score,
+               son_count_column(), db.func.coalesce(CommentView.views, 0).label("view_count")]
+    if not with_auth:
+        select = db.select(*columns)
+    else:
+        select = (db.select(*columns, Comment.auth_id, User.email.label("auth_email"))
+                  .join(User, User.id == Comment.auth_id))
+    return select.outerjoin(CommentView, CommentView.comment_id == Comment.id)
+
+
+def list_comment_card(page: int, per_page: int, archive_id=None, sort="new"):
+    """
+    主页和归档页的讨论卡片, sort 为 new (最新)、score (评分) 或 hot (热度)
+    按热度排序时只列出 comment_rank 中的讨论 (创建时写入), 排序使用 comment_rank.hot 索引
+    主页按评分排序使用 ix_comment_father_id_score; 归档页先通过 archive_comment 的主键取出归档中的讨论,
+    评分在另一张表上, 没有可用的索引, 需要对该归档的全部主题排序, 代价与归档大小成正比
+    """
+    select = comment_card_select().where(Comment.title != None).where(Comment.father_id == None)
+    if archive_id:
+        select = (select
+                  .join(ArchiveComment, ArchiveComment.c.comment_id == Comment.id)
+                  .where(ArchiveComment.c.archive_id == archive_id))
+
+    if sort == "hot":
+        select = (select
+                  .join(CommentRank, CommentRank.comment_id == Comment.id)
+                  .order_by(CommentRank.hot.desc(), CommentRank.comment_id.desc()))
+    elif sort == "score":
+        select = select.order_by(Comment.score.desc(), Comment.id.desc())
+    elif archive_id:
+        select = select.order_by(Comment.create_time.desc(), Comment.title.asc())
+    else:
+        select = select.order_by(Comment.create_time.desc(), Comment.title.desc())
+    return RowPagination(page=page, per_page=per_page, error_out=False, select=select, view=CommentCard)
+
+
+def user_comment_card(user_id: int, page: int, per_page: int):
+    """ 用户讨论页的卡片, 页面已显示用户信息因此不需要作者 """
+    select = (comment_card_select(with_auth=False)
+              .where(Comment.auth_id == user_id)
+              .order_by(Comment.create_time.desc(), Comment.title.asc()))
+    return RowPagination(page=page, per_page=per_page, error_out=False, select=select, view=CommentCard)
+
+
+QUERY_TIMEOUT = 3024  # MySQL 查询超过 MAX_EXECUTION_TIME 时的错误码
+
+
+def is_query_timeout(e: OperationalError):
+    return bool(e.orig.args) and e.orig.args[0] == QUERY_TIMEOUT
+
+
+def search_user(prefix: str, role_id=None, after=None, limit=20):
+    """
+    按邮箱前缀搜索用户, 以上一页最后一个邮箱作为 after 翻页
+    前缀匹配和排序都使用 email 或 (role_id, email) 索引, 只扫描返回的行, 不计算总数
+    MySQL 下查询超过 USER_SEARCH_TIMEOUT 毫秒时中止并抛出 OperationalError, 调用者通过 is_query_timeout 判断
+    """
+    stmt = (db.select(User.id, User.email, Role.name.label("role"))
+            .join(Role, Role.id == User.role_id)
+            .where(User.email.startswith(prefix, autoescape=True))
+            .order_by(User.email.asc())
+            .limit(limit)
+            .prefix_with(f"/*+ MAX_EXECUTION_TIME({int(conf['USER_SEARCH_TIMEOUT'])}) */", dialect="mysql"))
+    if role_id is not None:
+        stmt = stmt.where(User.role_id == role_id)
+    if after:
+        stmt = stmt.where(User.email > after)
+    return db.session.execute(stmt).all()
+
+
+archives = VersionedCache("archive")
+
+
+def archive_choices():
+    """ 发表讨论时的归档选项, 一条查询得到所有归档的主题数, 创建归档时失效, 主题数最多滞后 CACHE_TTL 秒 """
+    def load():
+        count = (db.select(db.func.count(Comment.id))
+                 .join(ArchiveComment, ArchiveComment.c.comment_id == Comment.id)
+                 .where(ArchiveComment.c.archive_id == Archive.id)
+                 .where(Comment.title != None).where(Comment.father_id == None)
+                 .correlate(Archive)
+                 .scalar_subquery())
+        rows = db.session.execute(db.select(Archive.id, Archive.name, count.label("comment_count"))
+                                  .order_by(Archive.id))
+        return [(i.id, f"{i.name} ({i.comment_count})") for i in rows]
+    return archives.get("choices", load)
+
+
+roles = VersionedCache("role")
+
+
+def load_roles():
+    """ 角色很少且几乎不变, 整表缓存为游离对象, 不属于任何 session, 只读 """
+    result = {}
+    for row in db.session.execute(db.select(Role.id, Role.name, Role.permission)):
+        role = Role(id=row.id, name=row.name, permission=row.permission)
+        make_transient_to_detached(role)
+        result[row.id] = result[row.name] = role
+    return result
+
+
+def cached_role(role_id=None, name=None):
+    """ 直接修改 role 表后需要执行 flask cache clear role """
+    return roles.get("all", load_roles).get(role_id if role_id is not None else name)
@@ -0,0 +1,47 @@
+from flask import Response, render_template, stream_template, get_flashed_messages, current_app
+
+from .metrics import metrics
+
+from configure import conf
+
+
+# 响应头已发送, 无法再返回错误页面; 在页面末尾插入可见的提示
+STREAM_ERROR = '<div class="alert alert-danger" role="alert">页面加载出错, 请刷新重试</div>'
+
+
+def buffer_stream(stream, size: int, logger):
+    """
+    合并 jinja 产生的细碎片段, 累计到 size 字节后再发送
+    渲染出错时发送已渲染的部分和错误提示后重新抛出异常, 服务器不发送结束块而是断开连接, 客户端得到不完整的响应
+    """
+    buffer = []
+    buffer_size = 0
+    try:
+        for i in stream:
+            buffer.append(i)
+            buffer_size += len(i)
+            if buffer_size >= size:
+                yield "".join(buffer)
+                buffer = []
+                buffer_size = 0
+    except Exception:
+        logger.exception("Stream template fail")
+        metrics.inc("stream_template_error_total")
+        buffer.append(STREAM_ERROR)
+        yield "".join(buffer)
+        raise
+    if buffer:
+        yield "".join(buffer)
+
+
+def render_page(template_name: str, **context):
+    """
+    渲染页面, 开启 STREAM_TEMPLATE 后以流的方式发送
+    流式渲染前需要完成所有可能 abort 的检查
+    """
+    if not conf["STREAM_TEMPLATE"]:
+        return render_template(template_name, **context)
+
+    get_flashed_messages()  # 在响应头发送前取出闪现消息, 保证 session 的修改被保存
+    stream = stream_template(template_name, **context)
+    return Response(buffer_stream(stream, conf["STREAM_TEMPLATE_BUFFER"], current_app.logger), mimetype="text/html")
@@ -0,0 +1,86 @@
+import math
+import struct
+from hashlib import sha1, blake2b
+
+
+class HyperLogLog:
+    """ 基数估计, 2^P 个单字节寄存器, 误差约为 1.04/sqrt(2^P) """
+    P = 10
+    M = 1 << P
+
+    def __init__(self, registers: bytes = None):
+        if registers and len(registers) == self.M:
+            self.registers = bytearray(registers)
+        else:
+            self.registers = bytearray(self.M)
+
+    def add(self, value: str):
+        h = int.from_bytes(sha1(value.encode("utf-8")).digest()[:8], "big")
+        index = h >> (64 - self.P)
+        rest = h & ((1 << (64 - self.P)) - 1)
+        rank = (64 - self.P) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.M)
+        estimate = alpha * self.M * self.M / sum(2.0 ** -i for i in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.M and zeros > 0:  # 小基数时使用线性计数
+            estimate = self.M * math.log(self.M / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+
+class MinHash:
+    """
+    单次置换 MinHash: 每个 shingle 只计算一次哈希, 按哈希值分到 K 个桶中各取最小值
+    空桶从右侧最近的非空桶借值并加上距离, 两个集合相同桶的比例估计 Jaccard 相似度
+    """
+    K = 64
+    EMPTY = (1 << 64) - 1
+    STRUCT = struct.Struct(f"<{K}Q")
+
+    def __init__(self, values=None):
+        self.values = list(values) if values is not None else [self.EMPTY] * self.K
+
+    @classmethod
+    def from_shingles(cls, shingles):
+        values = [cls.EMPTY] * cls.K
+        for s in shingles:
+            h = int.from_bytes(blake2b(s.encode("utf-8"), digest_size=8).digest(), "little")
+            index, value = h % cls.K, h // cls.K
+            if value < values[index]:
+                values[index] = value
+
+        filled = [i for i, v in enumerate(values) if v != cls.EMPTY]
+        if filled and len(filled) < cls.K:
+            dense = list(values)
+            for i in range(cls.K):
+                if values[i] == cls.EMPTY:
+                    j = next((j for j in filled if j > i), filled[0] + cls.K)
+                    dense[i] = values[j % cls.K] + (j - i) * (cls.EMPTY // cls.K)  # 区分借来的值
+            values = [v & cls.EMPTY for v in dense]
+        return cls(values)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        return cls(cls.STRUCT.unpack(data))
+
+    def to_bytes(self):
+        return self.STRUCT.pack(*self.values)
+
+    def similarity(self, other: "MinHash"):
+        return sum(a == b for a, b in zip(self.values, other.values)) / self.K
+
+    def bands(self, rows: int):
+        """ LSH: 每 rows 个值合并为一个带的桶号, 任意一个带相同即为候选 """
+        band = struct.Struct(f"<{rows}Q")
+        return [int.from_bytes(blake2b(band.pack(*self.values[i:i + rows]), digest_size=8).digest(),
+                               "little", signed=True)
+                for i in range(0, self.K, rows)]
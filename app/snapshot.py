@@ -0,0 +1,207 @@
+import math
+import os
+import shutil
+from datetime import datetime, timedelta
+from hashlib import blake2b
+
+import click
+from flask import Response, request, session, send_file, current_app, url_for
+from flask.cli import AppGroup
+from flask_login import current_user
+
+from .db import db, Comment, Archive, ArchiveComment
+from .metrics import metrics
+from .readmodel import son_count_column
+
+from configure import conf
+
+
+snapshot_cli = AppGroup("snapshot", help="静态页面快照")
+
+PER_PAGE = 8  # 与 comment.list_all_page 每页的讨论个数相同
+BUILDING = "htalk.snapshot"  # 生成快照的请求在 environ 中带有此标记, 既不使用快照也不计入浏览数
+
+
+def thread_version(comment_id: int):
+    """
+    讨论页面的数据版本: 讨论本身和每个子讨论卡片的 (id, 修改时间, 点赞, 渲染版本, 子讨论个数)
+    逐个卡片比较, 任意卡片的变化都会改变版本, 不会因为求和而相互抵消; 浏览数不计入版本, 快照中的浏览数为生成时的值
+    讨论不存在时返回 None
+    """
+    rows = db.session.execute(db.select(Comment.id, Comment.update_time, Comment.score, Comment.render_version,
+                                        son_count_column())
+                              .where((Comment.id == comment_id) | (Comment.father_id == comment_id))
+                              .order_by(Comment.id)).all()
+    if not any(i.id == comment_id for i in rows):
+        return None
+    return tuple(tuple(i) for i in rows)
+
+
+def archive_version(archive_id: int, page: int):
+    """
+    归档列表一页的数据版本: 归档本身和主题个数, 该页每张卡片的 (id, 修改时间, 点赞, 子讨论个数)
+    与 list_comment_card 使用相同的排序, 每页有独立的版本; 归档不存在时返回 None
+    """
+    count = (db.select(db.func.count(ArchiveComment.c.comment_id))
+             .join(Comment, Comment.id == ArchiveComment.c.comment_id)
+             .where(ArchiveComment.c.archive_id == archive_id)
+             .where(Comment.title != None).where(Comment.father_id == None)
+             .scalar_subquery())
+    archive = db.session.execute(db.select(Archive.name, Archive.describe, count)
+                                 .where(Archive.id == archive_id)).first()
+    if archive is None:
+        return None
+    rows = db.session.execute(db.select(Comment.id, Comment.update_time, Comment.score, son_count_column())
+                              .join(ArchiveComment, ArchiveComment.c.comment_id == Comment.id)
+                              .where(ArchiveComment.c.archive_id == archive_id)
+                              .where(Comment.title != None).where(Comment.father_id == None)
+                              .order_by(Comment.create_time.desc(), Comment.title.asc())
+                              .limit(PER_PAGE).offset((page - 1) * PER_PAGE)).all()
+    return tuple(archive), tuple(tuple(i) for i in rows)
+
+
+class SnapshotStore:
+    """
+    快照保存在 SNAPSHOT_HOME/<kind>/<key>/<版本摘要>.html, 每个页面一个目录, 查找时只列出这个很小的目录
+    请求时用一条查询得到当前的数据版本, 存在同一版本的文件时直接发送, 否则照常渲染;
+    数据变化后旧文件不再匹配, 不需要额外的失效通知
+    只对匿名且没有闪现消息的请求使用快照, 页面内容与用户无关
+    """
+
+    @staticmethod
+    def digest(version):
+        return blake2b(repr(tuple(version)).encode("utf-8"), digest_size=8).hexdigest()
+
+    @staticmethod
+    def directory(kind: str, key: str):
+        return os.path.join(conf["SNAPSHOT_HOME"], kind, key)
+
+    def path(self, kind: str, key: str, digest: str):
+        return os.path.join(self.directory(kind, key), f"{digest}.html")
+
+    def files(self, kind: str, key: str):
+        try:
+            names = os.listdir(self.directory(kind, key))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.directory(kind, key), i) for i in names if i.endswith(".html")]
+
+    def serve(self, kind: str, key: str, version):
+        """ version 为返回数据版本的函数, 只在存在快照文件时调用; 无法使用快照时返回 None """
+        if (not conf["SNAPSHOT_HOME"] or request.environ.get(BUILDING) or
+                current_user.is_authenticated or "_flashes" in session):
+            return None
+        files = self.files(kind, key)
+        if not files:
+            return None
+
+        version = version()
+        path = self.path(kind, key, self.digest(version)) if version is not None else None
+        if path not in files:
+            metrics.inc("snapshot_stale_total")
+            return None
+        metrics.inc("snapshot_hit_total")
+        if conf["SNAPSHOT_ACCEL_REDIRECT"]:  # 由前端代理发送文件
+            location = conf["SNAPSHOT_ACCEL_REDIRECT"] + os.path.relpath(path, conf["SNAPSHOT_HOME"])
+            return Response(headers={"X-Accel-Redirect": location}, mimetype="text/html")
+        return send_file(path, mimetype="text/html")
+
+    def write(self, kind: str, key: str, version, html: bytes):
+        """ 先写临时文件再改名, 请求不会读到写了一半的文件; 同一页面的旧版本随后删除 """
+        path = self.path(kind, key, self.digest(version))
+        os.makedirs(self.directory(kind, key), exist_ok=True)
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(html)
+        os.replace(temp, path)
+        for i in self.files(kind, key):
+            if i != path:
+                os.remove(i)
+
+
+snapshots = SnapshotStore()
+
+
+def render(client, url: str):
+    """ 以匿名用户请求页面, 与动态渲染的结果完全相同 """
+    response = client.get(url, environ_overrides={BUILDING: True})
+    data = response.get_data()
+    response.close()
+    db.session.remove()
+    return data if response.status_code == 200 else None
+
+
+def old_threads(cutoff: datetime, chunk: int):
+    """ 按 id 分批返回本身和子讨论在 cutoff 之后都没有修改的主题和有回复的讨论 """
+    son = db.aliased(Comment)
+    has_son = db.select(son.id).where(son.father_id == Comment.id).exists()
+    last_id = 0
+    while True:
+        ids = db.session.execute(db.select(Comment.id)
+                                 .where((Comment.title != None) | has_son)
+                                 .where(Comment.update_time < cutoff)
+                                 .where(~db.select(son.id)
+                                        .where(son.father_id == Comment.id)
+                                        .where(son.update_time >= cutoff).exists())
+                                 .where(Comment.id > last_id)
+                                 .order_by(Comment.id).limit(chunk)).scalars().all()
+        if not ids:
+            return
+        last_id = ids[-1]
+        yield from ids
+
+
+def old_archives(cutoff: datetime):
+    """ 返回 (归档 id, 主题个数), 归档中最新的主题在 cutoff 之前 """
+    return db.session.execute(db.select(ArchiveComment.c.archive_id, db.func.count(Comment.id))
+                              .join(Comment, Comment.id == ArchiveComment.c.comment_id)
+                              .where(Comment.title != None).where(Comment.father_id == None)
+                              .group_by(ArchiveComment.c.archive_id)
+                              .having(db.func.max(Comment.update_time) < cutoff)).all()
+
+
+@snapshot_cli.command("build")
+@click.option("--days", default=None, type=int, help="超过多少天没有变化的讨论和归档, 默认为 SNAPSHOT_AGE")
+@click.option("--chunk", default=500, help="每次查询的主题个数")
+@click.option("--full", is_flag=True, help="忽略已有的快照, 全部重新生成")
+def build_command(days, chunk, full):
+    """ 增量生成快照: 数据版本与已有文件一致的页面跳过, 只重新渲染变化过的页面 """
+    if not conf["SNAPSHOT_HOME"]:
+        raise click.ClickException("SNAPSHOT_HOME is not configured")
+    cutoff = datetime.utcnow() - timedelta(days=days if days is not None else conf["SNAPSHOT_AGE"])
+    client = current_app.test_client()
+    built = skipped = 0
+
+    def build(kind, key, url, version):
+        nonlocal built, skipped
+        if version is None:
+            return
+        if not full and os.path.exists(snapshots.path(kind, key, snapshots.digest(version))):
+            skipped += 1
+            return
+        html = render(client, url)  # 先取版本再渲染, 渲染期间的修改只会使快照被判定为过期
+        if html is not None:
+            snapshots.write(kind, key, version, html)
+            built += 1
+
+    with current_app.test_request_context():
+        for comment_id in list(old_threads(cutoff, chunk)):
+            build("comment", str(comment_id), url_for("comment.comment_page", comment=comment_id),
+                  thread_version(comment_id))
+
+        for archive_id, count in old_archives(cutoff):
+            for page in range(1, math.ceil(count / PER_PAGE) + 1):
+                build("archive", f"{archive_id}-{page}",
+                      url_for("comment.list_all_page", archive=archive_id, page=page),
+                      archive_version(archive_id, page))
+            db.session.remove()
+    click.echo(f"Build {built} snapshots, skip {skipped} unchanged (before {cutoff.isoformat()})")
+
+
+@snapshot_cli.command("clear")
+def clear_command():
+    """ 删除所有快照, 修改模板或静态资源后执行 """
+    if conf["SNAPSHOT_HOME"] and os.path.isdir(conf["SNAPSHOT_HOME"]):
+        for kind in ("comment", "archive"):
+            shutil.rmtree(os.path.join(conf["SNAPSHOT_HOME"], kind), ignore_errors=True)
+    click.echo("Clear snapshots")
@@ -0,0 +1,231 @@
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import click
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort
+from flask_login import login_required
+
+from .db import db, Comment, CommentMinHash, CommentBand, CommentHold, Archive, Role
+from .login import role_required
+from .logger import Logger
+from .metrics import metrics
+from .notify import notify_reply
+from .ranking import ranking
+from .live import feed
+from .sketch import MinHash
+from .audit import audit_log
+from .bus import bus
+
+from configure import conf
+
+
+spam = Blueprint("spam", __name__)
+
+SHINGLE = 3  # 按字符切分, 不依赖中文分词
+ROWS = 4  # 16 个带, 每带 4 个值, 相似度 0.8 的讨论成为候选的概率约为 99.9%
+CANDIDATE_LIMIT = 100
+SEPARATOR = re.compile(r"[\W_]+")
+
+
+def shingles(content: str):
+    text = SEPARATOR.sub("", content.lower())
+    if len(text) <= SHINGLE:
+        return {text}
+    return {text[i:i + SHINGLE] for i in range(len(text) - SHINGLE + 1)}
+
+
+class SignatureCache:
+    """ 进程内的 LRU 缓存, 刷屏时候选讨论高度集中, 大部分签名不需要再查询数据库 """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__data = OrderedDict()
+
+    def get(self, comment_id: int):
+        with self.__lock:
+            signature = self.__data.get(comment_id)
+            if signature is not None:
+                self.__data.move_to_end(comment_id)
+            return signature
+
+    def put(self, comment_id: int, signature: tuple):
+        with self.__lock:
+            self.__data[comment_id] = signature
+            self.__data.move_to_end(comment_id)
+            while len(self.__data) > conf["SPAM_CACHE_SIZE"]:
+                self.__data.popitem(last=False)
+
+    def discard(self, key):
+        with self.__lock:
+            if key is None:
+                self.__data.clear()
+            elif key.isdigit():  # 其他 key (例如手动清除时输错) 不对应任何讨论
+                self.__data.pop(int(key), None)
+
+
+cache = SignatureCache()
+bus.subscribe("comment", cache.discard)  # 删除讨论后释放签名
+
+
+def find_similar(signature: MinHash):
+    """ 通过 LSH 索引找到候选讨论, 返回 (相似度, 讨论 id, 作者 id), 没有候选时返回 None """
+    keys = list(enumerate(signature.bands(ROWS)))
+    ids = db.session.execute(db.select(CommentBand.comment_id)
+                             .where(db.tuple_(CommentBand.band, CommentBand.bucket).in_(keys))
+                             .distinct()
+                             .order_by(CommentBand.comment_id.desc())
+                             .limit(CANDIDATE_LIMIT)).scalars().all()
+    if not ids:
+        return None
+
+    candidate = {}
+    for i in ids:
+        cached = cache.get(i)
+        if cached is not None:
+            candidate[i] = cached
+    missing = [i for i in ids if i not in candidate]
+    if missing:
+        for row in db.session.execute(db.select(CommentMinHash.comment_id, CommentMinHash.signature, Comment.auth_id)
+                                      .join(Comment, Comment.id == CommentMinHash.comment_id)
+                                      .where(CommentMinHash.comment_id.in_(missing))):
+            candidate[row.comment_id] = (MinHash.from_bytes(row.signature), row.auth_id)
+            cache.put(row.comment_id, candidate[row.comment_id])
+
+    return max(((signature.similarity(sig), i, auth_id) for i, (sig, auth_id) in candidate.items()), default=None)
+
+
+def check_comment(content: str, auth_id: int):
+    """
+    返回 (签名, 动作, 最相似的讨论 id, 相似度), 动作为 None、hold 或 reject
+    只有重复自己的讨论, 或新账号重复他人的讨论时才会被处理, 内容过短时不检查
+    """
+    if not conf["SPAM_CHECK"] or len(content) < conf["SPAM_MIN_LENGTH"]:
+        return None, None, None, 0
+    signature = MinHash.from_shingles(shingles(content))
+    match = find_similar(signature)
+    if match is None or match[0] < conf["SPAM_THRESHOLD"]:
+        return signature, None, None, 0
+
+    similarity, match_id, match_auth_id = match
+    if match_auth_id != auth_id:
+        count = db.session.execute(db.select(db.func.count(Comment.id))
+                                   .where(Comment.auth_id == auth_id)).scalar()
+        if count >= conf["SPAM_NEW_ACCOUNT_COMMENTS"]:
+            return signature, None, None, 0
+
+    metrics.inc(f"spam_{conf['SPAM_ACTION']}_total")
+    return signature, conf["SPAM_ACTION"], match_id, similarity
+
+
+def index_comment(comment_id: int, auth_id: int, signature: MinHash):
+    """ 与讨论在同一个事务中写入签名和 LSH 索引 """
+    db.session.execute(CommentMinHash.__table__.insert(),
+                       [{"comment_id": comment_id, "signature": signature.to_bytes()}])
+    db.session.execute(CommentBand.__table__.insert(),
+                       [{"band": i, "bucket": bucket, "comment_id": comment_id}
+                        for i, bucket in enumerate(signature.bands(ROWS))])
+    cache.put(comment_id, (signature, auth_id))
+
+
+def index_missing(chunk: int):
+    """ 为没有签名的讨论分批生成签名, 返回处理的讨论个数 """
+    table = Comment.__table__
+    minhash = CommentMinHash.__table__
+    last_id = 0
+    count = 0
+    while True:
+        rows = db.session.execute(db.select(table.c.id, table.c.content)
+                                  .outerjoin(minhash, minhash.c.comment_id == table.c.id)
+                                  .where(minhash.c.comment_id == None)
+                                  .where(table.c.id > last_id)
+                                  .order_by(table.c.id).limit(chunk)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        signatures = [(i.id, MinHash.from_shingles(shingles(i.content))) for i in rows
+                      if len(i.content) >= conf["SPAM_MIN_LENGTH"]]
+        if signatures:
+            db.session.execute(minhash.insert(),
+                               [{"comment_id": i, "signature": s.to_bytes()} for i, s in signatures])
+            db.session.execute(CommentBand.__table__.insert(),
+                               [{"band": j, "bucket": bucket, "comment_id": i}
+                                for i, s in signatures for j, bucket in enumerate(s.bands(ROWS))])
+        db.session.commit()
+        count += len(rows)
+        click.echo(f"Index {count} comments (id <= {last_id})")
+    return count
+
+
+@spam.route("/hold")
+@login_required
+@role_required(Role.BLOCK_USER, "list hold comment")
+def hold_page():
+    page = request.args.get("page", 1, type=int)
+    pagination = (CommentHold.query
+                  .options(db.joinedload(CommentHold.auth), db.joinedload(CommentHold.match))
+                  .order_by(CommentHold.id.desc())
+                  .paginate(page=page, per_page=8, error_out=False))
+    Logger.print_load_page_log("hold comment list")
+    return render_template("spam/hold.html", items=pagination.items, pagination=pagination)
+
+
+@spam.route("/hold/approve")
+@login_required
+@role_required(Role.BLOCK_USER, "approve hold comment")
+def approve_page():
+    hold = CommentHold.query.filter_by(id=request.args.get("hold", None, type=int)).first()
+    if not hold:
+        return abort(404)
+
+    father = Comment.query.filter_by(id=hold.father_id).first() if hold.father_id else None
+    if hold.father_id and not father:  # 父讨论已被删除, 不能作为主题讨论发布
+        hold_id = hold.id
+        db.session.delete(hold)
+        db.session.commit()
+        audit_log.record("discard_hold", "hold", hold_id, "father deleted")
+        flash("父讨论已被删除, 讨论已丢弃")
+        Logger.print_user_opt_success_log(f"discard hold comment {hold_id}")
+        return redirect(url_for("spam.hold_page"))
+
+    archive = Archive.query.filter(Archive.id.in_([int(i) for i in hold.archive.split(",") if i])).all()
+    now = datetime.utcnow()  # 以发布时间创建, 讨论页的实时更新按创建时间轮询
+    cm = Comment(title=hold.title, content=hold.content, father=father, archive=archive, auth=hold.auth,
+                 create_time=now, update_time=now)
+    db.session.add(cm)
+    ranking.add(cm)
+    notify_reply(cm, father)
+    db.session.flush()
+    if len(cm.content) >= conf["SPAM_MIN_LENGTH"]:
+        index_comment(cm.id, hold.auth_id, MinHash.from_shingles(shingles(cm.content)))
+    match_id = hold.match_id
+    db.session.delete(hold)
+    db.session.commit()
+    feed.publish(cm)
+    audit_log.record("approve_hold", "comment", cm.id, f"similar to {match_id}")
+    flash("讨论已发布")
+    Logger.print_user_opt_success_log(f"approve hold comment {cm.id}")
+    return redirect(url_for("spam.hold_page"))
+
+
+@spam.route("/hold/discard")
+@login_required
+@role_required(Role.BLOCK_USER, "discard hold comment")
+def discard_page():
+    hold_id = request.args.get("hold", None, type=int)
+    count = CommentHold.query.filter_by(id=hold_id).delete()
+    db.session.commit()
+    if count == 0:
+        return abort(404)
+    audit_log.record("discard_hold", "hold", hold_id)
+    flash("讨论已丢弃")
+    Logger.print_user_opt_success_log(f"discard hold comment")
+    return redirect(url_for("spam.hold_page"))
+
+
+@spam.cli.command("index")
+@click.option("--chunk", default=1000, help="每批处理的讨论个数")
+def index_command(chunk):
+    """ 为已有讨论生成近似重复检测的签名和索引 """
+    index_missing(chunk)
@@ -0,0 +1,91 @@
+import json
+import os
+from hashlib import sha1
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask.templating import DispatchingJinjaLoader
+from jinja2 import ChoiceLoader, ModuleLoader, FileSystemBytecodeCache, TemplateNotFound
+
+from configure import conf
+
+
+MANIFEST = "manifest.json"
+
+template_cli = AppGroup("template", help="模板预编译")
+
+
+class CompiledLoader(ModuleLoader):
+    """ 只加载与源码一致的预编译模板, 其余模板交给后续的 loader """
+
+    def __init__(self, path: str, names):
+        super(CompiledLoader, self).__init__(path)
+        self.names = frozenset(names)
+
+    def load(self, environment, name, globals=None):
+        if name not in self.names:
+            raise TemplateNotFound(name)
+        return super(CompiledLoader, self).load(environment, name, globals)
+
+
+def source_hash(source: str):
+    return sha1(source.encode("utf-8")).hexdigest()
+
+
+def create_bytecode_cache():
+    """ 根据配置生成 jinja 字节码缓存, 未配置时返回 None """
+    if len(conf["TEMPLATE_CACHE_HOME"]) == 0:
+        return None
+    return FileSystemBytecodeCache(conf["TEMPLATE_CACHE_HOME"], "htalk-%s.cache")
+
+
+def create_template_loader(app, loader):
+    """ 若存在预编译模板, 则在 loader 前插入 CompiledLoader; 源码已修改的模板不会使用预编译结果 """
+    path = conf["TEMPLATE_COMPILED_HOME"]
+    if len(path) == 0 or app.debug:
+        return loader
+
+    try:
+        with open(os.path.join(path, MANIFEST), mode="r", encoding="utf-8") as f:
+            manifest = json.loads(f.read())
+    except (OSError, ValueError):
+        return loader
+
+    names = []
+    for name, old_hash in manifest.items():
+        try:
+            source, _, _ = loader.get_source(None, name)
+        except TemplateNotFound:
+            continue
+        if source_hash(source) == old_hash:
+            names.append(name)
+
+    app.logger.info(f"Load {len(names)}/{len(manifest)} compiled templates from {path}")
+    return ChoiceLoader([CompiledLoader(path, names), loader])
+
+
+@template_cli.command("compile")
+def compile_template():
+    """ 预编译全部模板 (包括 email-msg) 到 TEMPLATE_COMPILED_HOME """
+    path = conf["TEMPLATE_COMPILED_HOME"]
+    if len(path) == 0:
+        raise click.ClickException("TEMPLATE_COMPILED_HOME is not set")
+
+    for i in os.listdir(path):  # 清理旧的预编译模板
+        if i.startswith("tmpl_") and i.endswith(".py"):
+            os.remove(os.path.join(path, i))
+
+    env = current_app.jinja_env
+    loader = DispatchingJinjaLoader(current_app)
+    manifest = {}
+    for name in sorted(loader.list_templates()):
+        source, filename, _ = loader.get_source(env, name)
+        code = env.compile(source, name, filename, raw=True, defer_init=True)
+        with open(os.path.join(path, ModuleLoader.get_module_filename(name)), mode="w", encoding="utf-8") as f:
+            f.write(code)
+        manifest[name] = source_hash(source)
+
+    with open(os.path.join(path, MANIFEST), mode="w", encoding="utf-8") as f:
+        f.write(json.dumps(manifest, indent=2))
+    click.echo(f"Compile {len(manifest)} templates to {path}")
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from configure import conf
+
+# 在导入 app 之前修改配置, 后台任务和跨进程的传输只在单个测试中按需开启
+conf.update({
+    "LOG_STDERR": False,
+    "WTF_CSRF_ENABLED": False,
+    "SERVER_NAME": None,
+    "SQLALCHEMY_DATABASE_URI": "sqlite://",
+    "PASSWD_WORKERS": 0,
+    "ADMISSION": False,
+    "RATE_LIMIT": False,
+    "BUS_TRANSPORT": "local",
+    "LIVE_BROKER": "local",
+    "HOT_REFRESH_INTERVAL": 0,
+    "VIEW_COUNTER": False,
+})
+
+
+@pytest.fixture
+def make_app(tmp_path, monkeypatch):
+    """ 返回创建 HTalkFlask 的函数, 使用 tmp_path 下的 SQLite 数据库, 可以临时修改配置 """
+    from app import HTalkFlask
+
+    def make(**kwargs):
+        monkeypatch.setitem(conf, "SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path}/htalk.db")
+        for key, value in kwargs.items():
+            monkeypatch.setitem(conf, key, value)
+        return HTalkFlask("main")
+    return make
@@ -0,0 +1,215 @@
+import random
+import re
+import shutil
+import threading
+from collections import Counter
+
+import pytest
+from flask import url_for
+from sqlalchemy import event
+
+from app.db import (db, create_all, create_faker_user, create_faker_comment, create_faker_archive,
+                    User, Role, Comment, Archive, ArchiveComment, Follow)
+from app.ranking import ranking
+from app.readmodel import roles, archives
+
+from configure import conf
+
+
+USERS = {"anonymous": None, "default": 2, "admin": 1}
+
+# 名称 -> (endpoint, 参数), 参数中的 topic、reply、archive 在填充数据后替换为实际的 id
+CASES = {
+    "index": ("base.index_page", {}),
+    "auth": ("auth.auth_page", {}),
+    "login_passwd": ("auth.passwd_login_page", {}),
+    "login_email": ("auth.email_login_page", {}),
+    "register": ("auth.register_page", {}),
+    "register_confirm": ("auth.register_confirm_page", {"token": "invalid"}),
+    "login_confirm": ("auth.email_login_confirm_page", {"token": "invalid"}),
+    "passwd": ("auth.change_passwd_page", {}),
+    "logout": ("auth.logout_page", {}),
+    "user": ("auth.user_page", {"user": 3}),
+    "follower": ("auth.follower_page", {}),
+    "followed": ("auth.followed_page", {}),
+    "follow": ("auth.set_follow_page", {"user": 30}),
+    "unfollow": ("auth.set_unfollow_page", {"user": 3}),
+    "block": ("auth.set_block_page", {"user": 50}),
+    "role": ("auth.change_role_page", {"user": 3}),
+    "search": ("auth.search_page", {"q": "a"}),
+    "comment": ("comment.comment_page", {"comment": "topic"}),
+    "comment_reply": ("comment.comment_page", {"comment": "reply"}),
+    "list_new": ("comment.list_all_page", {"page": 1}),
+    "list_hot": ("comment.list_all_page", {"page": 1, "sort": "hot"}),
+    "list_archive": ("comment.list_all_page", {"page": 1, "archive": "archive"}),
+    "list_user": ("comment.user_page", {"page": 1, "user": 3}),
+    "create": ("comment.create_page", {}),
+    "create_reply": ("comment.create_page", {"father": "topic"}),
+    "vote": ("comment.vote_page", {"comment": "topic"}),
+    "unvote": ("comment.unvote_page", {"comment": "reply"}),
+    "archive_list": ("archive.list_all_page", {}),
+    "archive_create": ("archive.create_page", {}),
+}
+
+# 名称 -> (SQL 语句个数, 响应字节数), 三种用户都不能超出
+# 每个用例在刚填充的数据库和空的进程内缓存上测量, 语句个数按实测值设定, 字节数留出约 25% 的余量
+BUDGET = {
+    "index": (0, 1024),
+    "auth": (6, 9216),
+    "login_passwd": (2, 9216),
+    "login_email": (2, 9216),
+    "register": (2, 9216),
+    "register_confirm": (0, 5120),
+    "login_confirm": (0, 5120),
+    "passwd": (2, 6144),
+    "logout": (2, 1024),
+    "user": (8, 6144),
+    "follower": (5, 10240),
+    "followed": (5, 10240),
+    "follow": (5, 1024),
+    "unfollow": (4, 1024),
+    "block": (7, 5120),
+    "role": (5, 8192),
+    "search": (4, 7168),
+    "comment": (7, 18432),
+    "comment_reply": (7, 14336),
+    "list_new": (4, 21504),
+    "list_hot": (4, 21504),
+    "list_archive": (5, 8192),
+    "list_user": (7, 7168),
+    "create": (3, 7168),
+    "create_reply": (4, 7168),
+    "vote": (5, 1024),
+    "unvote": (3, 1024),
+    "archive_list": (4, 12288),
+    "archive_create": (2, 6144),
+}
+
+BLUEPRINTS = ("base", "auth", "comment", "archive")
+
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+PARAMETERS = re.compile(r"\(\?(?:, \?)+\)")
+
+
+def shape(statement: str):
+    """ 合并空白, 去掉字面值和 IN 列表的长度, 同一处代码产生的语句得到相同的形状 """
+    statement = LITERAL.sub("?", " ".join(statement.split()))
+    return PARAMETERS.sub("(?, ...)", statement)
+
+
+def seed():
+    """ 固定随机种子填充数据, 每次运行的结果相同 """
+    random.seed(0)
+    from faker import Faker
+    Faker.seed(0)
+
+    create_all()
+    create_faker_user()
+    create_faker_comment()
+    create_faker_archive()
+
+    admin = db.session.execute(db.select(Role.id).where(Role.name == "admin")).scalar()
+    db.session.execute(db.update(User).where(User.id == USERS["admin"]).values(role_id=admin))
+    topics = db.session.execute(db.select(Comment.id).where(Comment.title != None).order_by(Comment.id)).scalars().all()
+    archive_ids = db.session.execute(db.select(Archive.id).order_by(Archive.id)).scalars().all()
+    for i, topic in enumerate(topics):
+        db.session.execute(ArchiveComment.insert().values(archive_id=archive_ids[i % len(archive_ids)],
+                                                          comment_id=topic))
+    for i in range(3, 13):
+        db.session.add(Follow(follower_id=USERS["default"], followed_id=i))
+        db.session.add(Follow(follower_id=i + 10, followed_id=USERS["default"]))
+    db.session.commit()
+    ranking.refresh(full=True)
+
+    topic = db.session.execute(db.select(Comment.father_id).where(Comment.father_id != None)
+                               .group_by(Comment.father_id)
+                               .order_by(db.func.count(Comment.id).desc(), Comment.father_id)).scalars().first()
+    reply = db.session.execute(db.select(Comment.id).where(Comment.father_id == topic)
+                               .order_by(Comment.id)).scalars().first()
+    return {"topic": topic, "reply": reply, "archive": archive_ids[0]}
+
+
+class StatementCounter:
+    """ 只记录调用线程执行的语句, 忽略计数器、总线等后台线程的查询 """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.thread = threading.get_ident()
+        self.statements = []
+
+    def __before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == self.thread:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self.__before_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(self.engine, "before_cursor_execute", self.__before_execute)
+
+
+@pytest.fixture(scope="session")
+def seeded(tmp_path_factory):
+    """ 填充一次数据, 每个用例复制一份数据库文件 """
+    from app import HTalkFlask
+    path = tmp_path_factory.mktemp("budget") / "seed.db"
+    uri = conf["SQLALCHEMY_DATABASE_URI"]
+    conf["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    try:
+        app = HTalkFlask("main")
+        with app.app_context():
+            ids = seed()
+            db.engine.dispose()
+    finally:
+        conf["SQLALCHEMY_DATABASE_URI"] = uri
+    return path, ids
+
+
+def test_every_route_has_budget(make_app):
+    """ 蓝图中没有对应用例的 GET 路由, 新增路由时需要同时增加用例和预算 """
+    app = make_app()
+    covered = {endpoint for endpoint, _ in CASES.values()}
+    missing = sorted(rule.endpoint for rule in app.url_map.iter_rules()
+                     if rule.endpoint.split(".")[0] in BLUEPRINTS and "GET" in rule.methods
+                     and rule.endpoint not in covered)
+    assert not missing, f"GET routes without a case in CASES and BUDGET: {missing}"
+    assert set(CASES) == set(BUDGET)
+
+
+@pytest.mark.parametrize("user", USERS)
+@pytest.mark.parametrize("name", CASES)
+def test_budget(name, user, seeded, make_app, tmp_path):
+    """
+    每个用例使用刚填充的数据库和空的进程内缓存, 只请求一次, 冷路径上加载缓存的查询也计入预算,
+    follow、block、vote 等修改数据的请求总是在相同的初始状态上测量
+    请求在应用上下文之外发出, 每个请求有独立的 g, 不会沿用上一个请求加载的用户
+    """
+    path, ids = seeded
+    shutil.copy(path, tmp_path / "htalk.db")
+    app = make_app()
+    endpoint, args = CASES[name]
+    with app.test_request_context():
+        url = url_for(endpoint, **{k: ids.get(v, v) if isinstance(v, str) else v for k, v in args.items()})
+    with app.app_context():
+        engine = db.engine
+        roles.invalidate()
+        archives.invalidate()
+
+    client = app.test_client()
+    if USERS[user] is not None:
+        with client.session_transaction() as session:
+            session["_user_id"] = str(USERS[user])
+            session["_fresh"] = True
+
+    with StatementCounter(engine) as counter:
+        response = client.get(url)
+        size = len(response.get_data())
+        response.close()
+
+    queries, max_size = BUDGET[name]
+    shapes = "\n".join(f"{count:3} x {statement[:200]}"
+                       for statement, count in Counter(shape(i) for i in counter.statements).most_common())
+    assert response.status_code < 500
+    assert len(counter.statements) <= queries, f"{len(counter.statements)}/{queries} queries on {url}\n{shapes}"
+    assert size <= max_size, f"{size}/{max_size} bytes on {url}"
@@ -0,0 +1,32 @@
+import os
+import queue
+import socket
+
+from app.bus import bus, SocketTransport
+from app.spam import SignatureCache
+
+
+def test_socket_transport_survives_bad_message(make_app, tmp_path):
+    """ 格式错误的消息和回调中的异常不会让接收线程退出 """
+    make_app(BUS_SOCKET_DIR=str(tmp_path / "bus"))
+    received = queue.Queue()
+
+    def callback(key):
+        if key == "bad":
+            raise ValueError(key)
+        received.put(key)
+
+    bus.subscribe("test-socket", callback)
+    SocketTransport().start(bus)
+    sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    path = os.path.join(SocketTransport.directory(), f"{os.getpid()}.sock")
+    sender.sendto(b"not json", path)
+    sender.sendto(b'["test-socket", "bad", 1]', path)
+    sender.sendto(b'["test-socket", "1", 2]', path)
+    assert received.get(timeout=10) == "1"
+
+
+def test_signature_cache_discard_ignores_non_integer_key():
+    cache = SignatureCache()
+    cache.discard("foo")
+    cache.discard(None)
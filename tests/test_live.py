@@ -0,0 +1,99 @@
+import multiprocessing
+import os
+import socket
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.db import db, create_all, User, Comment
+from app.live import feed, SocketBroker
+
+
+def seed():
+    create_all()
+    user = User(email="live@example.com", passwd_hash="", role_id=3)
+    topic = Comment(title="live", content="topic", auth=user)
+    db.session.add(topic)
+    db.session.commit()
+    return user.id, topic.id
+
+
+def subscriber(app, thread_id: int, ready, result):
+    """ 在另一个进程中订阅, 收到第一条事件后通过 result 返回 """
+    with app.app_context():
+        db.engine.dispose()  # 不使用父进程的连接
+    sub = feed.subscribe(thread_id)
+    ready.set()
+    result.put(sub.queue.get(timeout=10))
+
+
+def test_socket_broker_cross_process(make_app, tmp_path):
+    app = make_app(LIVE_BROKER="socket", LIVE_SOCKET_DIR=str(tmp_path / "live"))
+    with app.app_context():
+        user_id, topic_id = seed()
+
+    context = multiprocessing.get_context("fork")
+    ready, result = context.Event(), context.Queue()
+    process = context.Process(target=subscriber, args=(app, topic_id, ready, result), daemon=True)
+    process.start()
+    try:
+        assert ready.wait(10)
+        with app.app_context():
+            reply = Comment(content="reply", auth_id=user_id, father_id=topic_id)
+            db.session.add(reply)
+            db.session.commit()
+            feed.publish(reply)  # 本进程没有订阅者, 只通过 socket 通知其他进程
+            reply_id = reply.id
+        row_id, event = result.get(timeout=10)
+    finally:
+        process.terminate()
+    assert row_id == reply_id
+    assert "event: comment" in event and '"content":"reply"' in event
+
+
+def test_poll_overlap_delivers_late_commit(make_app):
+    """ id 较小的讨论在较大的 id 之后才提交, 仍然在下一次轮询时分发, 重叠窗口内的讨论不重复分发 """
+    app = make_app(LIVE_BROKER="database", LIVE_POLL_INTERVAL=3600)
+    with app.app_context():
+        user_id, topic_id = seed()
+        sub = feed.subscribe(topic_id)
+        try:
+            feed.poll()  # 第一次轮询只记录起点
+            now = datetime.utcnow()
+            db.session.add(Comment(id=100, content="early", auth_id=user_id, father_id=topic_id, create_time=now))
+            db.session.commit()
+            feed.poll()
+            db.session.add(Comment(id=50, content="late", auth_id=user_id, father_id=topic_id,
+                                   create_time=now - timedelta(seconds=1)))
+            db.session.commit()
+            feed.poll()
+            feed.poll()
+        finally:
+            feed.unsubscribe(sub)
+    received = []
+    while not sub.queue.empty():
+        received.append(sub.queue.get_nowait()[0])
+    assert received == [100, 50]
+
+
+def test_socket_broker_survives_bad_datagram(make_app, tmp_path):
+    """ 格式错误的数据报被丢弃, 接收线程继续分发之后的讨论 """
+    app = make_app(LIVE_SOCKET_DIR=str(tmp_path / "live"))
+    with app.app_context():
+        user_id, topic_id = seed()
+        reply = Comment(content="reply", auth_id=user_id, father_id=topic_id)
+        db.session.add(reply)
+        db.session.commit()
+        reply_id = reply.id
+
+    sub = feed.subscribe(topic_id)
+    try:
+        SocketBroker().start(feed)
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        path = os.path.join(SocketBroker.directory(), f"{os.getpid()}.sock")
+        sender.sendto(b"not-a-comment-id", path)
+        sender.sendto(str(reply_id).encode("utf-8"), path)
+        row_id, _ = sub.queue.get(timeout=10)
+    finally:
+        feed.unsubscribe(sub)
+    assert row_id == reply_id
@@ -0,0 +1,29 @@
+from app.db import db, create_all, User, ModerationJob
+from app.moderate import runner, create_job
+
+
+def test_unexpected_error_releases_lease(make_app):
+    """ 非数据库错误时任务保持未完成并释放租约, 之后可以继续处理 """
+    app = make_app(MODERATION_CHUNK_PAUSE=0)
+    with app.app_context():
+        create_all()
+        db.session.add(User(email="spam@example.com", passwd_hash="", role_id=3))
+        db.session.commit()
+        job_id = create_job(ModerationJob.BLOCK, None, users="spam@example.com").id
+
+        def fail(*args):
+            raise RuntimeError("boom")
+
+        runner.change_role = fail
+        try:
+            assert runner.claim(job_id)
+            runner.run(job_id)
+        finally:
+            del runner.change_role
+        job = db.session.get(ModerationJob, job_id)
+        assert (job.state, job.lease_time, job.message) == (ModerationJob.RUNNING, None, "boom")
+
+        assert runner.claim(job_id)
+        runner.run(job_id)
+        assert db.session.get(ModerationJob, job_id).state == ModerationJob.DONE
+        assert db.session.execute(db.select(User.role_id).where(User.email == "spam@example.com")).scalar() == 4
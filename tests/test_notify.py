@@ -0,0 +1,46 @@
+import sys
+from datetime import datetime, timedelta
+
+from app.db import db, create_all, User, Notification
+from app.notify import digest, LEASE
+
+
+def seed():
+    create_all()
+    users = [User(email=f"notify{i}@example.com", passwd_hash="", role_id=3) for i in range(3)]
+    db.session.add_all(users)
+    db.session.flush()
+    for i in (1, 2):
+        db.session.add(Notification(user_id=users[i].id, kind=Notification.FOLLOW, actor_id=users[0].id))
+    db.session.commit()
+    return [i.id for i in users]
+
+
+def test_digest_reclaims_expired_claims(make_app, monkeypatch):
+    """ 领取后没有发送的通知在租约过期后重新领取, 发送失败的通知在下一批重新领取, 发送成功的不再发送 """
+    app = make_app(WEBSITE_URL="http://localhost")
+    sent, fail = [], set()
+
+    def send_msg(title, to, template, **kwargs):
+        if to in fail:
+            raise OSError("smtp")
+        sent.append(to)
+
+    monkeypatch.setattr(sys.modules["app.notify"], "send_msg", send_msg)
+    with app.app_context():
+        _, first, second = seed()
+        table = Notification.__table__
+        db.session.execute(table.update().where(table.c.user_id == first)  # worker 在领取后退出
+                           .values(digest="lost", claim_time=datetime.utcnow() - LEASE - timedelta(minutes=1)))
+        db.session.execute(table.update().where(table.c.user_id == second)  # 另一个 worker 正在发送
+                           .values(digest="running", claim_time=datetime.utcnow()))
+        db.session.commit()
+
+        fail.add("notify1@example.com")
+        assert digest.send() == 0
+        fail.clear()
+        assert digest.send() == 1
+        assert digest.send() == 0
+        assert sent == ["notify1@example.com"]
+        assert db.session.execute(db.select(Notification.claim_time)
+                                  .where(Notification.user_id == first)).scalar() is None
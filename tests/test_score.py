@@ -0,0 +1,74 @@
+import json
+from datetime import datetime, timedelta
+
+from flask import url_for
+
+from app.db import db, create_all, User, Comment, CommentVote
+from app.counter import scores
+
+
+def setup_db():
+    create_all()
+    scores.flush()  # 丢弃其他测试留在内存中的增量, 此时还没有讨论
+    user = User(email="score@example.com", passwd_hash="", role_id=3)
+    db.session.add(user)
+    db.session.commit()
+    return user.id
+
+
+def test_reconcile_keeps_imported_score(make_app, tmp_path):
+    """ 导入的评分没有点赞记录, 重新计算时只修正点赞部分 """
+    app = make_app()
+    with app.app_context():
+        setup_db()
+    users, comments = tmp_path / "user.ndjson", tmp_path / "comment.ndjson"
+    users.write_text(json.dumps({"id": 1, "email": "old@example.com"}) + "\n")
+    comments.write_text("\n".join(json.dumps(i) for i in (
+        {"id": 1, "title": "imported", "content": "topic", "auth_id": 1, "score": 5},
+        {"id": 2, "title": "lost", "content": "topic", "auth_id": 1, "score": 3},
+    )) + "\n")
+    runner = app.test_cli_runner()
+    assert runner.invoke(args=["import", "user", str(users)]).exit_code == 0
+    assert runner.invoke(args=["import", "comment", str(comments)]).exit_code == 0
+
+    old = datetime.utcnow() - timedelta(days=1)
+    with app.app_context():
+        imported, lost = db.session.execute(db.select(Comment).order_by(Comment.id)).scalars().all()
+        voter = db.session.execute(db.select(User.id).where(User.email == "score@example.com")).scalar()
+        db.session.add(CommentVote(comment_id=lost.id, user_id=voter, time=old))  # 增量在 worker 退出时丢失
+        lost.vote_time = old
+        db.session.commit()
+
+        assert scores.reconcile(100) == (2, 1)
+        assert db.session.get(Comment, imported.id).score == 5
+        assert db.session.get(Comment, lost.id).score == 4
+
+
+def test_reconcile_skips_recent_unvote(make_app):
+    """ 取消点赞删除了最后一条点赞记录, -1 还在内存中时不能修正评分 """
+    app = make_app(WRITE_BEHIND_INTERVAL=3600)
+    old = datetime.utcnow() - timedelta(days=1)
+    with app.app_context():
+        user_id = setup_db()
+        topic = Comment(title="vote", content="topic", auth_id=user_id, score=1, vote_time=old)
+        db.session.add(topic)
+        db.session.flush()
+        db.session.add(CommentVote(comment_id=topic.id, user_id=user_id, time=old))
+        db.session.commit()
+        topic_id = topic.id
+
+    with app.test_request_context():
+        url = url_for("comment.unvote_page", comment=topic_id)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+    assert client.get(url).status_code == 302
+
+    with app.app_context():
+        assert scores.reconcile(100) == (1, 0)
+        assert db.session.get(Comment, topic_id).score == 1
+        scores.flush()
+        db.session.expire_all()
+        assert db.session.get(Comment, topic_id).score == 0
+        assert scores.reconcile(100) == (1, 0)
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+
+from flask import url_for
+
+from app.db import db, create_all, User, Comment, CommentHold
+from app.live import feed
+
+
+def setup_hold(app, father_id=None):
+    """ 返回 (管理员 id, 主题讨论 id, 暂扣的回复 id), father_id 为空时回复该主题讨论 """
+    with app.app_context():
+        create_all()
+        admin = User(email="admin@example.com", passwd_hash="", role_id=1)
+        topic = Comment(title="topic", content="topic", auth=admin)
+        db.session.add(topic)
+        db.session.flush()
+        hold = CommentHold(content="reply", father_id=father_id or topic.id, auth=admin, match_id=topic.id,
+                           similarity=0.9, create_time=datetime.utcnow() - timedelta(hours=1))
+        db.session.add(hold)
+        db.session.commit()
+        return admin.id, topic.id, hold.id
+
+
+def approve(app, admin_id, hold_id):
+    with app.test_request_context():
+        url = url_for("spam.approve_page", hold=hold_id)
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(admin_id)
+        session["_fresh"] = True
+    return client.get(url)
+
+
+def test_approve_publishes_reply(make_app):
+    """ 审核通过的回复以通过时间创建, 并推送给正在查看该讨论的连接 """
+    app = make_app()
+    admin_id, topic_id, hold_id = setup_hold(app)
+    sub = feed.subscribe(topic_id)
+    try:
+        assert approve(app, admin_id, hold_id).status_code == 302
+    finally:
+        feed.unsubscribe(sub)
+    row_id, _ = sub.queue.get_nowait()
+    with app.app_context():
+        reply = db.session.get(Comment, row_id)
+        assert reply.father_id == topic_id
+        assert reply.create_time > datetime.utcnow() - timedelta(minutes=1)
+
+
+def test_approve_discards_reply_to_deleted_father(make_app):
+    app = make_app()
+    admin_id, topic_id, hold_id = setup_hold(app, father_id=999)
+    assert approve(app, admin_id, hold_id).status_code == 302
+    with app.app_context():
+        assert db.session.get(CommentHold, hold_id) is None
+        assert db.session.execute(db.select(db.func.count(Comment.id))).scalar() == 1